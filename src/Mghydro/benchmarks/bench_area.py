@@ -0,0 +1,92 @@
+"""
+Benchmark: accuracy and speed of the polygon area calculation (py/area.py) vs. the original get_area().
+
+Run it from the Mghydro folder, so that config.py and the relative paths in it are found:
+
+    python benchmarks/bench_area.py 72
+    python benchmarks/bench_area.py 72 --sample 2000 --lowres
+
+Uses a sample of the unit catchments in a basin, plus a few large dissolved watersheds (the
+pre-dissolved polygons, if they have been built, which have many more vertices). For each method,
+reports the time, throughput, and the error relative to the geodesic area from pyproj.Geod.
+"""
+import argparse
+import os
+import sys
+import time
+from functools import partial
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+import shapely
+import shapely.ops
+import pyproj
+from delineate import load_gdf
+from py.area import get_area, get_areas, geodesic_area
+from py.predissolve import load_predissolved
+
+
+def get_area_original(poly) -> float:
+    """
+    The original get_area() from delineate.py, for comparison.
+    (It fails for polygons whose bounds are centered on the equator, where lat_1 = -lat_2; we return NaN.)
+    """
+    if poly.bounds[1] + poly.bounds[3] == 0:
+        return np.nan
+    projected_poly = shapely.ops.transform(
+        partial(
+            pyproj.transform,
+            pyproj.Proj(init='EPSG:4326'),
+            pyproj.Proj(
+                proj='aea',
+                lat_1=poly.bounds[1],
+                lat_2=poly.bounds[3]
+            )
+        ),
+        poly)
+    return projected_poly.area / 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('basin', type=int, help="Level 2 basin, e.g. 72")
+    parser.add_argument('--sample', type=int, default=500, help="Number of unit catchments. Default: 500")
+    parser.add_argument('--lowres', action='store_true', help="Use the low-resolution unit catchments")
+    args = parser.parse_args()
+
+    catchments_gdf = load_gdf("catchments", args.basin, not args.lowres)
+    sample = catchments_gdf.sample(min(args.sample, len(catchments_gdf)), random_state=0)
+    test_sets = [("unit catchments", sample.geometry.values)]
+
+    predissolved_gdf = load_predissolved(args.basin, not args.lowres)
+    if predissolved_gdf is not None and len(predissolved_gdf) > 0:
+        largest = predissolved_gdf.geometry.values[np.argsort(shapely.get_num_coordinates(
+            predissolved_gdf.geometry.values))[-10:]]
+        test_sets.append(("large watersheds", largest))
+
+    with np.errstate(all='ignore'):
+        for name, geoms in test_sets:
+            n_vertices = int(shapely.get_num_coordinates(geoms).sum())
+            print(f"\n{len(geoms):,} {name}, {n_vertices:,} vertices")
+
+            reference = np.array([geodesic_area(g) for g in geoms])
+            methods = {
+                'original get_area()': lambda: np.array([get_area_original(g) for g in geoms]),
+                'get_area(), one at a time': lambda: np.array([get_area(g) for g in geoms]),
+                'get_areas(), all at once': lambda: get_areas(geoms),
+                'geodesic_area()': lambda: np.array([geodesic_area(g) for g in geoms]),
+            }
+
+            print(f"  {'':28s} {'time (s)':>10s} {'vertices/s':>12s} {'mean err':>10s} {'max err':>10s}")
+            for method, f in methods.items():
+                t0 = time.perf_counter()
+                areas = f()
+                elapsed = time.perf_counter() - t0
+                rel_err = np.abs(areas - reference) / reference
+                print(f"  {method:28s} {elapsed:10.3f} {n_vertices / elapsed:12,.0f} "
+                      f"{np.nanmean(rel_err):10.2e} {np.nanmax(rel_err):10.2e}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+"""
+Benchmark: loading a basin's unit catchments and rivers from the pickle files vs. the
+columnar cache (py/columnar_cache.py).
+
+Run it from the Mghydro folder, so that config.py and the relative paths in it are found:
+
+    python benchmarks/bench_cache.py 72
+
+For each layer, we first make sure both caches exist, then time the loads in fresh
+Python processes ("cold start", like each SLURM task or each run of delineate.py),
+and again in the same process ("warm start", where the OS already has the files in its page cache).
+The columnar cache is timed for a full read, for the columns that delineate.py uses,
+and for an attributes-only read from the memory-mapped Arrow file.
+"""
+import argparse
+import os
+import pickle
+import subprocess
+import sys
+import time
+
+MGHYDRO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, MGHYDRO_DIR)
+
+from delineate import get_pickle_filename, get_shapefile_name, RIVERS_COLUMNS, PROJ_WGS84
+from py.topology import UP_FIELDS
+import py.columnar_cache as columnar_cache
+
+# The loads that we time: name -> Python statement, run with `basin`, `geotype` and `res` defined
+LOADS = {
+    'pickle, full':
+        "pickle.load(open(get_pickle_filename(geotype, basin, res), 'rb'))",
+    'columnar, full':
+        "columnar_cache.load_columnar(geotype, basin, res)",
+    'columnar, delineate() columns':
+        "columnar_cache.load_columnar(geotype, basin, res, columns=COLUMNS[geotype])",
+    'columnar, attributes only (mmap)':
+        "columnar_cache.load_columnar(geotype, basin, res, columns=ATTRIBUTES[geotype], geometry=False)",
+}
+
+# The columns delineate.py needs from each layer
+COLUMNS = {'catchments': ['unitarea'], 'rivers': RIVERS_COLUMNS}
+ATTRIBUTES = {'catchments': ['unitarea'], 'rivers': UP_FIELDS + ['uparea']}
+
+SETUP = "import pickle, sys; sys.path.insert(0, {dir!r}); " \
+        "from delineate import get_pickle_filename; import py.columnar_cache as columnar_cache; " \
+        "from benchmarks.bench_cache import COLUMNS, ATTRIBUTES; " \
+        "basin, geotype, res = {basin}, {geotype!r}, {res}"
+
+
+def ensure_caches(geotype: str, basin: int, res: bool):
+    """Builds both the pickle file and the columnar cache from the shapefile, if needed."""
+    import geopandas as gpd
+    shapefile = get_shapefile_name(geotype, basin, res)
+    pickle_fname = get_pickle_filename(geotype, basin, res)
+    have_pickle = os.path.isfile(pickle_fname)
+    have_columnar = columnar_cache.is_valid(geotype, basin, res, shapefile)
+    if have_pickle and have_columnar:
+        return
+
+    t0 = time.perf_counter()
+    gdf = gpd.read_file(shapefile)
+    gdf.set_index('COMID', inplace=True)
+    gdf.set_crs(PROJ_WGS84, inplace=True, allow_override=True)
+    print(f"  read shapefile in {time.perf_counter() - t0:.2f} s")
+    if not have_pickle:
+        with open(pickle_fname, 'wb') as f:
+            pickle.dump(gdf, f)
+    if not have_columnar:
+        columnar_cache.save_columnar(gdf, geotype, basin, res, shapefile)
+
+
+def time_cold(statement: str, setup: str, repeats: int) -> float:
+    """Best time of `statement` in fresh Python processes."""
+    code = f"{setup}\nimport time\nt0 = time.perf_counter()\n{statement}\nprint(time.perf_counter() - t0)"
+    times = []
+    for _ in range(repeats):
+        out = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, cwd=MGHYDRO_DIR,
+                             check=True)
+        times.append(float(out.stdout.strip().splitlines()[-1]))
+    return min(times)
+
+
+def time_warm(statement: str, setup: str, repeats: int) -> float:
+    """Best time of `statement` in this process, after a first run to warm everything up."""
+    namespace = {}
+    exec(setup, namespace)
+    exec(statement, namespace)
+    times = []
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        exec(statement, namespace)
+        times.append(time.perf_counter() - t0)
+    return min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('basin', type=int, help="Level 2 basin, e.g. 72")
+    parser.add_argument('--lowres', action='store_true', help="Use the low-resolution unit catchments")
+    parser.add_argument('-r', '--repeats', type=int, default=3, help="Number of repeats. Default: 3")
+    args = parser.parse_args()
+
+    if not columnar_cache.HAS_PYARROW:
+        raise Exception("This benchmark requires pyarrow")
+
+    for geotype, res in [('catchments', not args.lowres), ('rivers', True)]:
+        print(f"\n{geotype}, basin {args.basin} ({'hires' if res else 'lores'})")
+        ensure_caches(geotype, args.basin, res)
+        setup = SETUP.format(dir=MGHYDRO_DIR, basin=args.basin, geotype=geotype, res=res)
+        print(f"  {'':34s} {'cold (s)':>10s} {'warm (s)':>10s}")
+        for name, statement in LOADS.items():
+            cold = time_cold(statement, setup, args.repeats)
+            warm = time_warm(statement, setup, args.repeats)
+            print(f"  {name:34s} {cold:10.3f} {warm:10.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,152 @@
+"""
+Benchmark: the ways of dissolving the unit catchments into a watershed (DISSOLVE_METHOD, see py/fast_dissolve.py).
+
+Run it from the Mghydro folder, so that config.py and the relative paths in it are found:
+
+    python benchmarks/bench_dissolve.py 72
+    python benchmarks/bench_dissolve.py 72 74 --sample 20 --methods clip coverage edges --lowres
+
+For each basin, picks a sample of river reaches with a range of upstream areas, from a handful of unit
+catchments up to the largest watershed in the basin, and dissolves the unit catchments upstream of each one
+with every method. Each dissolve runs in its own forked process, so that we can measure its peak memory
+(on Linux and macOS; elsewhere, the memory is not reported).
+
+The "edges" method uses the edge index of the basin if it has been built (python prepare_data.py edges 72),
+unless you add --no-index. With --workers N, the dissolves are split into chunks and run in N processes
+(see dissolve_parallel); the memory then includes the largest worker.
+
+Reports, for each method, the total and mean time, the largest increase in peak memory, and how well
+the polygons agree with the "clip" method: the largest difference in area, and the smallest intersection
+over union (IoU).
+"""
+import argparse
+import os
+import sys
+import time
+import multiprocessing
+from collections import defaultdict
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+from shapely import wkb
+from config import DISSOLVE_CHUNK_SIZE
+from delineate import load_gdf
+from py.area import get_area
+from py.fast_dissolve import dissolve_parallel, DISSOLVE_METHODS
+from py.edge_index import load_edge_index
+from py.signature import signature
+from py.topology import UP_FIELDS, load_topology, upstream_comids
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+def peak_memory() -> float:
+    """Peak resident memory of this process (and its largest child process) so far, in MB."""
+    if resource is None:
+        return np.nan
+    # Plus the largest of the worker processes that have finished, with --workers
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss + \
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    # In kB on Linux, and in bytes on macOS
+    return maxrss / 1e6 if sys.platform == 'darwin' else maxrss / 1e3
+
+
+def run_dissolve(gdf, method: str, options: dict, conn):
+    """Runs in the child process, and sends back the time, the increase in peak memory, and the polygon."""
+    before = peak_memory()
+    t0 = time.perf_counter()
+    poly = dissolve_parallel(gdf, method, **options).iloc[0]
+    elapsed = time.perf_counter() - t0
+    conn.send((elapsed, peak_memory() - before, wkb.dumps(poly)))
+    conn.close()
+
+
+def timed_dissolve(gdf, method: str, options: dict) -> (float, float, object):
+    """
+    Dissolves in a forked process if we can, otherwise in this one.
+    The options are the other arguments of dissolve_parallel(), e.g. the number of workers and the edge index.
+    """
+    if 'fork' not in multiprocessing.get_all_start_methods():
+        t0 = time.perf_counter()
+        poly = dissolve_parallel(gdf, method, **options).iloc[0]
+        return time.perf_counter() - t0, np.nan, poly
+
+    context = multiprocessing.get_context('fork')
+    parent_conn, child_conn = context.Pipe()
+    process = context.Process(target=run_dissolve, args=(gdf, method, options, child_conn))
+    process.start()
+    elapsed, memory, poly = parent_conn.recv()
+    process.join()
+    return elapsed, memory, wkb.loads(poly)
+
+
+def pick_outlets(rivers_gdf, topology, n: int) -> list:
+    """River reaches at evenly spaced quantiles of upstream area, always including the largest."""
+    uparea = rivers_gdf['uparea'].sort_values()
+    positions = np.unique(np.linspace(0, len(uparea) - 1, n).round().astype(int))
+    return [(comid, upstream_comids(topology, comid)) for comid in uparea.index[positions]]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('basins', type=int, nargs='+', help="Level 2 basins, e.g. 72")
+    parser.add_argument('--sample', type=int, default=10, help="Number of outlets per basin. Default: 10")
+    parser.add_argument('--methods', nargs='+', default=list(DISSOLVE_METHODS), choices=DISSOLVE_METHODS,
+                        help="Methods to compare. Default: all of them. The first one is the reference.")
+    parser.add_argument('--lowres', action='store_true', help="Use the low-resolution (simplified) unit catchments")
+    parser.add_argument('--no-index', action='store_true', help="Don't use the edge index for the \"edges\" method")
+    parser.add_argument('--workers', type=int, default=1, help="Number of processes for each dissolve. Default: 1")
+    parser.add_argument('--chunk-size', type=int, default=DISSOLVE_CHUNK_SIZE,
+                        help=f"Polygons per chunk, with --workers. Default: DISSOLVE_CHUNK_SIZE = {DISSOLVE_CHUNK_SIZE}")
+    args = parser.parse_args()
+
+    reference = "clip" if "clip" in args.methods else args.methods[0]
+    times = defaultdict(float)
+    memory = defaultdict(float)
+    area_diff = defaultdict(float)
+    min_iou = defaultdict(lambda: 1.0)
+    n_outlets = 0
+
+    for basin in args.basins:
+        catchments_gdf = load_gdf("catchments", basin, not args.lowres)
+        rivers_gdf = load_gdf("rivers", basin, True, columns=UP_FIELDS + ['uparea'], geometry=False)
+        topology = load_topology(basin, rivers_gdf)
+        edge_index = None if args.no_index else load_edge_index(basin, not args.lowres, signature(catchments_gdf))
+        if "edges" in args.methods:
+            print(f"Basin {basin}: the \"edges\" method is {'not ' if edge_index is None else ''}using the edge index")
+
+        for comid, B in pick_outlets(rivers_gdf, topology, args.sample):
+            gdf = catchments_gdf.loc[B]
+            n_outlets += 1
+            print(f"\nBasin {basin}, COMID {comid}: {len(B):,} unit catchments")
+            polys = {}
+            for method in [reference] + [m for m in args.methods if m != reference]:
+                options = {'workers': args.workers, 'chunk_size': args.chunk_size, 'memory_mb': 0,
+                           'edge_index': edge_index, 'catchments_gdf': catchments_gdf}
+                elapsed, mem, poly = timed_dissolve(gdf, method, options)
+                polys[method] = poly
+                times[method] += elapsed
+                memory[method] = np.nanmax([memory[method], mem])
+
+                ref = polys[reference]
+                diff = abs(get_area(poly) - get_area(ref)) / get_area(ref)
+                iou = poly.intersection(ref).area / poly.union(ref).area
+                area_diff[method] = max(area_diff[method], diff)
+                min_iou[method] = min(min_iou[method], iou)
+                print(f"  {method:10s} {elapsed:8.3f} s  {mem:8.1f} MB  area {diff:8.4%}  IoU {iou:.6f}  "
+                      f"{poly.geom_type}, valid: {poly.is_valid}")
+
+    print(f"\nSummary for {n_outlets} outlets, compared to '{reference}':")
+    print(f"{'method':10s} {'total (s)':>10s} {'mean (s)':>10s} {'peak (MB)':>10s} {'max area diff':>14s} "
+          f"{'min IoU':>9s}")
+    for method in args.methods:
+        print(f"{method:10s} {times[method]:10.2f} {times[method] / n_outlets:10.3f} {memory[method]:10.1f} "
+              f"{area_diff[method]:14.4%} {min_iou[method]:9.6f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+"""
+Benchmark: dissolving a large watershed from all of its unit catchments vs. from the
+pre-dissolved pieces (py/predissolve.py) plus the leftover unit catchments.
+
+Run it from the Mghydro folder, so that config.py and the relative paths in it are found:
+
+    python benchmarks/bench_predissolve.py
+    python benchmarks/bench_predissolve.py --outlet "Grand River" 42.8595 -79.5783 --largest 82
+
+By default, times the Grand River (Ontario) at its mouth, and the reach with the largest
+upstream area in the same Level 2 basin (a continental-scale outlet). Use --largest to add the
+largest outlet of any other basin. If the pre-dissolved polygons have not been built with
+prepare_data.py, they are built here first (and that time is reported too).
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import geopandas as gpd
+from shapely.geometry import Point
+from config import MERIT_BASINS, PREDISSOLVE_AREA
+from delineate import load_gdf, get_area
+from py.fast_dissolve import dissolve_geopandas
+from py.topology import UP_FIELDS, load_topology, upstream_comids
+from py.signature import signature
+from py.predissolve import load_predissolved, build_predissolved, save_predissolved, cached_mask, \
+    assemble_subbasins
+
+
+def find_basin(lat: float, lng: float) -> int:
+    megabasins_gdf = gpd.read_file(MERIT_BASINS)
+    hits = megabasins_gdf[megabasins_gdf.intersects(Point(lng, lat))]
+    if len(hits) == 0:
+        raise Exception(f"Point {lat}, {lng} is not in any Level 2 basin")
+    return int(hits.iloc[0].BASIN)
+
+
+def find_comid(catchments_gdf: gpd.GeoDataFrame, lat: float, lng: float) -> int:
+    point = Point(lng, lat)
+    candidates = catchments_gdf.iloc[catchments_gdf.sindex.query(point, predicate='intersects')]
+    if len(candidates) == 0:
+        raise Exception(f"Point {lat}, {lng} is not in any unit catchment")
+    return candidates.index[0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--outlet', nargs=3, action='append', metavar=('NAME', 'LAT', 'LNG'),
+                        help="An outlet to time. Can be repeated.")
+    parser.add_argument('--largest', type=int, action='append', metavar='BASIN',
+                        help="Also time the outlet with the largest upstream area in this basin. Can be repeated.")
+    parser.add_argument('--area', type=float, default=PREDISSOLVE_AREA, help="PREDISSOLVE_AREA to use if building.")
+    args = parser.parse_args()
+
+    outlets = args.outlet if args.outlet else [("Grand River", 42.8595, -79.5783)]
+    targets = []  # (name, basin, lat or None, lng or None)
+    for name, lat, lng in outlets:
+        basin = find_basin(float(lat), float(lng))
+        targets.append((name, basin, float(lat), float(lng)))
+    for basin in (args.largest if args.largest else [targets[0][1]]):
+        targets.append((f"Largest outlet in basin {basin}", basin, None, None))
+
+    for name, basin, lat, lng in targets:
+        catchments_gdf = load_gdf("catchments", basin, True)
+        rivers_gdf = load_gdf("rivers", basin, True, columns=UP_FIELDS + ['uparea'], geometry=False)
+        topology = load_topology(basin, rivers_gdf)
+
+        predissolved_gdf = load_predissolved(basin, True, signature(catchments_gdf, topology))
+        if predissolved_gdf is None:
+            t0 = time.perf_counter()
+            predissolved_gdf = build_predissolved(catchments_gdf, rivers_gdf, topology, args.area)
+            print(f"Built {len(predissolved_gdf):,} pre-dissolved polygons for basin {basin} "
+                  f"in {time.perf_counter() - t0:.1f} s")
+            save_predissolved(predissolved_gdf, basin, True)
+        is_cached = cached_mask(topology, predissolved_gdf)
+
+        if lat is None:
+            comid = rivers_gdf['uparea'].idxmax()
+        else:
+            comid = find_comid(catchments_gdf, lat, lng)
+        B = upstream_comids(topology, comid)
+
+        t0 = time.perf_counter()
+        full = dissolve_geopandas(catchments_gdf.loc[B]).iloc[0]
+        t_full = time.perf_counter() - t0
+
+        t0 = time.perf_counter()
+        subbasins_gdf = assemble_subbasins(catchments_gdf, predissolved_gdf, is_cached, topology, comid, B,
+                                           include_root=False)
+        fast = dissolve_geopandas(subbasins_gdf).iloc[0]
+        t_fast = time.perf_counter() - t0
+
+        iou = full.intersection(fast).area / full.union(fast).area
+        print(f"\n{name}: COMID {comid}, basin {basin}, {len(B):,} unit catchments, {get_area(full):,.0f} km²")
+        print(f"  all unit catchments:     {t_full:8.2f} s")
+        print(f"  pre-dissolved pieces:    {t_fast:8.2f} s  ({len(subbasins_gdf):,} polygons to dissolve)")
+        print(f"  speedup:                 {t_full / t_fast:8.1f} x")
+        print(f"  intersection over union: {iou:8.5f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,161 @@
+"""
+Benchmark: time each step of the raster-based delineation in split_catchment() (py/merit_detailed.py) separately.
+
+Run it from the Mghydro folder, so that config.py and the relative paths in it are found:
+
+    python benchmarks/bench_raster_steps.py 72
+    python benchmarks/bench_raster_steps.py 72 --sample 50 --loops
+
+Picks a random sample of the high-res unit catchments in a basin, and uses a point inside each one as the outlet.
+Then goes through the same steps as split_catchment(), one at a time, and reports the total and mean time
+for each step. The rasters are read from MERIT_FDIR_DIR and MERIT_ACCUM_DIR in config.py.
+
+For comparison, it also times reading the windows with pysheds' read_raster() (the old way, which opens
+the file each time), making the polygon with pysheds' polygonize() and unary_union (instead of tracing
+its boundary), and with --loops, masking the rasters with the old pixel-by-pixel Python loops.
+Before timing anything, it checks that tracing a mask with holes that touch at a corner gives a valid polygon.
+If the pre-rasterized unit catchments have been built for the basin (python prepare_data.py labels),
+it also times reading the mask from them (see py/catchment_labels.py).
+The old ways and the alternatives are not counted in the shares of the total time.
+"""
+import argparse
+import os
+import sys
+import time
+from collections import defaultdict
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+from affine import Affine
+from shapely import ops
+from shapely.geometry import Polygon
+from pysheds.grid import Grid
+from delineate import load_gdf
+from py.merit_detailed import get_bounding_box, rasterize_catchment, DIRMAP
+from py.raster_boundary import catchment_polygon
+from py.settings import Settings
+import py.raster_cache as raster_cache
+import py.catchment_labels as catchment_labels
+
+
+# A catchment with holes that touch each other at a corner (the pixels in the middle)
+CORNER_HOLES = np.array([[0, 1, 1, 1, 1, 0],
+                         [1, 1, 1, 0, 1, 0],
+                         [1, 1, 0, 1, 0, 1],
+                         [1, 1, 1, 0, 1, 1],
+                         [1, 1, 1, 0, 1, 1],
+                         [0, 1, 1, 1, 1, 1]], dtype=bool)
+
+
+def check_holes():
+    """Checks that the polygon of CORNER_HOLES, with all of its holes kept, is valid and has the right area."""
+    polygon = catchment_polygon(CORNER_HOLES, Affine(1, 0, 0, 0, -1, 0), hole_threshold=0)
+    if not polygon.is_valid or polygon.area != 26:
+        raise Exception(f"Tracing the holes gave a bad polygon: {polygon.wkt}")
+
+
+def mask_with_loops(data, mymask, shape):
+    """The original pixel-by-pixel masking in split_catchment(), for comparison."""
+    m, n = shape
+    for i in range(0, m):
+        for j in range(0, n):
+            if int(mymask[i, j]) == 0:
+                data[i, j] = 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('basin', type=int, help="Level 2 basin, e.g. 72")
+    parser.add_argument('--sample', type=int, default=100, help="Number of unit catchments. Default: 100")
+    parser.add_argument('--loops', action='store_true', help="Also time the old masking loops (slow!)")
+    args = parser.parse_args()
+
+    check_holes()
+    settings = Settings.from_config()
+    fdir_fname = f"{settings.merit_fdir_dir}/flowdir{args.basin}.tif"
+    accum_fname = f"{settings.merit_accum_dir}/accum{args.basin}.tif"
+
+    catchments_gdf = load_gdf("catchments", args.basin, True)
+    sample = catchments_gdf.sample(min(args.sample, len(catchments_gdf)), random_state=0)
+    print(f"Timing the raster steps for {len(sample)} unit catchments in basin {args.basin}\n")
+
+    times = defaultdict(float)
+    n_pixels = 0
+
+    def timed(step, f, *fargs, **kwargs):
+        t0 = time.perf_counter()
+        result = f(*fargs, **kwargs)
+        times[step] += time.perf_counter() - t0
+        return result
+
+    # The first unit catchment goes through twice. The first time is not timed; it's a warm-up,
+    # since pysheds compiles its numba functions the first time that they are called.
+    geoms = list(sample.geometry.items())
+    for k, (comid, catchment_poly) in enumerate(geoms[:1] + geoms):
+        if k == 1:
+            times.clear()
+            n_pixels = 0
+
+        point = catchment_poly.representative_point()
+        lng, lat = point.x, point.y
+
+        bounding_box = timed("bounding box", get_bounding_box, catchment_poly)
+
+        # The old way of reading the windows, with the file opened each time
+        timed("read windows with pysheds (old)", lambda: (
+            Grid.from_raster(fdir_fname, window=bounding_box, nodata=0).read_raster(fdir_fname, window=bounding_box,
+                                                                                   nodata=0),
+            Grid().read_raster(accum_fname, window=bounding_box, nodata=0)))
+
+        fdir = timed("read windows", raster_cache.read_window, fdir_fname, bounding_box, nodata=0)
+        acc = timed("read windows", raster_cache.read_window, accum_fname, bounding_box, nodata=0)
+        grid = Grid.from_raster(fdir)
+        n_pixels += fdir.size
+
+        mymask = timed("rasterize mask", rasterize_catchment, grid, catchment_poly)
+        timed("mask from labels (alternative)", catchment_labels.read_mask, args.basin, comid, catchment_poly, bounding_box, fdir)
+
+        if args.loops:
+            timed("mask with loops (old)", mask_with_loops, fdir.copy(), mymask, grid.shape)
+            timed("mask with loops (old)", mask_with_loops, acc.copy(), mymask, grid.shape)
+
+        def apply_mask():
+            outside = np.asarray(mymask) == 0
+            fdir[outside] = 0
+            acc[outside] = 0
+        timed("mask", apply_mask)
+
+        timed("clip grid to mask", grid.clip_to, mymask)
+
+        streams = acc > settings.threshold_multiple
+        try:
+            lng_snap, lat_snap = timed("snap pour point", grid.snap_to_mask, streams, (lng, lat))
+            catch = timed("catchment", grid.catchment, fdir=fdir, x=lng_snap, y=lat_snap, dirmap=DIRMAP,
+                          xytype='coordinate', recursionlimit=15000)
+        except Exception as e:
+            print(f"  skipping a unit catchment: {e}")
+            continue
+
+        grid.clip_to(catch)
+        clipped_catch = timed("clip to catchment", grid.view, catch, dtype=np.uint8)
+
+        def to_polygon():
+            shapes = grid.polygonize(clipped_catch)
+            polygons = [Polygon(shape['coordinates'][0]) for shape, value in shapes]
+            return ops.unary_union(polygons)
+        timed("polygonize and dissolve (old)", to_polygon)
+        timed("trace boundary", catchment_polygon, np.asarray(clipped_catch) != 0, clipped_catch.affine)
+
+    total = sum(t for step, t in times.items() if "(" not in step)
+    print(f"{n_pixels / len(sample):,.0f} pixels per window on average\n")
+    print(f"{'step':32s} {'total (s)':>10s} {'mean (ms)':>10s} {'share':>7s}")
+    for step, t in times.items():
+        share = f"{t / total:7.1%}" if "(" not in step else ""
+        print(f"{step:32s} {t:10.3f} {t / len(sample) * 1000:10.2f} {share}")
+    print()
+    raster_cache.report()
+
+
+if __name__ == "__main__":
+    main()
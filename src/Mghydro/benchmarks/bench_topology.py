@@ -0,0 +1,108 @@
+"""
+Benchmark: finding the upstream unit catchments with the array-backed topology index
+(py/topology.py) vs. the original recursive addnode() function.
+Times both the frontier traversal and the nested set (pre-order slice) lookup.
+
+Run it from the Mghydro folder, so that config.py and the relative paths in it are found:
+
+    python benchmarks/bench_topology.py            # picks the largest Level 2 basin
+    python benchmarks/bench_topology.py -b 71 -n 200
+
+By default, uses the basin whose rivers shapefile is the largest on disk.
+Times the watershed of the reach with the largest upstream area in the basin,
+plus a random sample of outlets, and checks that both methods give the same set of COMIDs.
+"""
+import argparse
+import glob
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+from config import RIVERS_DIR
+from delineate import load_gdf
+from py.topology import UP_FIELDS, build_topology, comid_to_row, upstream_comids, upstream_rows
+
+
+def addnode(B, node, rivers_gdf):
+    """
+    The original recursive routine from delineate(), kept here for comparison.
+    """
+    B.append(node)
+    for field in ['up1', 'up2', 'up3', 'up4']:
+        up = rivers_gdf[field].loc[node]
+        if up != 0:
+            addnode(B, up, rivers_gdf)
+
+
+def largest_basin() -> int:
+    """Finds the basin with the biggest rivers shapefile."""
+    files = glob.glob(f"{RIVERS_DIR}/riv_pfaf_*_MERIT_Hydro_v07_Basins_v01*.shp")
+    if len(files) == 0:
+        raise Exception(f"Could not find any rivers shapefiles in {RIVERS_DIR}")
+    biggest = max(files, key=os.path.getsize)
+    return int(re.search(r"riv_pfaf_(\d+)_", os.path.basename(biggest)).group(1))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-b', '--basin', type=int, default=None, help="Level 2 basin. Default: the largest one.")
+    parser.add_argument('-n', '--num_outlets', type=int, default=100, help="Number of random outlets to time.")
+    args = parser.parse_args()
+
+    basin = args.basin if args.basin is not None else largest_basin()
+    rivers_gdf = load_gdf("rivers", basin, True, columns=UP_FIELDS + ['uparea'], geometry=False)
+    print(f"Basin {basin}: {len(rivers_gdf):,} river reaches")
+
+    t0 = time.perf_counter()
+    topo = build_topology(rivers_gdf)
+    print(f"Built topology index in {time.perf_counter() - t0:.3f} s")
+
+    rng = np.random.default_rng(0)
+    outlets = [rivers_gdf['uparea'].idxmax()]
+    outlets += rng.choice(rivers_gdf.index.to_numpy(), size=min(args.num_outlets, len(rivers_gdf)), replace=False).tolist()
+
+    # The recursive version needs a lot of stack on long rivers
+    sys.setrecursionlimit(max(sys.getrecursionlimit(), 100000))
+
+    for label, sample in [("largest watershed", outlets[:1]), (f"{len(outlets) - 1} random outlets", outlets[1:])]:
+        t_recursive = 0.0
+        t_frontier = 0.0
+        t_array = 0.0
+        n_catchments = 0
+        for comid in sample:
+            t0 = time.perf_counter()
+            try:
+                B = []
+                addnode(B, comid, rivers_gdf)
+            except RecursionError:
+                B = None
+            t_recursive += time.perf_counter() - t0
+
+            t0 = time.perf_counter()
+            B_frontier = topo['comid'][upstream_rows(topo, comid_to_row(topo, comid)[0])]
+            t_frontier += time.perf_counter() - t0
+
+            t0 = time.perf_counter()
+            B_array = upstream_comids(topo, comid)
+            t_array += time.perf_counter() - t0
+            n_catchments += len(B_array)
+
+            if B is None:
+                print(f"  COMID {comid}: recursive version hit the recursion limit")
+            elif set(B) != set(B_array.tolist()) or set(B) != set(B_frontier.tolist()):
+                raise Exception(f"Results differ for COMID {comid}")
+
+        print(f"\n{label} ({n_catchments:,} unit catchments in total)")
+        print(f"  recursive addnode(): {t_recursive:10.4f} s")
+        print(f"  frontier traversal:  {t_frontier:10.4f} s")
+        print(f"  nested set slice:    {t_array:10.4f} s")
+        if t_array > 0:
+            print(f"  speedup:             {t_recursive / t_array:10.1f} x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+"""
+Benchmark: the built-in upstream tracer (py/d8_trace.py) vs. pysheds' grid.catchment().
+
+Run it from the Mghydro folder, so that config.py and the relative paths in it are found:
+
+    python benchmarks/bench_tracer.py 72
+    python benchmarks/bench_tracer.py 72 --sample 200 --synthetic 200000
+
+Picks a random sample of the high-res unit catchments in a basin, and for each one, prepares the flow
+direction window and snaps a point inside it to the river, like split_catchment() does. Then delineates
+the catchment with pysheds, and with the built-in tracer (with numba if it is installed, and with NumPy),
+checks that they all give the same pixels, and reports the times.
+
+With --synthetic N, also tests a made-up flow direction grid where the water zig-zags back and forth
+through about N pixels before reaching the outlet, like in a long, narrow unit catchment.
+"""
+import argparse
+import os
+import sys
+import time
+from collections import defaultdict
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+from affine import Affine
+from pysheds.grid import Grid
+from pysheds.sview import Raster, ViewFinder
+from delineate import load_gdf
+from py.merit_detailed import get_bounding_box, rasterize_catchment, DIRMAP
+from py.settings import Settings
+import py.raster_cache as raster_cache
+import py.d8_trace as d8_trace
+
+
+def get_methods() -> dict:
+    methods = {'pysheds grid.catchment()': lambda grid, fdir, x, y: grid.catchment(
+        fdir=fdir, x=x, y=y, dirmap=DIRMAP, xytype='coordinate', recursionlimit=15000)}
+    if d8_trace.HAS_NUMBA:
+        methods['built-in, numba'] = lambda grid, fdir, x, y: d8_trace.catchment(grid, fdir, x, y, DIRMAP, True)
+    methods['built-in, NumPy'] = lambda grid, fdir, x, y: d8_trace.catchment(grid, fdir, x, y, DIRMAP, False)
+    return methods
+
+
+def make_serpentine(n_pixels: int) -> (Grid, Raster, float, float):
+    """
+    Makes a flow direction grid where the water goes back and forth along rows 200 pixels long,
+    and then drains to the outlet in the bottom-left corner. Returns the grid, the flow directions, and the outlet.
+    """
+    N, NE, E, SE, S, SW, W, NW = DIRMAP
+    width = 200
+    height = max(3, n_pixels // width)
+    fdir = np.zeros((height + 2, width + 2), dtype=np.uint8)
+    for i in range(1, height + 1):
+        fdir[i, 1:width + 1] = E if i % 2 == 1 else W
+        # at the end of each row, go down to the next one
+        fdir[i, width if i % 2 == 1 else 1] = S
+    fdir[height, width if height % 2 == 1 else 1] = 0
+
+    outlet_row, outlet_col = height, width if height % 2 == 1 else 1
+    affine = Affine(1 / 1200, 0, 0, 0, -1 / 1200, 1)
+    viewfinder = ViewFinder(affine=affine, shape=fdir.shape, nodata=0)
+    fdir = Raster(fdir, viewfinder)
+    x, y = affine * (outlet_col, outlet_row)
+    return Grid.from_raster(fdir), fdir, x, y
+
+
+def time_methods(grid, fdir, x, y, methods, times, errors) -> bool:
+    """Runs each method on one catchment; returns True if they all gave the same pixels."""
+    results = []
+    for name, f in methods.items():
+        t0 = time.perf_counter()
+        try:
+            results.append(np.asarray(f(grid, fdir, x, y)))
+        except Exception:
+            errors[name] += 1
+            results.append(None)
+        times[name] += time.perf_counter() - t0
+    done = [r for r in results if r is not None]
+    return all(np.array_equal(done[0], r) for r in done[1:])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('basin', type=int, help="Level 2 basin, e.g. 72")
+    parser.add_argument('--sample', type=int, default=100, help="Number of unit catchments. Default: 100")
+    parser.add_argument('--synthetic', type=int, default=0, help="Length of the synthetic flow path, in pixels")
+    args = parser.parse_args()
+
+    settings = Settings.from_config()
+    fdir_fname = f"{settings.merit_fdir_dir}/flowdir{args.basin}.tif"
+    accum_fname = f"{settings.merit_accum_dir}/accum{args.basin}.tif"
+    methods = get_methods()
+
+    catchments_gdf = load_gdf("catchments", args.basin, True)
+    sample = catchments_gdf.sample(min(args.sample, len(catchments_gdf)), random_state=0)
+
+    times = defaultdict(float)
+    errors = defaultdict(int)
+    n_tested = 0
+    n_different = 0
+    n_pixels = 0
+
+    # The first unit catchment goes through twice, and is only timed the second time,
+    # so that the times do not include numba compiling the functions.
+    geoms = list(sample.geometry)
+    for k, catchment_poly in enumerate(geoms[:1] + geoms):
+        if k == 1:
+            times.clear()
+            errors.clear()
+
+        # The same steps as in split_catchment()
+        bounding_box = get_bounding_box(catchment_poly)
+        fdir = raster_cache.read_window(fdir_fname, bounding_box, nodata=0)
+        acc = raster_cache.read_window(accum_fname, bounding_box, nodata=0)
+        grid = Grid.from_raster(fdir)
+        mymask = rasterize_catchment(grid, catchment_poly)
+        outside = np.asarray(mymask) == 0
+        fdir[outside] = 0
+        acc[outside] = 0
+        grid.clip_to(mymask)
+
+        point = catchment_poly.representative_point()
+        try:
+            x, y = grid.snap_to_mask(acc > settings.threshold_single, (point.x, point.y))
+        except Exception:
+            continue
+
+        same = time_methods(grid, fdir, x, y, methods, times, errors)
+        if k > 0:
+            n_tested += 1
+            n_pixels += grid.size
+            n_different += not same
+
+    print(f"\n{n_tested} unit catchments in basin {args.basin}, {n_pixels / max(n_tested, 1):,.0f} pixels per "
+          f"window on average. Different results: {n_different}")
+    print(f"  {'':28s} {'time (s)':>10s} {'mean (ms)':>10s} {'errors':>7s}")
+    for name in methods:
+        print(f"  {name:28s} {times[name]:10.3f} {times[name] / max(n_tested, 1) * 1000:10.2f} {errors[name]:7d}")
+
+    if args.synthetic > 0:
+        grid, fdir, x, y = make_serpentine(args.synthetic)
+        times.clear()
+        errors.clear()
+        same = time_methods(grid, fdir, x, y, methods, times, errors)
+        print(f"\nSynthetic flow path of {args.synthetic:,} pixels. Same results: {same}")
+        for name in methods:
+            status = "FAILED" if errors[name] > 0 else ""
+            print(f"  {name:28s} {times[name]:10.3f} {status}")
+
+
+if __name__ == "__main__":
+    main()
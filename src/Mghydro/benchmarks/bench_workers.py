@@ -0,0 +1,71 @@
+"""
+Benchmark: scaling of delineate_batch() with the number of worker processes (WORKERS / --workers).
+
+Run it from the Mghydro folder, so that config.py and the relative paths in it are found:
+
+    python benchmarks/bench_workers.py outlets.csv
+    python benchmarks/bench_workers.py outlets.csv --workers 1 2 4 8 16 --lowres
+
+The outlets CSV has the same format as OUTLETS_CSV. We first load the data for every basin with
+the outlets in it (not timed), then delineate all of the outlets with each number of workers,
+without writing any output files. Reports the time, the speedup over one worker, the parallel
+efficiency, and checks that every run gives the same watersheds, in the same order.
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import geopandas as gpd
+from delineate import delineate_batch, read_outlets, load_megabasins, load_basin, PROJ_WGS84
+from py.settings import Settings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('outlets_csv', help="CSV file with the columns id, lat, lng")
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8, 16],
+                        help="Numbers of workers to try. Default: 1 2 4 8 16")
+    parser.add_argument('--lowres', action='store_true', help="Use low-resolution mode")
+    args = parser.parse_args()
+
+    points_df = read_outlets(args.outlets_csv)
+    settings = Settings.from_config(high_res=not args.lowres, output_dir='', make_map=False, plots=False,
+                                    verbose=False)
+
+    # Load the basin data into the in-process cache, so that we only time the delineation
+    points_gdf = gpd.GeoDataFrame(points_df, crs=PROJ_WGS84,
+                                  geometry=gpd.points_from_xy(points_df['lng'], points_df['lat']))
+    basins = gpd.sjoin(points_gdf, load_megabasins(), how="inner", predicate='intersects')['BASIN'].unique()
+    t0 = time.perf_counter()
+    for basin in basins:
+        load_basin(int(basin), settings.high_res)
+    print(f"Loaded data for {len(basins)} basin(s) in {time.perf_counter() - t0:.1f} s; "
+          f"{os.cpu_count()} CPUs available\n")
+
+    print(f"{'workers':>8s} {'time (s)':>10s} {'outlets/s':>10s} {'speedup':>8s} {'efficiency':>10s}")
+    baseline = None
+    first = None
+    for workers in args.workers:
+        t0 = time.perf_counter()
+        watersheds_gdf, status_df = delineate_batch(points_df, settings.replace(workers=workers))
+        elapsed = time.perf_counter() - t0
+
+        if first is None:
+            first = watersheds_gdf
+            baseline = elapsed
+        elif not (watersheds_gdf['id'].tolist() == first['id'].tolist()
+                  and watersheds_gdf.geometry.geom_equals(first.geometry).all()):
+            raise Exception(f"The results with {workers} workers are different from the first run")
+
+        speedup = baseline / elapsed * args.workers[0]
+        print(f"{workers:8d} {elapsed:10.2f} {len(points_df) / elapsed:10.2f} {speedup:8.2f} "
+              f"{speedup / workers:10.0%}")
+
+    print(f"\n{len(first)} of {len(points_df)} watersheds delineated")
+
+
+if __name__ == "__main__":
+    main()
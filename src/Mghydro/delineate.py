@@ -21,31 +21,31 @@ to download MERIT-Hydro raster data from U. of Tokyo.
 For comments or questions, please contact the author: Matthew Heberger, matt@mghydro.com
 or create an Issue on the GitHub repo: https://github.com/mheberger/delineator
 """
+import argparse
 import warnings
 
 import math
+import multiprocessing
 import numpy as np
 import pickle
 import pandas as pd
 import os
 os.environ['USE_PYGEOS'] = '1'
 import geopandas as gpd
-import re
 from shapely.geometry import Point, Polygon, box
-import shapely.ops
-from shapely.wkt import loads
 import sigfig  # for formatting numbers to significant digits
-from py.fast_dissolve import dissolve_geopandas, fill_geopandas
+from py.fast_dissolve import dissolve_parallel, fill_geopandas
 import pyproj
-from functools import partial
 from config import *
 from py.mapper import make_map, create_folder_if_not_exists
-
-if PLOTS:
-    import matplotlib.pyplot as plt
-
-if HIGH_RES:
-    import py.merit_detailed
+from py.area import get_area
+from py.precision import round_coordinates
+from py.topology import load_topology, upstream_comids, comid_to_row, upstream_first
+from py.predissolve import load_predissolved, cached_mask, assemble_subbasins
+from py.signature import signature
+import py.columnar_cache as columnar_cache
+import py.basin_cache as basin_cache
+from py.settings import Settings
 
 warnings.simplefilter(action='ignore', category=FutureWarning)
 
@@ -54,6 +54,13 @@ gpd.options.use_pygeos = True
 # The WGS84 projection string, used in a few places
 PROJ_WGS84 = 'EPSG:4326'
 
+# The fields we use from the MERIT-Basins rivers table. (With the columnar cache, we skip reading the others.)
+RIVERS_COLUMNS = ['lengthkm', 'uparea', 'order', 'up1', 'up2', 'up3', 'up4']
+
+# Number of decimals that we keep in the lat, lng coordinates in GeoJSON and KML files, to make them smaller
+# (see py/precision.py)
+COORDINATE_DECIMALS = 5
+
 
 def validate(gages_df: pd.DataFrame) -> bool:
     """
@@ -75,7 +82,7 @@ def validate(gages_df: pd.DataFrame) -> bool:
     # Check that lat, lng are numeric
     fields = ['lat', 'lng']
     for field in fields:
-        if gages_df[field].dtype != 'float64':
+        if not pd.api.types.is_numeric_dtype(gages_df[field]):
             raise Exception(f"In outlets CSV, the column {field} is not numeric.")
 
     # Check that all the lats are in the right range
@@ -103,48 +110,121 @@ def validate(gages_df: pd.DataFrame) -> bool:
     return True
 
 
-def validate_search_distance():
+def validate_search_distance(search_dist: float):
     """
     For the pour point relocation routine. SEARCH_DIST governs how far away we'll look for
     a unit catchment with an upstream area close to the a priori estimate.
     This function just checks whether this is valid.
     Does not return anything, just throws an error if it is out of range.
     """
-    if not isinstance(SEARCH_DIST, int) and not isinstance(SEARCH_DIST, float):
-       raise Exception(f"SEARCH_DIST must be a number. We got {SEARCH_DIST}")
+    if not isinstance(search_dist, int) and not isinstance(search_dist, float):
+       raise Exception(f"SEARCH_DIST must be a number. We got {search_dist}")
 
-    if SEARCH_DIST < 0.0:
+    if search_dist < 0.0:
         raise Exception("SEARCH distance in config.py must be a positive number.")
 
-    if SEARCH_DIST > 0.25:
+    if search_dist > 0.25:
         raise Exception("SEARCH_DIST is unrealistically high. It should be in decimal degrees, and must be less "
-                        "than 0.25. In config.py, you entered {SEARCH_DIST}")
+                        "than 0.25. In config.py, you entered {search_dist}")
 
 
-def get_area(poly: Polygon) -> float:
+def find_close_catchment(rivers_gdf: gpd.GeoDataFrame, lat: float, lng: float, area_reported: float,
+                         settings: Settings) -> (int or None, float or None):
+    """
+    Part of my simple pour point relocation method. If the outlet falls in a unit catchment
+    whose area is a mismatch of our a priori estimate of the upstream area,
+    look around the neighborhood for a unit catchment whose area matches more closely
     """
-    Projects a Shapely polygon in raw lat, lng coordinates, and calculates its area
-    Argss:
-        poly: Shapely polygon
-    :return: area in km²
+    # Find the river segment that is within a bounding box around the point
+    dist = 0.01
+    max_dist = settings.max_dist  # How far away can we look before we give up?
+
+    # Keep track of how many river segments were found with each increase in distance.
+    num_segments_found = [0]
+
+    iteration = 1
+    while True:
+        find_box = box(lng - dist, lat - dist, lng + dist, lat + dist)
+        possible_matches_index = list(rivers_gdf.sindex.intersection(find_box.bounds))
+        possible_matches = rivers_gdf.iloc[possible_matches_index]
+        precise_matches = possible_matches[possible_matches.intersects(find_box)]
+        segments_found = precise_matches
+        num_segments_found.append(len(segments_found.index))
+
+        # If any new segments were found on this iteration...
+        if num_segments_found[iteration] > num_segments_found[iteration - 1]:
+            # Calculate the percent difference in the area for the found river segments and the gage
+            segments_found['pd'] = ((segments_found['uparea'] - area_reported) / area_reported).abs()
+
+            # Get some info on the "best matching" river segment
+            min_pd = segments_found['pd'].min()
+
+            # Check whether they are "good enough"
+            if min_pd < settings.area_matching_threshold:
+                COMID = segments_found['pd'].idxmin()
+                uparea = round(segments_found['uparea'][COMID], 0)
+                if settings.verbose:
+                    print("  (X) Found a river reach at a distance of {}, "
+                          "area difference: {:,.0f}%".format(dist, min_pd * 100))
+                return COMID, uparea
+
+        if dist > max_dist:
+            # If we've gone out a certain radius around the gage, and still haven't found a river
+            # segment with a closely matching upstream area, raise some kind of error message.
+            print('  (!) Could not find a river segment with closely matching upstr.'
+                  ' area within %s degrees of gage' % round(dist, 2))
+
+            return None, None
+        else:
+            # Otherwise, expand the search radius and keep looking
+            dist += 0.01
+            iteration += 1
+
+
+def plot_basins(subbasins_gdf: gpd.GeoDataFrame, wid: str, lat: float, lng: float, lat_snap: float or None,
+                lng_snap: float or None, suffix: str):
+    """
+    Makes a plot of the unit catchments that are in the watershed
+
+    It is all the upstream unit catchments, and the *split* terminal unit catchment.
+
     """
-    projected_poly = shapely.ops.transform(
-        partial(
-            pyproj.transform,
-            pyproj.Proj(init='EPSG:4326'),
-            pyproj.Proj(
-                proj='aea',
-                lat_1=poly.bounds[1],
-                lat_2=poly.bounds[3]
-            )
-        ),
-        poly)
+    import matplotlib.pyplot as plt
+
+    # subbasins_gdf.plot(column='area', edgecolor='gray', legend=True)
+    [fig, ax] = plt.subplots(1, 1, figsize=(10, 8))
+
+    # Plot each unit catchment with a different color
+    for x in subbasins_gdf.index:
+        color = np.random.rand(3, )
+        subbasins_gdf.loc[[x]].plot(facecolor=color, edgecolor=color, alpha=0.5, ax=ax)
+
+    # Plot the gage point
+    plt.scatter(x=lng, y=lat, c='red', edgecolors='black')
+
+    if suffix == "post" and lat_snap is not None:
+        plt.scatter(x=lng_snap, y=lat_snap, c='cyan', edgecolors='black')
+        plt.title(f"Showing the {len(subbasins_gdf)-1} upstream unit catchments and split terminal unit catchment")
+    else:
+        plt.title(f"Found {len(subbasins_gdf)} unit catchments for watershed id = {wid}")
+
+    plt.savefig(f"plots/{wid}_vector_unit_catchments_{suffix}.png")
+    plt.close(fig)
+
+
+def read_outlets(outlets_csv: str) -> pd.DataFrame:
+    """
+    Reads the outlet points CSV file and puts it into a Pandas DataFrame.
+    Needs at least the columns id, lat, lng. Optional columns are name and area (in km²).
+    """
+    # Check that the CSV file is there
+    if not os.path.isfile(outlets_csv):
+        raise Exception(f"Could not load your outlets file at: {outlets_csv}")
 
-    # Get the area in m^2
-    return projected_poly.area / 1e6
+    return pd.read_csv(outlets_csv, header=0, dtype={'id': 'str', 'lat': 'float', 'lng': 'float'})
 
 
-def delineate():
+def delineate(workers: int = None):
     """
     THIS is the Main watershed delineation routine
     Make sure to set the variables in `config.py` before running.
@@ -157,123 +237,706 @@ def delineate():
     (shows the watershed id, names, and areas).
 
     Optionally creates an HTML page with a handy map viewer to review the results.
+
+    To delineate watersheds from another Python program, without reading or writing any files,
+    see delineate_batch().
+
+    Args:
+        workers: number of worker processes. If None, uses WORKERS in config.py
     """
+    if workers is None:
+        settings = Settings.from_config()
+    else:
+        settings = Settings.from_config(workers=workers)
 
-    # Regular expression used to find numbers so I can round lat, lng coordinates in GeoJSON files to make them smaller
-    simpledec = re.compile(r"\d*\.\d+")
-
-    def mround(match):
-        # For rounding the coordinates in GeoJSON files to make them smaller
-        return "{:.5f}".format(float(match.group()))
-
-    def addnode(B, node):
-        """"
-        Recursive function to assemble the list of upstream unit catchments
-        B is a list of the unit catchments that make up our watershed.
-        List items are `comid`s, unique identifiers of each unit catchment.
-        """
-        # first, append the node to the basin
-        B.append(node)
-
-        # next, check whether the fields up1, up2, up3, and up4 contain a node ID
-        up1 = rivers_gdf['up1'].loc[node]
-        if up1 != 0:
-            addnode(B, up1)
-
-        up2 = rivers_gdf['up2'].loc[node]
-        if up2 != 0:
-            addnode(B, up2)
-
-        up3 = rivers_gdf['up3'].loc[node]
-        if up3 != 0:
-            addnode(B, up3)
-
-        up4 = rivers_gdf['up4'].loc[node]
-        if up4 != 0:
-            addnode(B, up4)
-
-    def find_close_catchment():
-        """
-        Part of my simple pour point relocation method. If the outlet falls in a unit catchment
-        whose area is a mismatch of our a priori estimate of the upstream area,
-        look around the neighborhood for a unit catchment whose area matches more closely
-        """
-        # Find the river segment that is within a bounding box around the point
-        dist = 0.01
-        max_dist = MAX_DIST  # How far away can we look before we give up?
-
-        # Keep track of how many river segments were found with each increase in distance.
-        num_segments_found = [0]
-
-        iteration = 1
-        while True:
-            find_box = box(lng - dist, lat - dist, lng + dist, lat + dist)
-            possible_matches_index = list(rivers_gdf.sindex.intersection(find_box.bounds))
-            possible_matches = rivers_gdf.iloc[possible_matches_index]
-            precise_matches = possible_matches[possible_matches.intersects(find_box)]
-            segments_found = precise_matches
-            num_segments_found.append(len(segments_found.index))
-
-            # If any new segments were found on this iteration...
-            if num_segments_found[iteration] > num_segments_found[iteration - 1]:
-                # Calculate the percent difference in the area for the found river segments and the gage
-                segments_found['pd'] = ((segments_found['uparea'] - area_reported) / area_reported).abs()
-
-                # Get some info on the "best matching" river segment
-                min_pd = segments_found['pd'].min()
-
-                # Check whether they are "good enough"
-                if min_pd < AREA_MATCHING_THRESHOLD:
-                    COMID = segments_found['pd'].idxmin()
-                    uparea = round(segments_found['uparea'][COMID], 0)
-                    if VERBOSE:
-                        print("  (X) Found a river reach at a distance of {}, "
-                              "area difference: {:,.0f}%".format(dist, min_pd * 100))
-                    return COMID, uparea
-
-            if dist > max_dist:
-                # If we've gone out a certain radius around the gage, and still haven't found a river
-                # segment with a closely matching upstream area, raise some kind of error message.
-                print('  (!) Could not find a river segment with closely matching upstr.'
-                      ' area within %s degrees of gage' % round(dist, 2))
-
-                return None, None
-            else:
-                # Otherwise, expand the search radius and keep looking
-                dist += 0.01
-                iteration += 1
+    # Read the outlet points CSV file and put into a Pandas DataFrame
+    # (I call the outlet points gages, because I usually in delineated watersheds at streamflow gages)
+    if VERBOSE: print(f"Reading your outlets data in: {OUTLETS_CSV}")
+    gages_df = read_outlets(OUTLETS_CSV)
+
+    delineate_batch(gages_df, settings)
+
+
+def load_basin(basin: int, high_resolution: bool) -> dict:
+    """
+    Loads the data we need to delineate watersheds in one Level 2 megabasin.
+    Returns a dict with:
+        basin: the basin code
+        rivers_gdf: the MERIT-Basins rivers (the river network is in here)
+        topology: compact array version of the river network (see py/topology.py)
+        catchments: dict of unit catchment GeoDataFrames; key is True for high-res, False for low-res.
+            Use get_catchments(), which loads the other resolution if needed.
+        predissolved: dict of (predissolved_gdf, is_cached) by resolution, loaded when first needed.
+        snap_memo: the split catchment polygons by terminal COMID and snapped outlet (see split_catchment)
+        stream_index: the stream pixel index (see py/stream_index.py), loaded when first needed
+        edge_index: the edge indexes for the "edges" dissolve method (see py/edge_index.py), by resolution,
+            loaded when first needed
+        snaps: the outlets snapped with the stream pixel index, by (terminal COMID, lat, lng) (see snap_outlets)
+        splits: the split catchment polygons made ahead of time for groups of outlets in the same unit catchment,
+            by (terminal COMID, lat, lng) (see split_in_batches)
+        watersheds: the watershed polygons and areas by (terminal COMID, resolution, lat_snap, lng_snap),
+            so that outlets that snap to the same place are only delineated once.
+        gauges: in nested mode, the dissolved watersheds of the outlets we have done so far, by resolution
+            and then by the row of their terminal unit catchment in the topology.
+    """
+    catchments = {high_resolution: load_gdf("catchments", basin, high_resolution)}
+
+    # The network data is in the RIVERS file rather than the CATCHMENTS file
+    # (this is just how the MeritBASIS authors did it)
+    if VERBOSE: print('Reading data table for rivers in basin %s' % basin)
+    rivers_gdf = load_gdf("rivers", basin, True, columns=RIVERS_COLUMNS)
 
-    def plot_basins(suffix: str):
-        """
-        Makes a plot of the unit catchments that are in the watershed
+    # Compact array version of the river network, with a nested set (pre-order) labeling,
+    # so that the upstream unit catchments of any reach are a single slice of an array
+    topology = basin_cache.get("topology", basin, None, lambda: load_topology(basin, rivers_gdf))
 
-        It is all the upstream unit catchments, and the *split* terminal unit catchment.
+    return {'basin': basin, 'rivers_gdf': rivers_gdf, 'topology': topology, 'catchments': catchments,
+            'predissolved': {}, 'snap_memo': {}, 'snaps': {}, 'splits': {}, 'watersheds': {}, 'gauges': {}}
 
-        """
-        # subbasins_gdf.plot(column='area', edgecolor='gray', legend=True)
-        [fig, ax] = plt.subplots(1, 1, figsize=(10, 8))
 
-        # Plot each unit catchment with a different color
-        for x in subbasins_gdf.index:
-            color = np.random.rand(3, )
-            subbasins_gdf.loc[[x]].plot(facecolor=color, edgecolor=color, alpha=0.5, ax=ax)
+def get_catchments(basin_data: dict, high_resolution: bool) -> gpd.GeoDataFrame:
+    """The unit catchments for a basin loaded with load_basin(), in high- or low-resolution."""
+    if high_resolution not in basin_data['catchments']:
+        basin_data['catchments'][high_resolution] = load_gdf("catchments", basin_data['basin'], high_resolution)
+    return basin_data['catchments'][high_resolution]
 
-        # Plot the gage point
-        gages_joined.iloc[[i]].plot(ax=ax, c='red', edgecolors='black')
 
-        if suffix == "post" and HIGH_RES:
-            plt.scatter(x=lng_snap, y=lat_snap, c='cyan', edgecolors='black')
-            plt.title(f"Showing the {len(subbasins_gdf)-1} upstream unit catchments and split terminal unit catchment")
+def get_predissolved(basin_data: dict, high_resolution: bool) -> (gpd.GeoDataFrame or None, np.ndarray or None):
+    """
+    The pre-dissolved polygons for a basin loaded with load_basin(), if they have been built
+    with prepare_data.py, and the boolean mask of the rows of the topology that have one.
+    """
+    predissolved = basin_data['predissolved']
+    if high_resolution not in predissolved:
+        basin = basin_data['basin']
+        source = signature(get_catchments(basin_data, high_resolution), basin_data['topology'])
+        predissolved_gdf = basin_cache.get("predissolved", basin, 'hires' if high_resolution else 'lores',
+                                           lambda: load_predissolved(basin, high_resolution, source))
+        predissolved[high_resolution] = (predissolved_gdf, cached_mask(basin_data['topology'], predissolved_gdf))
+    return predissolved[high_resolution]
+
+
+def get_stream_index(basin_data: dict) -> dict or None:
+    """The stream pixel index for a basin loaded with load_basin(), or None if it has not been built."""
+    if 'stream_index' not in basin_data:
+        import py.stream_index
+        basin = basin_data['basin']
+        source = signature(get_catchments(basin_data, True))
+        basin_data['stream_index'] = basin_cache.get("streams", basin, 'hires',
+                                                     lambda: py.stream_index.load_stream_index(basin, source))
+    return basin_data['stream_index']
+
+
+def check_labels(basin_data: dict):
+    """
+    Checks that the unit catchment labels for a basin loaded with load_basin() (see py/catchment_labels.py)
+    were made from the unit catchments that we have loaded. If not, split_catchment() doesn't use them.
+    """
+    import py.catchment_labels
+    py.catchment_labels.check_labels(basin_data['basin'], signature(get_catchments(basin_data, True)))
+
+
+def get_edge_index(basin_data: dict, high_resolution: bool) -> dict or None:
+    """The edge index for a basin loaded with load_basin(), or None if it has not been built."""
+    edge_index = basin_data.setdefault('edge_index', {})
+    if high_resolution not in edge_index:
+        import py.edge_index
+        basin = basin_data['basin']
+        source = signature(get_catchments(basin_data, high_resolution))
+        edge_index[high_resolution] = basin_cache.get(
+            "edges", basin, 'hires' if high_resolution else 'lores',
+            lambda: py.edge_index.load_edge_index(basin, high_resolution, source))
+    return edge_index[high_resolution]
+
+
+def delineate_outlet(basin_data: dict, wid: str, lat: float, lng: float, terminal_comid: int,
+                     area_reported: float or None, settings: Settings) -> (Polygon or None, dict):
+    """
+    Delineates the watershed for a single outlet point.
+
+    Args:
+        basin_data: the data for the Level 2 basin the outlet is in, from load_basin()
+        wid: the watershed id
+        lat, lng: coordinates of the outlet
+        terminal_comid: the unit catchment that contains the outlet
+        area_reported: a priori estimate of the upstream area in km², or None
+        settings: see py/settings.py
+
+    Returns:
+        basin_poly: the watershed polygon, or None if we could not delineate the watershed
+        info: dict with the result ("high res", "low res" or "failed"), and either the explanation
+            of the failure, or: area_calc_sqkm, lat_snap, lng_snap, snap_dist_m,
+            comids, the list of unit catchments in the watershed, and reused, which is True if we
+            reused the watershed of a previous outlet that snapped to the same place (see DEDUPLICATE)
+    """
+    rivers_gdf = basin_data['rivers_gdf']
+    topology = basin_data['topology']
+
+    # Reset the local boolean flag for high-res mode. If the watershed is too big, script will switch to low.
+    bool_high_res = settings.high_res
+
+    # Get the upstream area of the unit catchment we found, according to MERIT-Basins
+    up_area = rivers_gdf.loc[terminal_comid].uparea
+
+    # If MATCH_AREAS is True and the user provided the area in the outlets CSV file,
+    # the script will check whether the upstream area of the unit catchment is a good match.
+    # If the areas do not match well, look around the neighborhood for another unit catchment
+    # whose area is a closer match to what we think it is.
+    if area_reported is not None and settings.match_areas:
+        PD_area = abs((area_reported - up_area) / area_reported)
+        if PD_area > settings.area_matching_threshold:
+            if settings.verbose:
+                print("Outlet point is in a unit catchment whose area is not a close match.")
+                print("Searching neighborhood for a river reach with a more closely matching upstream area")
+            candidate_comid, up_area = find_close_catchment(rivers_gdf, lat, lng, area_reported, settings)
+            if candidate_comid is None:
+                return None, {'result': "failed",
+                              'explanation': "Could not find a nearby river reach whose upstream area is "
+                                             "within {}% of reported area of {:,.0f} km²"
+                                  .format(settings.area_matching_threshold * 100, area_reported)}
+            else:
+                terminal_comid = candidate_comid
+
+    # Let B be the array of unit catchments (and river reaches) that are in the basin.
+    # The first element is the terminal unit catchment. No need to walk the river network.
+    B = upstream_comids(topology, terminal_comid)
+    if settings.verbose: print(f"  found {len(B)} unit catchments in the watershed")
+
+    # If the watershed is too big, revert to low-precision mode.
+    if settings.high_res and up_area > settings.low_res_threshold:
+        if settings.verbose:
+            print(f"Watershed for id = {wid} is larger than LOW_RES_THRESHOLD = {settings.low_res_threshold}. "
+                  "SWITCHING TO LOW-RESOLUTION MODE.")
+        bool_high_res = False
+
+    # If we just flipped to low-res mode, this loads the low-res unit catchment polygons.
+    unit_catchments_gdf = get_catchments(basin_data, bool_high_res)
+
+    # In detailed mode,
+    if bool_high_res:
+        import py.merit_detailed
+
+        if settings.verbose: print("Performing detailed raster-based delineation for "
+                                   "the downstream portion of the watershed")
+        # Let split_catchment_poly be the polygon of the terminal unit catchment
+        assert terminal_comid == B[0]
+        catchment_poly = unit_catchments_gdf.loc[terminal_comid].geometry
+        bSingleCatchment = len(B) == 1
+        snap_memo = basin_data['snap_memo'].setdefault(terminal_comid, {}) if settings.deduplicate else None
+        split_key = (terminal_comid, lat, lng)
+        if split_key in basin_data['splits']:
+            # We already split the catchment for this outlet, together with the others in the unit catchment
+            split_catchment_poly, lat_snap, lng_snap = basin_data['splits'][split_key]
         else:
-            plt.title(f"Found {len(subbasins_gdf)} unit catchments for watershed id = {wid}")
+            snapped = basin_data['snaps'].get(split_key)
+            split_catchment_poly, lat_snap, lng_snap = py.merit_detailed.split_catchment(wid, basin_data['basin'],
+                                                                                         lat, lng, catchment_poly,
+                                                                                         bSingleCatchment, settings,
+                                                                                         snap_memo, snapped,
+                                                                                         terminal_comid)
+        if split_catchment_poly is None:
+            return None, {'result': "failed", 'explanation': "An error occured in pysheds detailed delineation."}
+    else:
+        snapped_outlet = rivers_gdf.loc[terminal_comid].geometry.coords[0]
+        lat_snap = snapped_outlet[1]
+        lng_snap = snapped_outlet[0]
+
+    # Outlets in the same unit catchment that snap to the same place have the same watershed.
+    # If we already made it for another outlet, reuse it.
+    watershed_key = (terminal_comid, bool_high_res, lat_snap, lng_snap)
+    reused = settings.deduplicate and watershed_key in basin_data['watersheds']
+    if reused:
+        if settings.verbose: print("  same terminal unit catchment and snapped outlet as a previous outlet; "
+                                   "reusing its watershed")
+        basin_poly, area = basin_data['watersheds'][watershed_key]
+    else:
+        if settings.predissolve:
+            predissolved_gdf, is_cached = get_predissolved(basin_data, bool_high_res)
+        else:
+            predissolved_gdf, is_cached = None, None
+
+        # Create a new geodataframe containing only the unit catchments_gdf that are in the list B,
+        # or, for large watersheds, a few pre-dissolved pieces plus the rest of the unit catchments.
+        # In high precision mode, we will update the geometry of the terminal unit catchment.
+        # In nested mode, we also use the watersheds of the outlets upstream, which we have already made.
+        gauge_polygons = basin_data['gauges'].get(bool_high_res) if settings.nested else None
+        subbasins_gdf = assemble_subbasins(unit_catchments_gdf, predissolved_gdf, is_cached, topology,
+                                           terminal_comid, B, include_root=not bool_high_res,
+                                           gauge_polygons=gauge_polygons)
+
+        # Make a plot of the selected unit catchments
+        if settings.plots:
+            plot_basins(subbasins_gdf, wid, lat, lng, None, None, "pre")
+
+        if bool_high_res:
+            # Create a temporary GeoDataFrame to create the geometry of the split catchment polygon
+            # This is just a shortcut method to transfer it to our watershed's subbasins GDF
+            split_gdf = gpd.GeoDataFrame(index=[0], crs='epsg:4326', geometry=[split_catchment_poly])
+            split_geom = split_gdf.loc[0, 'geometry']
+            subbasins_gdf.loc[terminal_comid, 'geometry'] = split_geom
+
+        if settings.plots:
+            snapped = (lat_snap, lng_snap) if bool_high_res else (None, None)
+            plot_basins(subbasins_gdf, wid, lat, lng, *snapped, "post")
+
+        if settings.verbose: print("Dissolving...")
+        # mybasin_gs is a GeoPandas GeoSeries
+        edge_index = get_edge_index(basin_data, bool_high_res) if settings.dissolve_method == "edges" else None
+        mybasin_gs = dissolve_parallel(subbasins_gdf, settings.dissolve_method, settings.dissolve_workers,
+                                       settings.dissolve_chunk_size, settings.dissolve_memory_mb, edge_index,
+                                       unit_catchments_gdf)
+
+        # Keep the dissolved polygon (before filling holes or simplifying) for the outlets downstream
+        if settings.nested:
+            terminal_row = comid_to_row(topology, terminal_comid)[0]
+            basin_data['gauges'].setdefault(bool_high_res, {}).setdefault(terminal_row, mybasin_gs.values[0])
+
+        if settings.fill:
+            # Fill donut holes in the watershed polygon
+            # Recall we asked the user for the fill threshold in terms of number of pixels
+            PIXEL_AREA = 0.000000695  # Constant for the area of a single pixel in MERIT-Hydro, in decimal degrees
+            area_max = settings.fill_threshold * PIXEL_AREA
+            mybasin_gs = fill_geopandas(mybasin_gs, area_max=area_max)
+
+        if settings.simplify:
+            # Simplify the geometry. GeoPandas uses the simple Douglas-Peuker algorithm
+            mybasin_gs = mybasin_gs.simplify(tolerance=settings.simplify_tolerance)
+
+        basin_poly = mybasin_gs.values[0]
+        area = get_area(basin_poly)
+        if settings.deduplicate:
+            basin_data['watersheds'][watershed_key] = (basin_poly, area)
+
+    # Get the (approx.) snap distance
+    geod = pyproj.Geod(ellps='WGS84')
+    snap_dist = geod.inv(lng, lat, lng_snap, lat_snap)[2]
+
+    info = {
+        'result': "high res" if bool_high_res else "low res",
+        'area_calc_sqkm': area,
+        'lat_snap': lat_snap,
+        'lng_snap': lng_snap,
+        'snap_dist_m': snap_dist,
+        'comids': B,
+        'reused': reused,
+    }
+    return basin_poly, info
+
+
+def write_watershed(mybasin_gdf: gpd.GeoDataFrame, wid: str, lat: float, lng: float, lat_snap: float,
+                    lng_snap: float, rivers_gdf: gpd.GeoDataFrame, B: np.ndarray, settings: Settings):
+    """
+    SAVE the Watershed to disk as a GeoJSON file or a shapefile, and the files for the HTML viewer map.
+    """
+    # This line rounds all the vertices to fewer digits. For text-like formats GeoJSON or KML, makes smaller
+    # files with minimal loss of precision. For other formats (shp, gpkg), doesn't make a difference in file size
+    if settings.output_ext.lower() in ['geojson', 'kml']:
+        mybasin_gdf = mybasin_gdf.copy()
+        mybasin_gdf.geometry = round_coordinates(mybasin_gdf.geometry.to_numpy(), COORDINATE_DECIMALS)
+
+    if settings.write_files and settings.output_ext != "":
+        outfile = f"{settings.output_dir}/{settings.output_prefix}{wid}.{settings.output_ext}"
+        with warnings.catch_warnings():
+            warnings.simplefilter(action='ignore', category=UserWarning)
+            mybasin_gdf.to_file(outfile)
+
+    # Create the HTML Viewer Map?
+    # We have to write a second, slightly different version of the GeoJSON files,
+    # because we need it in a .js file assigned to a variable, to avoid cross-origin restrictions
+    # of modern web browsers.
+    if settings.make_map:
+        watershed_js = f"{settings.map_folder}/{wid}.js"
+        with open(watershed_js, 'w') as f:
+            s = f"gage_coords = [{lat}, {lng}];\n"
+            f.write(s)
+            s = f"snapped_coords = [{lat_snap}, {lng_snap}];\n"
+            f.write(s)
+
+            f.write("basin = ")
+            f.write(mybasin_gdf.to_json())
+
+        if settings.map_rivers:
+            myrivers_gdf = rivers_gdf.loc[B]
+
+            # Keep only the fields lengthkm and order
+            myrivers_gdf = myrivers_gdf[['lengthkm', 'order', 'geometry']]
+
+            # Filter out the little headwater streams in large watersheds.
+            max_order = myrivers_gdf.order.max()
+            min_order = max_order - settings.num_stream_orders
+            # Drop rows where order < min_order
+            myrivers_gdf = myrivers_gdf[myrivers_gdf.order >= min_order]
+            myrivers_gdf = myrivers_gdf.round(1)
+            myrivers_gdf.geometry = round_coordinates(myrivers_gdf.geometry.to_numpy(), COORDINATE_DECIMALS)
+            rivers_js = f"{settings.map_folder}/{wid}_rivers.js"
+            with open(rivers_js, 'w') as f:
+                f.write("rivers = ")
+                f.write(myrivers_gdf.to_json())
+
+
+def process_outlet(basin_data: dict, job: tuple, n_gages: int, settings: Settings) -> (gpd.GeoDataFrame or None, dict):
+    """
+    Delineates the watershed for one outlet (see delineate_outlet), and writes its output files.
+
+    Args:
+        basin_data: from load_basin()
+        job: tuple (counter, wid, lat, lng, terminal_comid, area_reported, name)
+        n_gages: total number of outlets, for status messages
+        settings: see py/settings.py
+
+    Returns:
+        mybasin_gdf: a GeoDataFrame with one row, the watershed and its attributes, or None if it failed
+        info: see delineate_outlet()
+    """
+    counter, wid, lat, lng, terminal_comid, area_reported, name = job
+    if settings.verbose: print(f"\n* Delineating watershed {counter} of {n_gages}, with outlet id = {wid}")
+
+    basin_poly, info = delineate_outlet(basin_data, wid, lat, lng, terminal_comid, area_reported, settings)
+    if basin_poly is None:
+        return None, info
+
+    # Let mybasin_gdf be a GeoPandas DataFrame with the geometry, and the id and area of our watershed
+    mybasin_gdf = gpd.GeoDataFrame(geometry=[basin_poly], crs=PROJ_WGS84)
+    mybasin_gdf['id'] = wid
+
+    # Add pourpoint coords to basin -   added
+    mybasin_gdf['lat'] = lat       # added
+    mybasin_gdf['lng'] = lng       # added
+
+    # If the user gave a name and an a priori area to the watershed, include it in the output
+    if name is not None:
+        mybasin_gdf['name'] = name
+    if info['result'] == "high res":
+        mybasin_gdf['result'] = "High Res"
+    else:
+        mybasin_gdf['result'] = "Low Res"
+
+    mybasin_gdf['area_calc_sqkm'] = info['area_calc_sqkm']       # edited
+    if area_reported is not None:
+        mybasin_gdf['area_reported'] = area_reported
+
+    if settings.verbose: print(f' Writing output for watershed {wid}')
+    write_watershed(mybasin_gdf, wid, lat, lng, info['lat_snap'], info['lng_snap'], basin_data['rivers_gdf'],
+                    info['comids'], settings)
+
+    return mybasin_gdf, info
+
+
+def outlet_key(basin_data: dict, job: tuple, settings: Settings) -> tuple:
+    """
+    Outlets with the same key are certain to have the same watershed, so we only need to delineate one of them.
+    In low-res mode, the watershed only depends on the terminal unit catchment. In high-res mode, it also
+    depends on where the outlet snaps to the river. If we snapped it with the stream pixel index (see snap_outlets),
+    we know that already. Otherwise, we only know it for outlets at the same coordinates.
+    (Those outlets that snap to the same pixel are found later; see delineate_outlet.)
+    """
+    counter, wid, lat, lng, terminal_comid, area_reported, name = job
+    if settings.match_areas and area_reported is not None:
+        # The pour point relocation depends on the exact location and the reported area
+        return terminal_comid, lat, lng, area_reported
+
+    up_area = basin_data['rivers_gdf'].loc[terminal_comid].uparea
+    if not settings.high_res or up_area > settings.low_res_threshold:
+        return (terminal_comid,)
+    snapped = basin_data['snaps'].get((terminal_comid, lat, lng))
+    if snapped is not None:
+        lng_snap, lat_snap = snapped
+        return terminal_comid, 'snapped', lat_snap, lng_snap
+    return terminal_comid, lat, lng
+
+
+def plan_jobs(basin_data: dict, jobs: list, settings: Settings) -> (list, list):
+    """
+    Groups the outlets that will have the same watershed (see outlet_key).
+    Returns the list of jobs to run (the first one in each group), and for each job in `jobs`,
+    the position in that list of the job whose watershed it will use.
+    """
+    if not settings.deduplicate:
+        return jobs, list(range(len(jobs)))
+
+    unique_jobs = []
+    same_as = []
+    positions = {}
+    for job in jobs:
+        key = outlet_key(basin_data, job, settings)
+        if key not in positions:
+            positions[key] = len(unique_jobs)
+            unique_jobs.append(job)
+        same_as.append(positions[key])
+    return unique_jobs, same_as
+
+
+def group_high_res_outlets(basin_data: dict, jobs: list, settings: Settings) -> dict:
+    """
+    Groups the outlets that will be delineated in high-res mode by their terminal unit catchment.
+    Returns a dict: terminal COMID -> {(lat, lng): wid}
+    """
+    rivers_gdf = basin_data['rivers_gdf']
+    groups = {}
+    for job in jobs:
+        counter, wid, lat, lng, terminal_comid, area_reported, name = job
+        # These outlets may be moved to another unit catchment, or switch to low-res mode
+        if settings.match_areas and area_reported is not None:
+            continue
+        if rivers_gdf.loc[terminal_comid].uparea > settings.low_res_threshold:
+            continue
+        groups.setdefault(terminal_comid, {})[(lat, lng)] = wid
+    return groups
+
+
+def snap_outlets(basin_data: dict, jobs: list, settings: Settings):
+    """
+    Snaps the high-res outlets to the streams with the stream pixel index (see py/stream_index.py),
+    for all of the outlets in each unit catchment at once, before we read any rasters.
+    The snapped (lng, lat) go in basin_data['snaps'], by (terminal COMID, lat, lng).
+    Does nothing if the index has not been built for this basin.
+    """
+    index = get_stream_index(basin_data)
+    if index is None:
+        return
+
+    import py.merit_detailed
+    import py.stream_index
+    n_snapped = 0
+    for terminal_comid, outlets in group_high_res_outlets(basin_data, jobs, settings).items():
+        bSingleCatchment = len(upstream_comids(basin_data['topology'], terminal_comid)) == 1
+        numpixels = py.merit_detailed.get_threshold(bSingleCatchment, settings)
+        xy = np.array([(lng, lat) for lat, lng in outlets])
+        snapped = py.stream_index.snap(index, terminal_comid, xy, numpixels)
+        # If we could not snap them here, split_catchment() snaps them with the rasters
+        if snapped is not None:
+            for (lat, lng), (lng_snap, lat_snap) in zip(outlets, snapped):
+                basin_data['snaps'][(terminal_comid, lat, lng)] = (lng_snap, lat_snap)
+            n_snapped += len(outlets)
+
+    if settings.verbose: print(f"Snapped {n_snapped} outlets with the stream pixel index")
+
+
+def split_group(basin_data: dict, group: tuple, settings: Settings) -> list:
+    """
+    Splits the terminal unit catchment for a group of outlets, (terminal COMID, [(wid, lat, lng), ...]),
+    with split_catchment_batch() (see py/merit_detailed.py). Returns the results, in the same order as the outlets.
+    """
+    import py.merit_detailed
+    terminal_comid, outlets = group
+    catchment_poly = get_catchments(basin_data, True).loc[terminal_comid].geometry
+    bSingleCatchment = len(upstream_comids(basin_data['topology'], terminal_comid)) == 1
+
+    # Use the snapped outlets from the stream pixel index, if we have all of them
+    snapped = [basin_data['snaps'].get((terminal_comid, lat, lng)) for wid, lat, lng in outlets]
+    snapped = None if None in snapped else np.array(snapped)
+
+    return py.merit_detailed.split_catchment_batch(outlets, basin_data['basin'], catchment_poly,
+                                                   bSingleCatchment, settings, snapped, terminal_comid)
+
+
+def split_in_batches(basin_data: dict, jobs: list, settings: Settings):
+    """
+    For the outlets in high-res mode that share a terminal unit catchment, splits the catchment for all
+    of them at once, with split_catchment_batch() (see py/merit_detailed.py), so that we only read the rasters
+    and trace the flow directions once per unit catchment. The results go in basin_data['splits'],
+    where delineate_outlet() finds them.
+    With settings.workers > 1, the unit catchments are split in a pool of forked workers, like the outlets
+    in run_jobs().
+    """
+    groups = [(comid, [(wid, lat, lng) for (lat, lng), wid in outlets.items()])
+              for comid, outlets in group_high_res_outlets(basin_data, jobs, settings).items() if len(outlets) > 1]
+    if len(groups) == 0:
+        return
+
+    # Imported (and the unit catchments loaded) before forking the workers, so that they don't each do it
+    import py.merit_detailed  # noqa: F401
+    import py.raster_cache
+    get_catchments(basin_data, True)
+    if settings.verbose: print(f"Splitting {len(groups)} unit catchments with more than one outlet")
+
+    workers = min(settings.workers, len(groups))
+    if workers > 1 and 'fork' in multiprocessing.get_all_start_methods():
+        all_results = []
+        worker_state.update(basin_data=basin_data, settings=settings, raster_counts=py.raster_cache.stats())
+        try:
+            with multiprocessing.get_context('fork').Pool(workers) as pool:
+                for results, raster_counts in pool.imap(split_group_in_worker, groups):
+                    py.raster_cache.add_stats(raster_counts)
+                    all_results.append(results)
+        finally:
+            worker_state.clear()
+    else:
+        all_results = [split_group(basin_data, group, settings) for group in groups]
+
+    # If it failed, delineate_outlet() tries again with split_catchment(), for just that outlet
+    for (terminal_comid, outlets), results in zip(groups, all_results):
+        for (wid, lat, lng), result in zip(outlets, results):
+            if result[0] is not None:
+                basin_data['splits'][(terminal_comid, lat, lng)] = result
+
+
+def copy_watershed(mybasin_gdf: gpd.GeoDataFrame, info: dict, job: tuple, basin_data: dict, n_gages: int,
+                   settings: Settings) -> (gpd.GeoDataFrame, dict):
+    """
+    For an outlet with the same watershed as another one: copies the other one's result, with this
+    outlet's id, coordinates, etc., and writes its output files.
+    """
+    counter, wid, lat, lng, terminal_comid, area_reported, name = job
+    if settings.verbose: print(f"\n* Watershed {counter} of {n_gages}, with outlet id = {wid}, "
+                               f"is the same as for outlet id = {mybasin_gdf['id'].iloc[0]}")
+
+    mybasin_gdf = mybasin_gdf.copy()
+    mybasin_gdf['id'] = wid
+    mybasin_gdf['lat'] = lat
+    mybasin_gdf['lng'] = lng
+    if name is not None:
+        mybasin_gdf['name'] = name
+    if area_reported is not None:
+        mybasin_gdf['area_reported'] = area_reported
+
+    info = dict(info)
+    geod = pyproj.Geod(ellps='WGS84')
+    info['snap_dist_m'] = geod.inv(lng, lat, info['lng_snap'], info['lat_snap'])[2]
+
+    if settings.verbose: print(f' Writing output for watershed {wid}')
+    write_watershed(mybasin_gdf, wid, lat, lng, info['lat_snap'], info['lng_snap'], basin_data['rivers_gdf'],
+                    info['comids'], settings)
+    return mybasin_gdf, info
+
+
+# The basin data and settings for the worker processes. We set these just before starting the workers,
+# and the workers are *forked*, so they share this memory with the main process (copy-on-write),
+# rather than each getting a pickled copy of the catchments and rivers.
+worker_state = {}
+
+
+def worker_raster_counts() -> dict:
+    """
+    The raster cache counters of this worker since its last job, so that the main process can report the totals.
+    """
+    if not worker_state['settings'].high_res:
+        return {}
+    import py.raster_cache
+    counts = py.raster_cache.stats()
+    raster_counts = {k: counts[k] - worker_state['raster_counts'].get(k, 0) for k in counts}
+    worker_state['raster_counts'] = counts
+    return raster_counts
+
+
+def process_outlet_in_worker(job: tuple) -> ((gpd.GeoDataFrame or None, dict), dict):
+    """
+    Runs process_outlet() in a worker. Also returns the raster cache counters for this job,
+    so that the main process can report the totals.
+    """
+    result = process_outlet(worker_state['basin_data'], job, worker_state['n_gages'], worker_state['settings'])
+    return result, worker_raster_counts()
+
+
+def split_group_in_worker(group: tuple) -> (list, dict):
+    """Runs split_group() in a worker. Also returns the raster cache counters, like process_outlet_in_worker()."""
+    results = split_group(worker_state['basin_data'], group, worker_state['settings'])
+    return results, worker_raster_counts()
+
+
+def preload_basin(basin_data: dict, jobs: list, settings: Settings):
+    """
+    Before forking the workers, load everything that the outlets in `jobs` might need,
+    (instead of having each worker load it on its own): the low-res unit catchments if any of the
+    watersheds are over LOW_RES_THRESHOLD, the pre-dissolved polygons, and the spatial index of the rivers.
+    """
+    rivers_gdf = basin_data['rivers_gdf']
+    resolutions = [settings.high_res]
+    if settings.high_res:
+        up_areas = rivers_gdf.loc[[job[4] for job in jobs], 'uparea']
+        if settings.match_areas or (up_areas > settings.low_res_threshold).any():
+            resolutions.append(False)
+
+    for high_resolution in resolutions:
+        get_catchments(basin_data, high_resolution)
+        if settings.predissolve:
+            get_predissolved(basin_data, high_resolution)
+
+    if settings.match_areas:
+        rivers_gdf.sindex  # builds the spatial index, if it is not there yet
 
-        plt.savefig(f"plots/{wid}_vector_unit_catchments_{suffix}.png")
-        plt.close(fig)
+    # Imported before forking the workers, so that they don't each import it (and pysheds) on their own
+    if settings.high_res:
+        import py.merit_detailed  # noqa: F401
+
+
+def run_jobs(basin_data: dict, jobs: list, n_gages: int, settings: Settings):
+    """
+    Runs process_outlet() for each job, and yields the results in the same order as the jobs.
+    With settings.workers > 1, uses a pool of forked worker processes.
+    """
+    workers = min(settings.workers, len(jobs))
+    if workers > 1 and 'fork' not in multiprocessing.get_all_start_methods():
+        print("(!) Running with one worker; multiple workers need the 'fork' start method (Linux or macOS)")
+        workers = 1
+
+    if workers <= 1:
+        for job in jobs:
+            yield process_outlet(basin_data, job, n_gages, settings)
+        return
+
+    preload_basin(basin_data, jobs, settings)
+    if settings.verbose: print(f"Starting {workers} workers for {len(jobs)} outlet points")
+
+    worker_state.update(basin_data=basin_data, n_gages=n_gages, settings=settings, raster_counts={})
+    if settings.high_res:
+        import py.raster_cache
+        worker_state['raster_counts'] = py.raster_cache.stats()
+    try:
+        with multiprocessing.get_context('fork').Pool(workers) as pool:
+            for result, raster_counts in pool.imap(process_outlet_in_worker, jobs):
+                if settings.high_res:
+                    py.raster_cache.add_stats(raster_counts)
+                yield result
+    finally:
+        worker_state.clear()
+
+
+def run_nested(basin_data: dict, jobs: list, n_gages: int, settings: Settings) -> list:
+    """
+    Nested mode: runs the jobs in order from upstream to downstream, so that each watershed can
+    reuse the watersheds of the outlets upstream of it (see assemble_subbasins). Because of this,
+    the jobs run one at a time in this process. Returns the results in the same order as `jobs`.
+    """
+    if settings.workers > 1:
+        print("(!) NESTED mode runs with one worker")
+
+    rows = comid_to_row(basin_data['topology'], [job[4] for job in jobs])
+    order = upstream_first(basin_data['topology'], rows)
+    results = [None] * len(jobs)
+    ordered_jobs = [jobs[i] for i in order]
+    for i, result in zip(order, run_jobs(basin_data, ordered_jobs, n_gages, settings.replace(workers=1))):
+        results[i] = result
+    return results
+
+
+def delineate_batch(points_df: pd.DataFrame, settings: Settings = None) -> (gpd.GeoDataFrame, pd.DataFrame):
+    """
+    Finds the watersheds for a table of outlet points, in memory.
+
+    This is the core of delineate(), for use from other Python programs, e.g. a batch driver that
+    streams thousands of points through one process. The data for each Level 2 basin stays in memory
+    between calls (see py/basin_cache.py). Output files and the map are only written if the settings
+    ask for them; use output_dir='' and make_map=False to not write anything.
+
+    Args:
+        points_df: DataFrame with the columns id, lat, lng, and optionally name and area (in km²)
+        settings: a Settings object (see py/settings.py). If None, uses the values in config.py
+
+    Returns:
+        watersheds_gdf: GeoDataFrame with one row per watershed that we found, with the columns
+            id, lat, lng, (name), result, area_calc_sqkm, (area_reported), geometry
+        status_df: DataFrame indexed by id, with one row for every outlet point. Same as OUTPUT.csv,
+            plus the column `explanation`, which says why we could not delineate a watershed.
+    """
+    if settings is None:
+        settings = Settings.from_config()
 
     # Check that the OUTPUT directories are there. If not, try to create them.
-    folder_exists = create_folder_if_not_exists(OUTPUT_DIR)
-    if not folder_exists:
-        raise Exception(f"No folder for output. Stopping")
+    if settings.write_files:
+        folder_exists = create_folder_if_not_exists(settings.output_dir)
+        if not folder_exists:
+            raise Exception(f"No folder for output. Stopping")
 
     # Check for the folder to put Python PICKLE files
     if PICKLE_DIR != "":
@@ -282,21 +945,19 @@ def delineate():
             raise Exception(f"No folder for pickle files. Stopping")
 
     # Check if the MAP_FOLDER is there
-    if MAKE_MAP:
-        folder_exists = create_folder_if_not_exists(MAP_FOLDER)
+    if settings.make_map:
+        folder_exists = create_folder_if_not_exists(settings.map_folder)
         if not folder_exists:
             raise Exception(f"No folder for the map files. Stopping")
 
-    # Check that the CSV file is there
-    if not os.path.isfile(OUTLETS_CSV):
-        raise Exception(f"Could not load your outlets file at: {OUTLETS_CSV}")
+    validate_search_distance(settings.search_dist)
 
-    # Read the outlet points CSV file and put into a Pandas DataFrame
-    # (I call the outlet points gages, because I usually in delineated watersheds at streamflow gages)
-    if VERBOSE: print(f"Reading your outlets data in: {OUTLETS_CSV}")
-    gages_df = pd.read_csv(OUTLETS_CSV, header=0, dtype={'id': 'str', 'lat': 'float', 'lng': 'float'})
+    # We add some columns to the outlets table, so work on a copy of it
+    gages_df = points_df.reset_index(drop=True)
+    if 'id' in gages_df:
+        gages_df['id'] = gages_df['id'].astype(str)
 
-    # Check that the CSV file includes at a minimum: id, lat, lng and that all values are appropriate
+    # Check that the table includes at a minimum: id, lat, lng and that all values are appropriate
     validate(gages_df)
 
     # Get the number of points, for status messages
@@ -313,7 +974,7 @@ def delineate():
 
     # If we are doing detailed delineation with raster data, we'll keep track of the "snapped" pour point
     # pysheds will always move the point a little bit, so that it coincides with the gridded data.
-    if HIGH_RES:
+    if settings.high_res:
         gages_df['lat_snap'] = np.nan
         gages_df['lng_snap'] = np.nan
         gages_df['snap_dist_m'] = 0
@@ -326,17 +987,13 @@ def delineate():
     # No longer needed with GeoPandas v 0.14
     #gages_df.drop(['geometry'], axis=1, inplace=True)
 
-    if VERBOSE: print("Finding out which Level 2 megabasin(s) your points are in")
+    if settings.verbose: print("Finding out which Level 2 megabasin(s) your points are in")
     # This file has the merged "megabasins_gdf" in it
-    megabasins_gdf = gpd.read_file(MERIT_BASINS)
-    # The CRS string in the shapefile is EPSG 4326 but does not match verbatim
-    megabasins_gdf.to_crs(PROJ_WGS84, inplace=True)
-    if not megabasins_gdf.loc[0].BASIN == 11:
-        raise Exception("An error occurred loading the Level 2 basins shapefile")
+    megabasins_gdf = load_megabasins()
 
     # Overlay the gage points on the Level 2 Basins polygons to find out which
     # PFAF_2 basin each point falls inside of, using a spatial join
-    if SEARCH_DIST == 0:
+    if settings.search_dist == 0:
         gages_basins_join = gpd.sjoin(points_gdf, megabasins_gdf, how="left", predicate='intersects')
 
     else:
@@ -344,7 +1001,8 @@ def delineate():
         # This line generates a warning about how its bad to use distances in unprojected geodata. OK
         with warnings.catch_warnings():
             warnings.simplefilter(action='ignore', category=UserWarning)
-            gages_basins_join = gpd.sjoin_nearest(points_gdf, megabasins_gdf, how='left', max_distance=SEARCH_DIST)
+            gages_basins_join = gpd.sjoin_nearest(points_gdf, megabasins_gdf, how='left',
+                                                  max_distance=settings.search_dist)
 
     # Needed to set this option in order to avoid a warning message in Geopandas.
     # https://stackoverflow.com/questions/20625582/how-to-deal-with-settingwithcopywarning-in-pandas
@@ -356,16 +1014,16 @@ def delineate():
 
     # Get a list of the DISTINCT Level 2 basins, and a count of how many gages in each.
     basins_df = gages_basins_join.groupby("BASIN").id.nunique()
-    basins = basins_df.index.tolist()
+    basins = [int(basin) for basin in basins_df.index]
 
-    if VERBOSE: 
+    if settings.verbose:
         print(f"Your watershed outlets are in {len(basins)} basin(s)")
         if len(basins) == 0:
             print(f"KO: COASTAL BASIN? Type 1")
 
     # Find any outlet points that are not in any Level 2 basin, and add these to the fail list
     # Look for any rows that are in gages_df that are not in basins_df
-    matched_ids = gages_basins_join['id'].tolist()
+    matched_ids = gages_basins_join.loc[gages_basins_join['BASIN'].notna(), 'id'].tolist()
     ids = gages_df['id'].tolist()
     for wid in ids:
         if wid not in matched_ids:
@@ -378,45 +1036,44 @@ def delineate():
     if bAreas:
         gages_df['perc_diff'] = 0
 
+    # The watersheds that we found, each one a GeoDataFrame with one row
+    watersheds = []
+
     gages_counter = 0
 
+    # Number of outlets that had the same watershed as another one, found in the planning pass,
+    # and after snapping the outlet (see DEDUPLICATE in config.py)
+    n_planned = 0
+    n_reused = 0
+
     # Iterate over the basins so that we only have
     # to open up each Level 2 Basin shapefile once, and handle all of the gages in it
     for basin in basins:
         # Create a dataframe of the gages_basins_join in that basins
         gages_in_basin = gages_basins_join[gages_basins_join["BASIN"] == basin]
         num_gages_in_basin = len(gages_in_basin)
-        if VERBOSE: print("\nBeginning delineation for %s outlet point(s) in Level 2 Basin #%s." % (num_gages_in_basin, basin))
+        if settings.verbose:
+            print("\nBeginning delineation for %s outlet point(s) in Level 2 Basin #%s." % (num_gages_in_basin, basin))
 
-        if HIGH_RES:
-            catchments_gdf = load_gdf("catchments", basin, True)
-            catchments_lowres_gdf = None
-        else:
-            catchments_gdf = load_gdf("catchments", basin, False)
-
-        # The network data is in the RIVERS file rather than the CATCHMENTS file
-        # (this is just how the MeritBASIS authors did it)
-        if VERBOSE: print('Reading data table for rivers in basin %s' % basin)
-        rivers_gdf = load_gdf("rivers", basin, True)
+        basin_data = load_basin(basin, settings.high_res)
+        catchments_gdf = get_catchments(basin_data, settings.high_res)
 
         # Perform a Spatial join on gages (points) and unit catchments (polygons)
         # to find the corresponding unit catchment for each gage
         # Adds the fields COMID and unitarea
-        if VERBOSE: print(f"Performing spatial join on {num_gages_in_basin} outlet points in basin #{basin}")
+        if settings.verbose: print(f"Performing spatial join on {num_gages_in_basin} outlet points in basin #{basin}")
         gages_in_basin.drop(['index_right'], axis=1, inplace=True)
 
-        validate_search_distance()
-        if SEARCH_DIST == 0:
+        if settings.search_dist == 0:
             gages_joined = gpd.sjoin(gages_in_basin, catchments_gdf, how="left", predicate="intersects")
 
         else:
             # This line generates a warning about how its bad to use distances in unprojected geodata. OK
             with warnings.catch_warnings():
                 warnings.simplefilter(action='ignore', category=UserWarning)
-                gages_joined = gpd.sjoin_nearest(gages_in_basin, catchments_gdf, max_distance=SEARCH_DIST)
+                gages_joined = gpd.sjoin_nearest(gages_in_basin, catchments_gdf, max_distance=settings.search_dist)
 
         gages_joined.rename(columns={"index_right": "COMID"}, inplace=True)
-        # catchments_gdf.to_file('catchments.geojson')
 
         # For any gages for which we could not find a unit catchment, add them to failed
         gages_matched = gages_joined['id'].tolist()
@@ -428,13 +1085,11 @@ def delineate():
         # Revise the number of gages in the basin, based on those which have a matching COMID
         num_gages_in_basin = len(gages_joined)
 
-        # Iterate over the gages and assemble the watershed
+        # Make a list of the outlets to delineate. Each job is a tuple:
+        # (counter, wid, lat, lng, terminal_comid, area_reported, name)
+        jobs = []
         for i in range(0, num_gages_in_basin):
             gages_counter += 1
-            if VERBOSE: print(f"\n* Delineating watershed {gages_counter} of {n_gages}, with outlet id = {wid}")
-
-            # Reset the local boolean flag for high-res mode. If the watershed is too big, script will switch to low.
-            bool_high_res = HIGH_RES
 
             # Let wid be the watershed ID. Get the lat, lng coords of the gage.
             wid = gages_joined['id'].iloc[i]
@@ -443,213 +1098,124 @@ def delineate():
 
             # The terminal comid is the unit catchment that contains (overlaps) the outlet point
             terminal_comid = gages_joined['COMID'].iloc[i]
-            
-            # Get the upstream area of the unit catchment we found, according to MERIT-Basins
+
+            # The point is in the Level 2 basin, but not in any of its unit catchments (e.g. on the coast)
             if math.isnan(terminal_comid):
                 print(f"KO: COASTAL BASIN? Type 2")
-                return
-                
-            up_area = rivers_gdf.loc[terminal_comid].uparea
-
-            # If MATCH_AREAS is True and the user provided the area in the outlets CSV file,
-            # the script will check whether the upstream area of the unit catchment is a good match.
-            # If the areas do not match well, look around the neighborhood for another unit catchment
-            # whose area is a closer match to what we think it is.
-            if bAreas and MATCH_AREAS:
-                area_reported = gages_df.loc[wid].area_reported
-                PD_area = abs((area_reported - up_area) / area_reported)
-                if PD_area > AREA_MATCHING_THRESHOLD:
-                    if VERBOSE:
-                        print("Outlet point is in a unit catchment whose area is not a close match.")
-                        print("Searching neighborhood for a river reach with a more closely matching upstream area")
-                    candidate_comid, up_area = find_close_catchment()
-                    if candidate_comid is None:
-                        failed[wid] = "Could not find a nearby river reach whose upstream area is " \
-                                      "within {}% of reported area of {:,.0f} km²" \
-                            .format(AREA_MATCHING_THRESHOLD * 100, area_reported)
-                        continue
-                    else:
-                        terminal_comid = candidate_comid
-
-            # Let B be the list of unit catchments (and river reaches) that are in the basin
-            B = []
-
-            # Add the first node, and the rest will be added recursively
-            addnode(B, terminal_comid)
-            if VERBOSE: print(f"  found {len(B)} unit catchments in the watershed")
-
-            # If the watershed is too big, revert to low-precision mode.
-            if HIGH_RES and up_area > LOW_RES_THRESHOLD:
-                if VERBOSE: print(f"Watershed for id = {wid} is larger than LOW_RES_THRESHOLD = {LOW_RES_THRESHOLD}. "
-                                  "SWITCHING TO LOW-RESOLUTION MODE.")
-                bool_high_res = False
-                # If we just flipped to low-res mode, check if the low-res unit catchment polygons are loaded.
-                if catchments_lowres_gdf is None:
-                    catchments_lowres_gdf = load_gdf("catchments", basin, False)
-
-                subbasins_gdf = catchments_lowres_gdf.loc[B]
-            else:
-                # Create a new geodataframe containing only the unit catchments_gdf that are in the list B
-                # In high precision mode, we will update the geometry of the terminal unit catchment.
-                subbasins_gdf = catchments_gdf.loc[B]
-
-            # Make a plot of the selected unit catchments
-            if PLOTS:
-                plot_basins("pre")
-
-            # In detailed mode,
-            if bool_high_res:
-                if VERBOSE: print("Performing detailed raster-based delineation for "
-                                  "the downstream portion of the watershed")
-                # Let split_catchment_poly be the polygon of the terminal unit catchment
-                assert terminal_comid == B[0]
-                catchment_poly = subbasins_gdf.loc[terminal_comid].geometry
-                bSingleCatchment = len(B) == 1
-                # if wid == "178573":
-                #     print(f"wid: {wid}, basin: {basin}, lat: {lat}, lng: {lng}, catchment_poly: {subbasins_gdf.loc[terminal_comid].geometry.geoms}, bSingleCatchment: {bSingleCatchment}")
-                split_catchment_poly, lat_snap, lng_snap = py.merit_detailed.split_catchment(wid, basin, lat, lng,
-                                                                                             catchment_poly,
-                                                                                             bSingleCatchment)
-                if split_catchment_poly is None:
-                    failed[wid] = "An error occured in pysheds detailed delineation."
-                    continue
+                failed[wid] = f"Could not assign to a unit catchment in Level 2 basin #{basin}"
+                continue
+
+            area_reported = gages_df.loc[wid].area_reported if bAreas else None
+            name = gages_df.loc[wid, 'name'] if bNames else None
+            jobs.append((gages_counter, wid, lat, lng, int(terminal_comid), area_reported, name))
+
+        # Don't mask the rasters with unit catchment labels that were made from other unit catchments
+        if settings.high_res and settings.catchment_labels:
+            check_labels(basin_data)
+
+        # Snap the outlets to the streams, all at once, if we have built the stream pixel index
+        if settings.high_res and settings.stream_index:
+            snap_outlets(basin_data, jobs, settings)
+
+        # Planning pass: outlets that we know will have the same watershed are only delineated once.
+        # unique_jobs are the ones we delineate, and same_as[i] is the position in unique_jobs
+        # of the job whose watershed we use for jobs[i].
+        unique_jobs, same_as = plan_jobs(basin_data, jobs, settings)
+
+        # Outlets that share a terminal unit catchment are split together, in one pass over the rasters.
+        # (Not with the plots, which only split_catchment() draws.)
+        if settings.high_res and settings.batch_split and not settings.plots:
+            split_in_batches(basin_data, unique_jobs, settings)
+
+        # Iterate over the gages and assemble the watersheds, in this process or in a pool of workers.
+        # Either way, we get the results back in the same order as the jobs.
+        if settings.nested:
+            results = run_nested(basin_data, unique_jobs, n_gages, settings)
+        else:
+            results = list(run_jobs(basin_data, unique_jobs, n_gages, settings))
+
+        # The outlets that we have seen so far, to tell the ones at the same place from the ones that snapped there
+        seen = set()
+        for job, k in zip(jobs, same_as):
+            counter, wid, lat, lng, terminal_comid, area_reported, name = job
+            mybasin_gdf, info = results[k]
+            if job is not unique_jobs[k]:
+                if (terminal_comid, lat, lng) in seen:
+                    n_planned += 1
                 else:
-                    # Create a temporary GeoDataFrame to create the geometry of the split catchment polygon
-                    # This is just a shortcut method to transfer it to our watershed's subbasins GDF
-                    split_gdf = gpd.GeoDataFrame(index=[0], crs='epsg:4326', geometry=[split_catchment_poly])
-                    split_geom = split_gdf.loc[0, 'geometry']
-                    subbasins_gdf.loc[terminal_comid, 'geometry'] = split_geom
-
-            if PLOTS:
-                plot_basins("post")
-
-            if VERBOSE: print("Dissolving...")
-            # mybasin_gs is a GeoPandas GeoSeries
-            mybasin_gs = dissolve_geopandas(subbasins_gdf)
-
-            if FILL:
-                # Fill donut holes in the watershed polygon
-                # Recall we asked the user for the fill threshold in terms of number of pixels
-                PIXEL_AREA = 0.000000695  # Constant for the area of a single pixel in MERIT-Hydro, in decimal degrees
-                area_max = FILL_THRESHOLD * PIXEL_AREA
-                mybasin_gs = fill_geopandas(mybasin_gs, area_max=area_max)
-
-            if SIMPLIFY:
-                # Simplify the geometry. GeoPandas uses the simple Douglas-Peuker algorithm
-                mybasin_gs = mybasin_gs.simplify(tolerance=SIMPLIFY_TOLERANCE)
-
-            # Let mybasin_gdf be a GeoPandas DataFrame with the geometry, and the id and area of our watershed
-            mybasin_gdf = gpd.GeoDataFrame(geometry=mybasin_gs)
-            mybasin_gdf['id'] = wid
-            basin_poly = mybasin_gdf.geometry.values[0]
-            up_area = get_area(basin_poly)
-
-            # Add pourpoint coords to basin -   added
-            mybasin_gdf['lat'] = gages_df.loc[wid, 'lat']       # added
-            mybasin_gdf['lng'] = gages_df.loc[wid, 'lng']       # added
-
-            # If the user gave a name and an a priori area to the watershed, include it in the output
-            if bNames:
-                mybasin_gdf['name'] = gages_df.loc[wid, 'name']
-            if bool_high_res:
-                mybasin_gdf['result'] = "High Res"
-                gages_df.at[wid, 'result'] = "high res"
-            else:
-                mybasin_gdf['result'] = "Low Res"
-                gages_df.at[wid, 'result'] = "low res"
-
-                snapped_outlet = rivers_gdf.loc[terminal_comid].geometry.coords[0]
-                lat_snap = snapped_outlet[1]
-                lng_snap = snapped_outlet[0]
-
-            # Get the (approx.) snap distance
-            geod = pyproj.Geod(ellps='WGS84')
-            snap_dist = geod.inv(lng, lat, lng_snap, lat_snap)[2]
-            gages_df.at[wid, 'snap_dist_m'] = sigfig.round(snap_dist, 2)
-            gages_df.at[wid, 'lat_snap'] = round(lat_snap, 3)
-            gages_df.at[wid, 'lng_snap'] = round(lng_snap, 3)
+                    n_reused += 1
+                if mybasin_gdf is not None:
+                    mybasin_gdf, info = copy_watershed(mybasin_gdf, info, job, basin_data, n_gages, settings)
+            elif info.get('reused'):
+                n_reused += 1
+            seen.add((terminal_comid, lat, lng))
+
+            if mybasin_gdf is None:
+                failed[wid] = info['explanation']
+                continue
+
+            gages_df.at[wid, 'result'] = info['result']
+            gages_df.at[wid, 'snap_dist_m'] = sigfig.round(info['snap_dist_m'], 2)
+            gages_df.at[wid, 'lat_snap'] = round(info['lat_snap'], 3)
+            gages_df.at[wid, 'lng_snap'] = round(info['lng_snap'], 3)
 
             # Add the upstream area of the delineated watershed to the DataFrame
-            # up_area = sigfig.round(up_area, 3)
-            mybasin_gdf['area_calc_sqkm'] = up_area       # edited
+            up_area = info['area_calc_sqkm']
             gages_df.at[wid, 'area_calc_sqkm'] = up_area
 
             if bAreas:
-                area_reported = gages_df.loc[wid].area_reported
-                mybasin_gdf['area_reported'] = area_reported
                 perc_diff = sigfig.round((up_area - area_reported) / area_reported * 100, 2)
                 gages_df.at[wid, 'perc_diff'] = perc_diff
 
-            # SAVE the Watershed to disk as a GeoJSON file or a shapefile
-            if VERBOSE: print(f' Writing output for watershed {wid}')
-            outfile = f"{OUTPUT_DIR}/{OUTPUT_PREFIX}{wid}.{OUTPUT_EXT}"
-
-            # This line rounds all the vertices to fewer digits. For text-like formats GeoJSON or KML, makes smaller
-            # files with minimal loss of precision. For other formats (shp, gpkg), doesn't make a difference in file size
-            if OUTPUT_EXT.lower() in ['geojson', 'kml']:
-                mybasin_gdf.geometry = mybasin_gdf.geometry.apply(lambda x: loads(re.sub(simpledec, mround, x.wkt)))
-
-            if OUTPUT_EXT != "":
-                with warnings.catch_warnings():
-                    warnings.simplefilter(action='ignore', category=UserWarning)
-                    mybasin_gdf.to_file(outfile)
-
-            # Create the HTML Viewer Map?
-            # We have to write a second, slightly different version of the GeoJSON files,
-            # because we need it in a .js file assigned to a variable, to avoid cross-origin restrictions
-            # of modern web browsers.
-            if MAKE_MAP:
-                watershed_js = f"{MAP_FOLDER}/{wid}.js"
-                with open(watershed_js, 'w') as f:
-                    s = f"gage_coords = [{lat}, {lng}];\n"
-                    f.write(s)
-                    s = f"snapped_coords = [{lat_snap}, {lng_snap}];\n"
-                    f.write(s)
-
-                    f.write("basin = ")
-                    f.write(mybasin_gdf.to_json())
-
-                if MAP_RIVERS:
-                    myrivers_gdf = rivers_gdf.loc[B]
-
-                    # Keep only the fields lengthkm and order
-                    myrivers_gdf = myrivers_gdf[['lengthkm', 'order', 'geometry']]
-
-                    # Filter out the little headwater streams in large watersheds.
-                    max_order = myrivers_gdf.order.max()
-                    min_order = max_order - NUM_STREAM_ORDERS
-                    # Drop rows where order < min_order
-                    myrivers_gdf = myrivers_gdf[myrivers_gdf.order >= min_order]
-                    myrivers_gdf = myrivers_gdf.round(1)
-                    myrivers_gdf.geometry = myrivers_gdf.geometry.apply(lambda x: loads(re.sub(simpledec, mround, x.wkt)))
-                    rivers_js = f"{MAP_FOLDER}/{wid}_rivers.js"
-                    with open(rivers_js, 'w') as f:
-                        f.write("rivers = ")
-                        f.write(myrivers_gdf.to_json())
+            watersheds.append(mybasin_gdf)
+
+    if settings.deduplicate and settings.verbose and n_planned + n_reused > 0:
+        print(f"Saved {n_planned + n_reused} of {n_gages} watershed computations: {n_planned} outlet(s) had the "
+              f"same unit catchment and location as another, and {n_reused} snapped to the same place as another.")
+
+    # The status table: everything in OUTPUT.csv, plus why any of the outlets failed
+    status_df = gages_df.drop(columns='geometry', errors='ignore')
+    status_df['explanation'] = pd.Series(failed, dtype='object')
 
     # CREATE OUTPUT.CSV, a data table of the outputs
     # id, status (hi, low, failed), name, area_reported, area_calculated
-    if OUTPUT_CSV:
-        output_csv_filename = f"{OUTPUT_DIR}/OUTPUT.csv"
+    if settings.write_files and settings.output_csv:
+        output_csv_filename = f"{settings.output_dir}/OUTPUT.csv"
         gages_df.to_csv(output_csv_filename)
 
     # FAILED.csv: If there were any failures, write this to a separate CSV file
     if len(failed) > 0:
         print(f"### FAILED to find watersheds for {len(failed)} locations. Check FAILED.csv for info.")
 
-        failfile = f"{OUTPUT_DIR}/FAILED.csv"
-        with open(failfile, 'w') as f:
-            f.write("ID, EXPLANATION\n")
-            for k, v in failed.items():
-                f.write(f'{k},"{v}"\n')
+        if settings.write_files:
+            failfile = f"{settings.output_dir}/FAILED.csv"
+            with open(failfile, 'w') as f:
+                f.write("ID, EXPLANATION\n")
+                for k, v in failed.items():
+                    f.write(f'{k},"{v}"\n')
 
     # If the user wants the browser map, make it
-    if MAKE_MAP:
-        if VERBOSE: print("* Creating viewer.html *")
-        make_map(gages_df)
+    if settings.make_map:
+        if settings.verbose: print("* Creating viewer.html *")
+        make_map(gages_df.copy(), settings.map_folder)
+
+    if len(watersheds) > 0:
+        watersheds_gdf = gpd.GeoDataFrame(pd.concat(watersheds, ignore_index=True), crs=PROJ_WGS84)
+    else:
+        watersheds_gdf = gpd.GeoDataFrame(columns=['id', 'geometry'], geometry='geometry', crs=PROJ_WGS84)
 
     # Finished, print a little status message
-    if VERBOSE: print(f"It's over! See results in {output_csv_filename}")
+    if settings.verbose:
+        basin_cache.report()
+        if settings.high_res:
+            import py.raster_cache
+            py.raster_cache.report()
+        if settings.write_files:
+            print(f"It's over! See results in {settings.output_dir}")
+        else:
+            print("It's over!")
+
+    return watersheds_gdf, status_df
 
 
 def get_pickle_filename(geotype: str, basin: int, high_resolution: bool) -> str:
@@ -673,48 +1239,121 @@ def get_pickle_filename(geotype: str, basin: int, high_resolution: bool) -> str:
     return fname
 
 
-def load_gdf(geotype: str, basin: int, high_resolution: bool) -> gpd.GeoDataFrame:
+def get_shapefile_name(geotype: str, basin: int, high_resolution: bool) -> str or None:
+    """
+    Finds the MERIT-Basins shapefile for a basin. Uses the _bugfix1 version if there is no regular one.
+    Returns None if we could not find it.
+    """
+    if geotype == "catchments":
+        if high_resolution:
+            directory = HIGHRES_CATCHMENTS_DIR
+        else:
+            directory = LOWRES_CATCHMENTS_DIR
+        shapefile = f"{directory}/cat_pfaf_{basin}_MERIT_Hydro_v07_Basins_v01.shp"
+        if not os.path.isfile(shapefile):
+            shapefile = f"{directory}/cat_pfaf_{basin}_MERIT_Hydro_v07_Basins_v01_bugfix1.shp"
+    elif geotype == "rivers":
+        shapefile = f"{RIVERS_DIR}/riv_pfaf_{basin}_MERIT_Hydro_v07_Basins_v01.shp"
+        if not os.path.isfile(shapefile):
+            shapefile = f"{RIVERS_DIR}/riv_pfaf_{basin}_MERIT_Hydro_v07_Basins_v01_bugfix1.shp"
+    else:
+        raise Exception(f"Unknown geotype: {geotype}")
+
+    if not os.path.isfile(shapefile):
+        return None
+    return shapefile
+
+
+def select_columns(gdf: gpd.GeoDataFrame, columns: list or None, geometry: bool) -> gpd.GeoDataFrame or pd.DataFrame:
+    """
+    Keeps only the requested attribute columns (those that exist), and the geometry if asked for.
+    """
+    if columns is not None:
+        keep = [c for c in columns if c in gdf.columns]
+        if geometry:
+            keep.append(gdf.geometry.name)
+        gdf = gdf[keep]
+    elif not geometry:
+        gdf = gdf.drop(columns=gdf.geometry.name)
+
+    if not geometry:
+        gdf = pd.DataFrame(gdf)
+    return gdf
+
+
+def load_megabasins() -> gpd.GeoDataFrame:
+    """
+    Returns the MERIT Level 2 basins (megabasins) as a GeoDataFrame.
+    Kept in the in-process basin data cache, so repeated calls to delineate() only read it once.
+    """
+    def read_megabasins():
+        megabasins_gdf = gpd.read_file(MERIT_BASINS)
+        # The CRS string in the shapefile is EPSG 4326 but does not match verbatim
+        megabasins_gdf.to_crs(PROJ_WGS84, inplace=True)
+        if not megabasins_gdf.loc[0].BASIN == 11:
+            raise Exception("An error occurred loading the Level 2 basins shapefile")
+        return megabasins_gdf
+
+    return basin_cache.get("megabasins", None, None, read_megabasins, key_extra=(MERIT_BASINS,))
+
+
+def load_gdf(geotype: str, basin: int, high_resolution: bool, columns: list = None,
+             geometry: bool = True) -> gpd.GeoDataFrame:
+    """
+    Same as read_gdf(), but keeps the result in the in-process basin data cache (py/basin_cache.py),
+    so that repeated calls to delineate() in the same process only load each basin once.
+    Do not modify the returned GeoDataFrame in place; it is shared.
+    """
+    resolution_str = 'hires' if high_resolution else 'lores'
+    key_extra = (None if columns is None else tuple(columns), geometry)
+    return basin_cache.get(geotype, basin, resolution_str,
+                           lambda: read_gdf(geotype, basin, high_resolution, columns, geometry),
+                           key_extra=key_extra)
+
+
+def read_gdf(geotype: str, basin: int, high_resolution: bool, columns: list = None,
+             geometry: bool = True) -> gpd.GeoDataFrame:
     """
     Returns the unit catchments vector polygon dataset as a GeoDataFrame
     Gets the data from the MERIT-Basins shapefile the first time,
-    and after that from a saved .pkl file on disk.
+    and after that from the cache in PICKLE_DIR: either the columnar cache (CACHE_FORMAT = 'parquet',
+    see py/columnar_cache.py) or a saved .pkl file on disk (CACHE_FORMAT = 'pickle').
     Uses some global parameters from config.py
 
     :param geotype: either "catchments" or "rivers" depending on which one we want to open.
     :param basin: the Pfafstetter level 2 megabasin, an integer from 11 to 91
     :param high_resolution: True to load the standard (high-resolution) file,
       False to load the low-resolution version (for faster processing, slightly less accurate results)
+    :param columns: the attribute columns we need, or None for all of them.
+      With the columnar cache, we only read these columns from disk.
+    :param geometry: False if we only need the attributes. Then the result is a plain pandas DataFrame.
 
     :return: a GeoPandas GeoDataFrame
 
     """
-
-    # First, check for the presence of a pickle file
-    if PICKLE_DIR != '':
+    shapefile = get_shapefile_name(geotype, basin, high_resolution)
+    use_columnar = PICKLE_DIR != '' and CACHE_FORMAT == 'parquet' and columnar_cache.HAS_PYARROW
+    if PICKLE_DIR != '' and CACHE_FORMAT == 'parquet' and not columnar_cache.HAS_PYARROW:
+        print("Warning: CACHE_FORMAT = 'parquet' requires pyarrow, which is not installed. Using pickle files.")
+
+    # First, check for the presence of a cache
+    if use_columnar:
+        if columnar_cache.is_valid(geotype, basin, high_resolution, shapefile):
+            if VERBOSE: print(f"Fetching BASIN # {basin} {geotype} data from columnar cache.")
+            return columnar_cache.load_columnar(geotype, basin, high_resolution, columns, geometry)
+
+    # Pickle files. We also look for these if we are using the columnar cache, but do not have the
+    # shapefiles to (re)build it from.
+    if PICKLE_DIR != '' and (not use_columnar or shapefile is None):
         pickle_fname = get_pickle_filename(geotype, basin, high_resolution)
         if os.path.isfile(pickle_fname):
             if VERBOSE: print(f"Fetching BASIN # {basin} catchment data from pickle file.")
             gdf = pickle.load(open(pickle_fname, "rb"))
-            return gdf
-    
+            return select_columns(gdf, columns, geometry)
+
     # Open the shapefile for the basin
-    if geotype == "catchments":
-        if high_resolution:
-            directory = HIGHRES_CATCHMENTS_DIR
-            shapefile = f"{directory}/cat_pfaf_{basin}_MERIT_Hydro_v07_Basins_v01_bugfix1.shp"
-        else:
-            directory = LOWRES_CATCHMENTS_DIR
-        shapefile = f"{directory}/cat_pfaf_{basin}_MERIT_Hydro_v07_Basins_v01.shp"
-        if not os.path.isfile(shapefile):
-            shapefile = f"{directory}/cat_pfaf_{basin}_MERIT_Hydro_v07_Basins_v01_bugfix1.shp"
-        if not os.path.isfile(shapefile):
-            raise Exception(f"Could not find the file: {shapefile}")
-    elif geotype == "rivers":
-        shapefile = f"{RIVERS_DIR}/riv_pfaf_{basin}_MERIT_Hydro_v07_Basins_v01.shp"
-        if not os.path.isfile(shapefile):
-            shapefile = f"{RIVERS_DIR}/riv_pfaf_{basin}_MERIT_Hydro_v07_Basins_v01_bugfix1.shp"
-        if not os.path.isfile(shapefile):
-            raise Exception(f"Could not find the file: {shapefile}")
+    if shapefile is None:
+        raise Exception(f"Could not find the {geotype} shapefile for basin {basin}")
 
     if VERBOSE: print(f"Reading geodata in {shapefile}")
     gdf = gpd.read_file(shapefile)
@@ -723,9 +1362,12 @@ def load_gdf(geotype: str, basin: int, high_resolution: bool) -> gpd.GeoDataFram
     # This line is necessary because some of the shapefiles provided by reachhydro.com do not include .prj files
     gdf.set_crs(PROJ_WGS84, inplace=True, allow_override=True)
 
-    # Before we exit, save the GeoDataFrame as a pickle file, for future speedups!
-    save_pickle(geotype, gdf, basin, high_resolution)
-    return gdf
+    # Before we exit, save the GeoDataFrame to the cache, for future speedups!
+    if use_columnar:
+        columnar_cache.save_columnar(gdf, geotype, basin, high_resolution, shapefile)
+    else:
+        save_pickle(geotype, gdf, basin, high_resolution)
+    return select_columns(gdf, columns, geometry)
 
 
 def save_pickle(geotype: str, gdf: gpd.GeoDataFrame, basin: int, high_resolution: bool):
@@ -750,4 +1392,9 @@ def save_pickle(geotype: str, gdf: gpd.GeoDataFrame, basin: int, high_resolution
 
 
 if __name__ == "__main__":
-    delineate()
+    parser = argparse.ArgumentParser(description="Delineates watersheds for the outlets in OUTLETS_CSV. "
+                                                 "All other settings are in config.py")
+    parser.add_argument('--workers', type=int, default=None,
+                        help=f"Number of worker processes for the outlets in each basin. Default: WORKERS = {WORKERS}")
+    args = parser.parse_args()
+    delineate(workers=args.workers)
@@ -0,0 +1,203 @@
+"""
+Offline data preparation for delineate.py
+
+Some of the speedups in delineate.py rely on data that we build ahead of time, once per
+Level 2 megabasin, and store next to the pickle files in PICKLE_DIR. This script builds them.
+Like delineate.py, it uses the settings in config.py. Run it from this folder:
+
+    python prepare_data.py predissolve 72 74       # pre-dissolved polygons for basins 72 and 74
+    python prepare_data.py predissolve 72 --lowres --area 5000
+    python prepare_data.py streams 72              # stream pixel index for snapping in high-res mode
+    python prepare_data.py labels 72               # pre-rasterized unit catchments for high-res mode
+    python prepare_data.py edges 72 --lowres       # edge index for the "edges" dissolve method
+    python prepare_data.py retile 72 --out /data/merit_tiled     # small tiles for faster windowed reads
+    python prepare_data.py memmap 72               # uncompressed copies of the rasters, in MEMMAP_DIR
+
+Commands:
+    predissolve     Pre-dissolved polygons for river reaches with large upstream areas (py/predissolve.py)
+    streams         Index of the stream pixels in each high-res unit catchment (py/stream_index.py)
+    labels          Raster of the high-res unit catchment COMIDs, on the flow direction grid (py/catchment_labels.py)
+    edges           Index of the edges of the unit catchments and their neighbours, for DISSOLVE_METHOD = "edges"
+                    (py/edge_index.py)
+
+    retile          Copies of the flow direction and accumulation rasters with small tiles (py/retile.py)
+    memmap          Uncompressed copies of the rasters (and the labels), for memory-mapping (py/raster_memmap.py)
+
+Build the labels before the stream pixel index, which uses them if they are there.
+Unlike the others, retile writes to the --out folder rather than PICKLE_DIR. Point MERIT_FDIR_DIR
+and MERIT_ACCUM_DIR to it afterwards. It can also retile other rasters, with --files.
+memmap writes to MEMMAP_DIR.
+"""
+import argparse
+import os
+import time
+
+from config import *
+from delineate import load_gdf
+from py.mapper import create_folder_if_not_exists
+from py.topology import UP_FIELDS, load_topology
+from py.predissolve import build_predissolved, save_predissolved
+from py.stream_index import build_stream_index, save_stream_index
+from py.catchment_labels import build_labels, check_labels, get_labels_filename
+from py.edge_index import build_edge_index, save_edge_index
+from py.signature import signature
+from py.raster_memmap import convert
+from py.retile import BLOCK_SIZE, describe, retile_raster, verify_raster, catchment_windows, random_windows, \
+    time_windows
+
+
+def predissolve(basins: list, high_resolution: bool, area_threshold: float):
+    for basin in basins:
+        t0 = time.perf_counter()
+        print(f"\nBuilding pre-dissolved polygons for BASIN # {basin}, upstream area >= {area_threshold} km²")
+        catchments_gdf = load_gdf("catchments", basin, high_resolution)
+        rivers_gdf = load_gdf("rivers", basin, True, columns=UP_FIELDS + ['uparea'], geometry=False)
+        topology = load_topology(basin, rivers_gdf)
+        predissolved_gdf = build_predissolved(catchments_gdf, rivers_gdf, topology, area_threshold)
+        save_predissolved(predissolved_gdf, basin, high_resolution)
+        print(f"Built {len(predissolved_gdf):,} polygons in {time.perf_counter() - t0:.1f} s")
+
+
+def streams(basins: list, threshold: int):
+    for basin in basins:
+        t0 = time.perf_counter()
+        print(f"\nBuilding the stream pixel index for BASIN # {basin}, with more than {threshold} upstream pixels")
+        catchments_gdf = load_gdf("catchments", basin, True)
+        # read_windows() masks the rasters with the labels, if they are up to date
+        check_labels(basin, signature(catchments_gdf))
+        index = build_stream_index(catchments_gdf, basin, threshold)
+        save_stream_index(index, basin)
+        print(f"Found {len(index['row']):,} stream pixels in {len(index['comid']):,} unit catchments "
+              f"in {time.perf_counter() - t0:.1f} s")
+
+
+def labels(basins: list):
+    for basin in basins:
+        t0 = time.perf_counter()
+        print(f"\nRasterizing the unit catchments for BASIN # {basin}")
+        catchments_gdf = load_gdf("catchments", basin, True)
+        build_labels(catchments_gdf, basin)
+        print(f"Rasterized {len(catchments_gdf):,} unit catchments in {time.perf_counter() - t0:.1f} s")
+
+
+def edges(basins: list, high_resolution: bool):
+    for basin in basins:
+        t0 = time.perf_counter()
+        print(f"\nBuilding the edge index for BASIN # {basin}")
+        catchments_gdf = load_gdf("catchments", basin, high_resolution)
+        index = build_edge_index(catchments_gdf)
+        save_edge_index(index, basin, high_resolution)
+        print(f"Indexed {len(index['u']):,} edges in {len(index['neighbor']):,} groups, for "
+              f"{len(index['comid']):,} unit catchments, in {time.perf_counter() - t0:.1f} s")
+
+
+def retile(basins: list, files: list, out_dir: str, block_size: int, compress: str, sample: int):
+    # For the MERIT rasters, we time the windows of a sample of the unit catchments. For other files, random windows.
+    jobs = [(path, None) for path in files]
+    for basin in basins:
+        windows = catchment_windows(load_gdf("catchments", basin, True), sample)
+        jobs += [(f"{MERIT_FDIR_DIR}/flowdir{basin}.tif", windows), (f"{MERIT_ACCUM_DIR}/accum{basin}.tif", windows)]
+
+    for path, windows in jobs:
+        if not os.path.isfile(path):
+            raise Exception(f"Could not find raster: {path}")
+        new_path = os.path.join(out_dir, os.path.basename(path))
+        print(f"\nRetiling {path}\n  before: {describe(path)}")
+        t0 = time.perf_counter()
+        retile_raster(path, new_path, block_size, compress)
+        print(f"  after:  {describe(new_path)}, written in {time.perf_counter() - t0:.1f} s")
+
+        verify_raster(path, new_path)
+        print("  checked: the pixels, size, transform, coordinate system and no-data value are the same")
+
+        if windows is None:
+            windows = random_windows(path, sample)
+        for label, p in (("before", path), ("after", new_path)):
+            t = time_windows(p, windows)
+            print(f"  read {len(windows)} windows {label + ':':7s} median {t['median_ms']:6.2f} ms, "
+                  f"mean {t['mean_ms']:6.2f} ms, {t['decoded_mb']:6.2f} MB decoded per window")
+
+
+def memmap(basins: list):
+    for basin in basins:
+        t0 = time.perf_counter()
+        print(f"\nMaking memory-mapped copies of the rasters for BASIN # {basin} in {MEMMAP_DIR}")
+        paths = [f"{MERIT_FDIR_DIR}/flowdir{basin}.tif", f"{MERIT_ACCUM_DIR}/accum{basin}.tif"]
+        if os.path.isfile(get_labels_filename(basin)):
+            paths.append(get_labels_filename(basin))
+        for path in paths:
+            if not os.path.isfile(path):
+                raise Exception(f"Could not find raster: {path}")
+            npy_fname, json_fname = convert(path)
+            print(f"  {npy_fname}: {os.path.getsize(npy_fname) / 1e6:,.0f} MB")
+        print(f"Done in {time.perf_counter() - t0:.1f} s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    p = subparsers.add_parser('predissolve', help="Build pre-dissolved polygons for large upstream areas")
+    p.add_argument('basins', type=int, nargs='+', help="Level 2 basin codes, e.g. 72")
+    p.add_argument('--lowres', action='store_true', help="Use the low-resolution (simplified) unit catchments")
+    p.add_argument('--area', type=float, default=PREDISSOLVE_AREA,
+                   help=f"Minimum upstream area in km². Default: PREDISSOLVE_AREA = {PREDISSOLVE_AREA}")
+
+    p = subparsers.add_parser('streams', help="Build the stream pixel index, for snapping the outlets")
+    p.add_argument('basins', type=int, nargs='+', help="Level 2 basin codes, e.g. 72")
+    p.add_argument('--threshold', type=int, default=min(THRESHOLD_SINGLE, THRESHOLD_MULTIPLE),
+                   help="Minimum number of upstream pixels. Default: the smaller of THRESHOLD_SINGLE "
+                        "and THRESHOLD_MULTIPLE")
+
+    p = subparsers.add_parser('labels', help="Rasterize the unit catchments, for masking the rasters")
+    p.add_argument('basins', type=int, nargs='+', help="Level 2 basin codes, e.g. 72")
+
+    p = subparsers.add_parser('edges', help="Build the edge index, for the \"edges\" dissolve method")
+    p.add_argument('basins', type=int, nargs='+', help="Level 2 basin codes, e.g. 72")
+    p.add_argument('--lowres', action='store_true', help="Use the low-resolution (simplified) unit catchments")
+
+    p = subparsers.add_parser('retile', help="Copy the rasters with small tiles, for faster windowed reads")
+    p.add_argument('basins', type=int, nargs='*', help="Level 2 basin codes, e.g. 72")
+    p.add_argument('--files', nargs='+', default=[], help="Other rasters to retile, e.g. the 15s HydroSHEDS rasters")
+    p.add_argument('--out', required=True, help="Folder for the new rasters")
+    p.add_argument('--block', type=int, default=BLOCK_SIZE, help=f"Tile size in pixels. Default: {BLOCK_SIZE}")
+    p.add_argument('--compress', default=None, help="Codec, e.g. ZSTD, LZW or DEFLATE. Default: ZSTD if we have it")
+    p.add_argument('--sample', type=int, default=100, help="Number of windows to time. Default: 100")
+
+    p = subparsers.add_parser('memmap', help="Copy the rasters to uncompressed files, for memory-mapping")
+    p.add_argument('basins', type=int, nargs='+', help="Level 2 basin codes, e.g. 72")
+
+    args = parser.parse_args()
+
+    if args.command == 'retile':
+        if len(args.basins) == 0 and len(args.files) == 0:
+            raise Exception("Please give some basins, or --files")
+        if not create_folder_if_not_exists(args.out):
+            raise Exception(f"Could not make the folder {args.out}. Stopping")
+        retile(args.basins, args.files, args.out, args.block, args.compress, args.sample)
+        return
+    if args.command == 'memmap':
+        if MEMMAP_DIR == '':
+            raise Exception("Please set MEMMAP_DIR in config.py; this is where we save the copies.")
+        if not create_folder_if_not_exists(MEMMAP_DIR):
+            raise Exception(f"Could not make the folder {MEMMAP_DIR}. Stopping")
+        memmap(args.basins)
+        return
+
+    if PICKLE_DIR == '':
+        raise Exception("Please set PICKLE_DIR in config.py; this is where we save the prepared data.")
+    if not create_folder_if_not_exists(PICKLE_DIR):
+        raise Exception("No folder for pickle files. Stopping")
+
+    if args.command == 'predissolve':
+        predissolve(args.basins, not args.lowres, args.area)
+    elif args.command == 'streams':
+        streams(args.basins, args.threshold)
+    elif args.command == 'labels':
+        labels(args.basins)
+    elif args.command == 'edges':
+        edges(args.basins, not args.lowres)
+
+
+if __name__ == "__main__":
+    main()
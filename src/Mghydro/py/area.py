@@ -0,0 +1,63 @@
+"""
+Areas of polygons in unprojected lat, lng coordinates, in km².
+
+The original get_area() in delineate.py made two new pyproj.Proj objects for every watershed, with
+an Albers equal-area projection fitted to the polygon's bounds, and pushed every vertex through
+the deprecated pyproj.transform() function via shapely.ops.transform(), one vertex at a time.
+That was slow for high-res watersheds with hundreds of thousands of vertices.
+
+Here we project ALL of the vertices of a whole array (or GeoSeries) of polygons in one call, with
+a single cached Transformer, to the Lambert cylindrical equal-area projection on the WGS84 ellipsoid.
+Since the projection preserves area everywhere on the ellipsoid, we do not need to fit it to
+each polygon, and the planar area of the projected polygons (computed by shapely in C) is the area
+on the ellipsoid. The only approximation is the same as before: edges are straight lines
+in the projected coordinates rather than geodesics, which makes no real difference for polygons
+with vertices every 3 arcseconds.
+
+For checking, geodesic_area() uses pyproj.Geod to compute the area with geodesic edges (slower).
+"""
+from functools import lru_cache
+import numpy as np
+import shapely
+import pyproj
+
+# Lambert cylindrical equal-area projection on the WGS84 ellipsoid
+PROJ_EQUAL_AREA = '+proj=cea +ellps=WGS84 +units=m +no_defs'
+
+
+@lru_cache(maxsize=None)
+def get_transformer() -> pyproj.Transformer:
+    """The lat, lng -> equal-area Transformer. Made once per process."""
+    return pyproj.Transformer.from_crs('EPSG:4326', PROJ_EQUAL_AREA, always_xy=True)
+
+
+def to_equal_area(coords: np.ndarray) -> np.ndarray:
+    """Projects an (n, 2) array of lng, lat coordinates to the equal-area projection, in meters."""
+    x, y = get_transformer().transform(coords[:, 0], coords[:, 1])
+    return np.column_stack([x, y])
+
+
+def get_areas(geoms) -> np.ndarray:
+    """
+    Areas in km² of an array, list or GeoSeries of shapely polygons (or multipolygons)
+    in lat, lng coordinates (EPSG:4326). Missing geometries get an area of NaN.
+    """
+    geoms = np.asarray(geoms, dtype=object)
+    projected = shapely.transform(geoms, to_equal_area)
+    return shapely.area(projected) / 1e6
+
+
+def get_area(poly) -> float:
+    """
+    Area of a shapely polygon (or multipolygon) in lat, lng coordinates, in km².
+    """
+    return float(get_areas([poly])[0])
+
+
+def geodesic_area(poly) -> float:
+    """
+    Area in km² on the WGS84 ellipsoid, with geodesic edges. Slower; used to check the accuracy of get_area().
+    """
+    geod = pyproj.Geod(ellps='WGS84')
+    area, _ = geod.geometry_area_perimeter(poly)
+    return abs(area) / 1e6
@@ -0,0 +1,115 @@
+"""
+In-process cache of the basin data loaded by delineate().
+
+When a batch driver (e.g. Super Computer Scripts/spc5_delineate_basins.py) calls delineate()
+over and over in the same Python process, each call used to re-read the Level 2 basins shapefile,
+and re-load the unit catchments, rivers and topology for the same megabasin. Now these go through
+this cache, so that a group of outlets in the same basin only pays the load cost once.
+
+Items are keyed by (geotype, basin, resolution), e.g. ("catchments", 72, "hires"), and are evicted
+in least-recently-used order when the total (estimated) size is over BASIN_CACHE_MB megabytes.
+Set BASIN_CACHE_MB = 0 in config.py to turn the cache off.
+
+The cached objects are shared between calls, so callers must not modify them in place.
+"""
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+from config import *
+
+# key -> (object, estimated size in bytes), most recently used last
+_cache = OrderedDict()
+_stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'bytes': 0}
+
+
+def estimate_size(obj) -> int:
+    """
+    Rough estimate of the memory used by an object, in bytes.
+    Handles (Geo)DataFrames, NumPy arrays, and dicts / tuples / lists of these.
+    """
+    if obj is None:
+        return 0
+    if isinstance(obj, gpd.GeoDataFrame):
+        geometry = obj.geometry.values
+        # 16 bytes per x, y coordinate pair plus some overhead per geometry object
+        n_bytes = int(shapely.get_num_coordinates(np.asarray(geometry)).sum()) * 16 + len(obj) * 100
+        others = obj.drop(columns=obj.geometry.name)
+        return n_bytes + int(others.memory_usage(index=True, deep=False).sum())
+    if isinstance(obj, pd.DataFrame):
+        return int(obj.memory_usage(index=True, deep=False).sum())
+    if isinstance(obj, np.ndarray):
+        return obj.nbytes
+    if isinstance(obj, dict):
+        return sum(estimate_size(v) for v in obj.values())
+    if isinstance(obj, (tuple, list)):
+        return sum(estimate_size(v) for v in obj)
+    return 0
+
+
+def budget_bytes() -> int:
+    return int(BASIN_CACHE_MB * 1024 * 1024)
+
+
+def get(geotype: str, basin: int or None, resolution: str or None, loader, key_extra: tuple = ()):
+    """
+    Returns the cached object for (geotype, basin, resolution), calling `loader()` to
+    load it if it is not in the cache.
+
+    Args:
+        geotype: what kind of data, e.g. "catchments", "rivers", "topology", "megabasins"
+        basin: the Pfafstetter level 2 megabasin, or None
+        resolution: "hires", "lores" or None
+        loader: function with no arguments that loads the data
+        key_extra: anything else that changes what `loader` returns (e.g. the list of columns)
+    """
+    if BASIN_CACHE_MB <= 0:
+        return loader()
+
+    key = (geotype, basin, resolution) + tuple(key_extra)
+    if key in _cache:
+        _cache.move_to_end(key)
+        _stats['hits'] += 1
+        return _cache[key][0]
+
+    _stats['misses'] += 1
+    obj = loader()
+    size = estimate_size(obj)
+
+    # Don't bother caching something bigger than the whole budget
+    if size > budget_bytes():
+        if VERBOSE: print(f"  {geotype} data for basin {basin} ({size / 1e6:,.0f} MB) is too big for "
+                          f"BASIN_CACHE_MB = {BASIN_CACHE_MB}; not caching it")
+        return obj
+
+    _cache[key] = (obj, size)
+    _stats['bytes'] += size
+
+    # Evict the least recently used items until we are within the budget
+    while _stats['bytes'] > budget_bytes():
+        old_key, (_, old_size) = _cache.popitem(last=False)
+        _stats['bytes'] -= old_size
+        _stats['evictions'] += 1
+        if VERBOSE: print(f"  removed {old_key} from the basin data cache")
+
+    return obj
+
+
+def stats() -> dict:
+    """Returns the cache counters: hits, misses, evictions, and the number of items and bytes held."""
+    return dict(_stats, items=len(_cache))
+
+
+def report():
+    """Prints a one-line summary of the cache counters."""
+    s = stats()
+    print(f"Basin data cache: {s['hits']} hits, {s['misses']} misses, {s['evictions']} evictions, "
+          f"{s['items']} items using {s['bytes'] / 1e6:,.0f} of {BASIN_CACHE_MB:,} MB")
+
+
+def clear():
+    """Empties the cache and resets the counters."""
+    _cache.clear()
+    for k in _stats:
+        _stats[k] = 0
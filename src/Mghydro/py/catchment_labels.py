@@ -0,0 +1,193 @@
+"""
+A raster of the unit catchment COMIDs, lined up with the MERIT-Hydro flow direction raster, for high-res mode.
+
+split_catchment() masks the flow direction and accumulation rasters to the terminal unit catchment.
+It used to rasterize the unit catchment polygon for every outlet (see rasterize_catchment). Instead, we can
+rasterize all of the unit catchments in the basin once, ahead of time (see prepare_data.py), into a
+"label" raster with the COMID of the unit catchment at each pixel. Then the mask is just labels == COMID,
+in the window, read through the raster cache.
+
+The labels are made the same way as the mask in rasterize_catchment(): the largest part of the polygon,
+with its holes filled. Where a unit catchment is inside of a hole in another one, it has its own COMID,
+so for unit catchments with holes, we fill the holes in the mask when we read it.
+We also sample the polygons at the same points as rasterize_catchment() does in the window, which is
+offset from the pixel grid by a tiny bit (see get_bounding_box): window pixel i is sampled a hair inside
+of the lower right corner of raster pixel k + i - 1, where k is the pixel that the window starts at.
+So we rasterize each pixel at that point, and read the window pixel by pixel, without resampling
+(GDAL's nearest-neighbour resampling of the window skips a pixel partway across it, because of the offset).
+This way, the masks are exactly the same.
+
+The labels are saved as a tiled, compressed GeoTIFF next to the pickle files:
+    PICKLE_DIR/labels_##.tif
+with the signature of the unit catchments in its "source" tag (see py/signature.py). If the unit catchments
+change, check_labels() finds that they don't match, and we rasterize the polygons again until the labels are rebuilt.
+"""
+import os
+import time
+import numpy as np
+import geopandas as gpd
+import rasterio
+import rasterio.features
+from rasterio.windows import Window
+from affine import Affine
+from scipy import ndimage
+import shapely
+from shapely.geometry import box
+from pysheds.sview import Raster, ViewFinder
+from config import *
+from py.settings import Settings
+from py.fast_dissolve import fill_holes
+from py.signature import signature, matches
+import py.raster_cache as raster_cache
+
+# Size of the pieces of the raster that we rasterize at a time, in pixels (a multiple of the tile size)
+CHUNK_SIZE = 4096
+TILE_SIZE = 256
+
+# The label files that were built from other unit catchments, which read_mask() doesn't use (see check_labels)
+_stale = set()
+
+
+def get_labels_filename(basin: int) -> str:
+    """
+    Standard filename for the unit catchment labels, stored next to the pickle files:
+        PICKLE_DIR/labels_##.tif
+    """
+    return f'{PICKLE_DIR}/labels_{basin}.tif'
+
+
+def mask_polygons(geoms: np.ndarray) -> np.ndarray:
+    """
+    The polygons that rasterize_catchment() uses, for an array of unit catchments:
+    the largest part of each one (the first, if there is a tie, like get_largest), without holes.
+    """
+    parts, part_of = shapely.get_parts(geoms, return_index=True)
+    order = np.lexsort((np.arange(len(parts)), -shapely.area(parts), part_of))
+    first = np.r_[True, part_of[order][1:] != part_of[order][:-1]]
+    if np.count_nonzero(first) != len(geoms):
+        raise Exception("Some of the unit catchments are empty")
+    return fill_holes(parts[order][first], 0)
+
+
+def build_labels(catchments_gdf: gpd.GeoDataFrame, basin: int, settings: Settings = None):
+    """
+    Rasterizes all of the high-res unit catchments in a basin onto the grid of its flow direction raster,
+    and saves the result (see the module docstring).
+
+    Args:
+        catchments_gdf: the high-res unit catchments, indexed by COMID
+        basin: the Level 2 basin, which tells us which flow direction raster to line up with
+        settings: see py/settings.py. If None, uses the values in config.py
+    """
+    from py.merit_detailed import HALFPIX
+    if settings is None:
+        settings = Settings.from_config()
+
+    fdir_fname = f"{settings.merit_fdir_dir}/flowdir{basin}.tif"
+    if not os.path.isfile(fdir_fname):
+        raise Exception(f"Could not find flow direction raster: {fdir_fname}")
+    with rasterio.open(fdir_fname) as f:
+        profile = {'driver': 'GTiff', 'width': f.width, 'height': f.height, 'count': 1, 'crs': f.crs,
+                   'transform': f.transform}
+    transform = profile['transform']
+
+    # COMIDs have 8 digits, so they fit in 32 bits
+    if catchments_gdf.index.max() >= 2 ** 32:
+        raise Exception("The COMIDs are too large for the label raster")
+    profile.update(dtype='uint32', nodata=0, tiled=True, blockxsize=TILE_SIZE, blockysize=TILE_SIZE,
+                   compress='deflate', BIGTIFF='IF_SAFER')
+
+    # The larger unit catchments go first, so that a unit catchment inside of a hole in another one
+    # gets its own COMID
+    polygons = gpd.GeoSeries(mask_polygons(catchments_gdf.geometry.to_numpy()), index=catchments_gdf.index)
+    polygons = polygons.iloc[np.argsort(-polygons.area.to_numpy(), kind='stable')]
+    comids = polygons.index.to_numpy()
+    sindex = polygons.sindex
+
+    fname = get_labels_filename(basin)
+    if VERBOSE: print(f"Rasterizing {len(polygons):,} unit catchments onto a {profile['width']:,} x "
+                      f"{profile['height']:,} grid, in {fname}")
+    t0 = time.perf_counter()
+    with rasterio.open(fname, 'w', **profile) as out:
+        for row in range(0, profile['height'], CHUNK_SIZE):
+            for col in range(0, profile['width'], CHUNK_SIZE):
+                window = Window(col, row, min(CHUNK_SIZE, profile['width'] - col),
+                                min(CHUNK_SIZE, profile['height'] - row))
+                bounds = rasterio.windows.bounds(window, transform)
+                hits = np.sort(sindex.query(box(*bounds)))
+                if len(hits) == 0:
+                    continue
+
+                # Sample each pixel at the same point as rasterize_catchment() does: a hair inside
+                # of its lower right corner. (The windows are offset by HALFPIX instead of 1/2400 degrees.)
+                x0, y0 = transform * (col, row)
+                sample_transform = Affine(transform.a, 0, x0 + transform.a - HALFPIX,
+                                          0, transform.e, y0 + transform.e + HALFPIX)
+                labels = rasterio.features.rasterize(
+                    zip(polygons.values[hits], comids[hits].tolist()), out_shape=(window.height, window.width),
+                    transform=sample_transform, fill=0, all_touched=False, dtype='uint32')
+                out.write(labels, 1, window=window)
+
+            if VERBOSE: print(f"  {min(row + CHUNK_SIZE, profile['height']):,} of {profile['height']:,} rows, "
+                              f"{time.perf_counter() - t0:.0f} s")
+        out.update_tags(source=signature(catchments_gdf))
+    _stale.discard(fname)
+
+
+def check_labels(basin: int, source: str) -> bool:
+    """
+    Checks that the labels for a basin were built from the unit catchments with the signature `source`
+    (from py.signature.signature()). If not, prints a warning, and read_mask() won't use them.
+    Returns False if the labels can't be used, or have not been built.
+    """
+    fname = get_labels_filename(basin)
+    if PICKLE_DIR == '' or not os.path.isfile(fname):
+        return False
+    with rasterio.open(fname) as f:
+        saved = f.tags().get('source')
+    if matches(saved, source, fname):
+        _stale.discard(fname)
+        return True
+    _stale.add(fname)
+    return False
+
+
+def read_mask(basin: int, comid: int, catchment_poly, bounding_box: tuple, fdir: Raster) -> Raster or None:
+    """
+    Returns the mask of a unit catchment in the window, the same as rasterize_catchment(),
+    or None if we have not built the labels for this basin, check_labels() found that they were built
+    from other unit catchments, or the window goes past the edge of the raster.
+
+    Args:
+        basin: the Level 2 basin
+        comid: the unit catchment
+        catchment_poly: its polygon, to see whether it has holes
+        bounding_box: the window, from get_bounding_box()
+        fdir: the flow direction raster in the same window
+    """
+    fname = get_labels_filename(basin)
+    if PICKLE_DIR == '' or fname in _stale or not os.path.isfile(fname):
+        return None
+
+    # The label pixels that are sampled at the same points as the window pixels (see the module docstring)
+    entry = raster_cache.get_dataset(fname)
+    window = rasterio.windows.from_bounds(*bounding_box, transform=entry['transform'])
+    row0, col0 = int(round(window.row_off - 0.5)), int(round(window.col_off - 0.5))
+    n_rows, n_cols = fdir.shape
+
+    # If the window goes past the edge of the raster, rasterize_catchment() can still find pixels of the
+    # polygon outside of it, but we can't. This is rare, so we just rasterize the polygon for these.
+    if row0 < 0 or col0 < 0 or row0 + n_rows > entry['height'] or col0 + n_cols > entry['width']:
+        return None
+
+    if entry['memmap'] is not None:
+        labels = entry['memmap'][row0:row0 + n_rows, col0:col0 + n_cols]
+    else:
+        labels = raster_cache.read_pixels(fname, entry, row0, row0 + n_rows, col0, col0 + n_cols)
+    mask = labels == comid
+
+    # If the unit catchment has holes, the pixels in them have another COMID (or none), so we fill them in
+    from py.merit_detailed import get_largest
+    if len(get_largest(catchment_poly).interiors) > 0:
+        mask = ndimage.binary_fill_holes(mask)
+    return Raster(mask.astype(np.uint8), ViewFinder(**fdir.viewfinder.properties))
@@ -0,0 +1,209 @@
+"""
+Columnar, versioned cache for the MERIT-Basins unit catchments and rivers.
+
+The pickle files (see load_gdf() in delineate.py) hold whole GeoDataFrames, up to around 1 GB per basin,
+and every process has to fully deserialize them, even when it only needs a few columns. They also
+never go stale: if you download a new version of a shapefile (e.g. the _bugfix1 files), the script
+keeps using the old data until you delete the pickle by hand.
+
+This cache stores each layer in two files in PICKLE_DIR:
+
+    {geotype}_{basin}_{res}.parquet   GeoParquet, with the geometry as WKB plus all of the attributes.
+                                       We read only the columns that the caller asks for.
+    {geotype}_{basin}_{res}.arrow     Arrow IPC (Feather v2), uncompressed, with only the attributes.
+                                       This one is memory-mapped, so that callers who do not need the
+                                       geometry (e.g. building the river topology) only touch the pages
+                                       for the columns they use, and the OS can share them between processes.
+
+plus a small .json file that records the cache version, and the size, modification time and
+SHA-256 hash of the source shapefile. When the source changes, the cache is rebuilt.
+The hash is only computed when the size or mtime do not match, e.g. after copying the files.
+
+Requires pyarrow. If it is not installed, delineate.py falls back to the pickle files.
+"""
+import hashlib
+import json
+import os
+import geopandas as gpd
+import pandas as pd
+from config import *
+
+try:
+    import pyarrow as pa
+    import pyarrow.ipc
+    import pyarrow.parquet
+    HAS_PYARROW = True
+except ImportError:
+    HAS_PYARROW = False
+
+# Increment this whenever the layout of the cache files changes, so old caches get rebuilt
+CACHE_VERSION = 1
+
+# The shapefile components that hold the data. (We do not care about .prj, .cpg, etc.)
+SOURCE_EXTENSIONS = ['.shp', '.dbf']
+
+# The WGS84 projection string (same as in delineate.py)
+PROJ_WGS84 = 'EPSG:4326'
+
+
+def get_cache_filenames(geotype: str, basin: int, high_resolution: bool) -> (str, str, str):
+    """
+    Standard filenames for the columnar cache, e.g. for the high-res catchments in basin 72:
+        PICKLE_DIR/catchments_72_hires.parquet
+        PICKLE_DIR/catchments_72_hires.arrow
+        PICKLE_DIR/catchments_72_hires.json
+    """
+    resolution_str = 'hires' if high_resolution else 'lores'
+    base = f'{PICKLE_DIR}/{geotype}_{basin}_{resolution_str}'
+    return f'{base}.parquet', f'{base}.arrow', f'{base}.json'
+
+
+def file_hash(fname: str) -> str:
+    """SHA-256 hash of a file, read in chunks so that we do not need to hold it all in memory."""
+    h = hashlib.sha256()
+    with open(fname, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def source_signature(shapefile: str, with_hash: bool) -> dict:
+    """
+    Describes the source shapefile: for each of its .shp and .dbf files, the size, mtime and
+    (optionally) the SHA-256 hash.
+    """
+    signature = {}
+    base = os.path.splitext(shapefile)[0]
+    for ext in SOURCE_EXTENSIONS:
+        fname = base + ext
+        if not os.path.isfile(fname):
+            continue
+        stat = os.stat(fname)
+        entry = {'size': stat.st_size, 'mtime': stat.st_mtime}
+        if with_hash:
+            entry['sha256'] = file_hash(fname)
+        signature[ext] = entry
+    return signature
+
+
+def is_valid(geotype: str, basin: int, high_resolution: bool, shapefile: str or None) -> bool:
+    """
+    Checks whether there is a cache for this layer, and that it was made from the current
+    version of the source shapefile. If the shapefile is not available (e.g. we only copied
+    the cache files to a cluster), we trust the cache.
+    """
+    parquet_fname, arrow_fname, meta_fname = get_cache_filenames(geotype, basin, high_resolution)
+    if not (os.path.isfile(parquet_fname) and os.path.isfile(arrow_fname) and os.path.isfile(meta_fname)):
+        return False
+
+    try:
+        with open(meta_fname, 'r') as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return False
+
+    if meta.get('version') != CACHE_VERSION:
+        return False
+
+    if shapefile is None:
+        return True
+
+    saved = meta.get('source', {})
+    current = source_signature(shapefile, with_hash=False)
+    if set(saved) != set(current):
+        return False
+
+    touched = False
+    for ext, entry in current.items():
+        if entry['size'] != saved[ext]['size']:
+            return False
+        if entry['mtime'] != saved[ext]['mtime']:
+            # Same size but a different time stamp: only stale if the contents changed.
+            if file_hash(os.path.splitext(shapefile)[0] + ext) != saved[ext].get('sha256'):
+                return False
+            saved[ext]['mtime'] = entry['mtime']
+            touched = True
+
+    # The contents are the same. Remember the new time stamp so that we do not hash the files every time.
+    if touched:
+        try:
+            write_meta(meta_fname, meta)
+        except OSError:
+            pass
+
+    return True
+
+
+def write_meta(meta_fname: str, meta: dict):
+    tmp = f"{meta_fname}.{os.getpid()}.tmp"
+    with open(tmp, 'w') as f:
+        json.dump(meta, f, indent=2)
+    os.replace(tmp, meta_fname)
+
+
+def save_columnar(gdf: gpd.GeoDataFrame, geotype: str, basin: int, high_resolution: bool, shapefile: str):
+    """
+    Saves a GeoDataFrame (indexed by COMID) to the columnar cache.
+    Each file is written to a temporary name and then renamed, and the .json file is written last,
+    so that other processes (e.g. SLURM array tasks) never see a half-written cache.
+    """
+    parquet_fname, arrow_fname, meta_fname = get_cache_filenames(geotype, basin, high_resolution)
+    if VERBOSE: print(f"Saving GeoDataFrame to columnar cache: {parquet_fname}")
+
+    pid = os.getpid()
+    gdf = gdf.reset_index()
+
+    tmp = f"{parquet_fname}.{pid}.tmp"
+    gdf.to_parquet(tmp)
+    os.replace(tmp, parquet_fname)
+
+    attributes = pa.Table.from_pandas(pd.DataFrame(gdf.drop(columns=gdf.geometry.name)), preserve_index=False)
+    tmp = f"{arrow_fname}.{pid}.tmp"
+    with pa.OSFile(tmp, 'wb') as sink:
+        with pa.ipc.new_file(sink, attributes.schema) as writer:
+            writer.write_table(attributes)
+    os.replace(tmp, arrow_fname)
+
+    meta = {
+        'version': CACHE_VERSION,
+        'shapefile': shapefile,
+        'source': source_signature(shapefile, with_hash=True),
+    }
+    write_meta(meta_fname, meta)
+
+
+def load_columnar(geotype: str, basin: int, high_resolution: bool, columns: list = None,
+                  geometry: bool = True) -> gpd.GeoDataFrame or pd.DataFrame:
+    """
+    Reads a layer from the columnar cache.
+
+    Args:
+        geotype: either "catchments" or "rivers"
+        basin: the Pfafstetter level 2 megabasin, an integer from 11 to 91
+        high_resolution: True for the standard files, False for the simplified (low-res) catchments
+        columns: list of attribute columns to read. None to read all of them.
+        geometry: if True, read the geometry from the GeoParquet file and return a GeoDataFrame.
+            If False, return a (pandas) DataFrame of the attributes from the memory-mapped Arrow file.
+
+    Returns:
+        a GeoDataFrame or DataFrame, indexed by COMID
+    """
+    parquet_fname, arrow_fname, _ = get_cache_filenames(geotype, basin, high_resolution)
+
+    if geometry:
+        read_columns = None
+        if columns is not None:
+            available = pa.parquet.read_schema(parquet_fname).names
+            read_columns = ['COMID'] + [c for c in columns if c in available] + ['geometry']
+        gdf = gpd.read_parquet(parquet_fname, columns=read_columns)
+        gdf.set_index('COMID', inplace=True)
+        gdf.set_crs(PROJ_WGS84, inplace=True, allow_override=True)
+        return gdf
+
+    with pa.memory_map(arrow_fname, 'r') as source:
+        table = pa.ipc.open_file(source).read_all()
+        if columns is not None:
+            table = table.select(['COMID'] + [c for c in columns if c in table.schema.names])
+        df = table.to_pandas(split_blocks=True)
+    df.set_index('COMID', inplace=True)
+    return df
@@ -0,0 +1,190 @@
+"""
+Finds all of the pixels upstream of a pour point in a D8 flow direction grid, without recursion.
+
+split_catchment() used pysheds' grid.catchment() for this, with recursionlimit=15000. In long, narrow
+unit catchments, the flow path can be longer than that, and the delineation failed (or used a lot of stack).
+Here we trace the flow *upstream* from the pour point with an explicit stack, so the length of the flow
+path does not matter. If numba is installed, the tracing loop is compiled; if not, we use NumPy to
+expand the whole "frontier" of the catchment by one pixel at a time.
+
+catchment() is a drop-in replacement for grid.catchment() in split_catchment(), and gives the same result.
+Set TRACER = "pysheds" in config.py to use pysheds instead.
+
+For several outlets in the same unit catchment, catchments() labels every pixel with the first outlet
+downstream of it, in one pass, instead of tracing the upstream area of each outlet separately
+(see split_catchment_batch() in py/merit_detailed.py).
+"""
+import numpy as np
+from pysheds.sview import Raster, ViewFinder
+
+try:
+    from numba import njit
+    HAS_NUMBA = True
+except ImportError:
+    HAS_NUMBA = False
+
+
+def get_offsets(n_cols: int, dirmap: tuple) -> (np.ndarray, np.ndarray):
+    """
+    For a grid with n_cols columns, returns the offsets of the 8 neighbours of a pixel in the flattened grid,
+    in the order N, NE, E, SE, S, SW, W, NW, and the flow direction value that each one has if it flows *into* the pixel.
+    For example, the neighbour to the north flows into the pixel if its flow direction is south.
+    """
+    offsets = np.array([-n_cols, 1 - n_cols, 1, 1 + n_cols, n_cols, -1 + n_cols, -1, -1 - n_cols], dtype=np.int64)
+    flows_in = np.array([dirmap[4], dirmap[5], dirmap[6], dirmap[7],
+                         dirmap[0], dirmap[1], dirmap[2], dirmap[3]], dtype=np.int64)
+    return offsets, flows_in
+
+
+def trace_stack(fdir_flat: np.ndarray, start: int, label: int, offsets: np.ndarray, flows_in: np.ndarray,
+                labels_flat: np.ndarray):
+    """
+    Gives the pixels upstream of `start` the value `label` in labels_flat, using a stack of pixels to visit.
+    We stop at pixels that already have a label (e.g. another outlet).
+    Every pixel flows into only one neighbour, so each pixel goes on the stack at most once.
+    (Compiled with numba, if it is available.)
+    """
+    stack = np.empty(fdir_flat.size, dtype=np.int64)
+    stack[0] = start
+    n = 1
+    while n > 0:
+        n -= 1
+        pixel = stack[n]
+        for k in range(8):
+            neighbor = pixel + offsets[k]
+            if labels_flat[neighbor] == 0 and fdir_flat[neighbor] == flows_in[k]:
+                labels_flat[neighbor] = label
+                stack[n] = neighbor
+                n += 1
+
+
+if HAS_NUMBA:
+    trace_stack = njit(cache=True)(trace_stack)
+
+
+def trace_frontier(fdir_flat: np.ndarray, start: int, label: int, offsets: np.ndarray, flows_in: np.ndarray,
+                   labels_flat: np.ndarray):
+    """
+    Same as trace_stack(), but with NumPy: each step adds all of the pixels that flow into the
+    pixels that were added in the previous step. For when numba is not installed.
+    """
+    frontier = np.array([start], dtype=np.int64)
+    while frontier.size > 0:
+        neighbors = (frontier[:, np.newaxis] + offsets).ravel()
+        flows_into_frontier = fdir_flat[neighbors] == np.tile(flows_in, frontier.size)
+        frontier = neighbors[flows_into_frontier & (labels_flat[neighbors] == 0)]
+        labels_flat[frontier] = label
+
+
+def label_outlets(fdir: np.ndarray, rows: list, cols: list, dirmap: tuple,
+                  use_numba: bool = HAS_NUMBA) -> (np.ndarray, list):
+    """
+    Labels every pixel of a D8 flow direction grid with the first outlet that its water flows through,
+    for any number of outlets, in one pass over the grid. Each outlet gets the pixels upstream of it,
+    up to (but not including) the other outlets upstream of it.
+    Like pysheds, we treat the pixels around the edge of the grid as if they don't flow anywhere.
+
+    Args:
+        fdir: the flow direction grid
+        rows, cols: the pixel of each outlet. Outlets at the same pixel get the same label.
+        dirmap: the flow direction values, in the order N, NE, E, SE, S, SW, W, NW
+        use_numba: if False, uses trace_frontier() instead of the compiled trace_stack()
+
+    Returns:
+        labels: an array with the same shape as fdir, with the label of the outlet for each pixel,
+            or 0 if it does not flow through any of them. The label of outlet i is i + 1,
+            or the label of the first outlet at the same pixel.
+        members: for each outlet, the list of labels that make up its whole catchment:
+            its own, and those of the outlets upstream of it
+    """
+    # We put a border of zeros around the grid, so that we never look past the edge.
+    m, n = fdir.shape
+    padded = np.zeros((m + 2, n + 2), dtype=np.int64)
+    padded[2:m, 2:n] = fdir[1:m - 1, 1:n - 1]
+    labels = np.zeros(padded.shape, dtype=np.int32)
+    padded_flat = padded.ravel()
+    labels_flat = labels.ravel()
+    offsets, flows_in = get_offsets(n + 2, dirmap)
+
+    # First label all of the outlets, so that the tracing stops when it reaches another outlet
+    starts = [(row + 1) * (n + 2) + (col + 1) for row, col in zip(rows, cols)]
+    outlet_labels = []
+    for i, start in enumerate(starts):
+        if labels_flat[start] == 0:
+            labels_flat[start] = i + 1
+        outlet_labels.append(int(labels_flat[start]))
+
+    trace = trace_stack if use_numba else trace_frontier
+    for i, start in enumerate(starts):
+        if outlet_labels[i] == i + 1:
+            trace(padded_flat, start, i + 1, offsets, flows_in, labels_flat)
+
+    # The next outlet downstream of each outlet is the label of the pixel that it flows into
+    downstream = {}
+    for i, start in enumerate(starts):
+        direction = padded_flat[start]
+        if outlet_labels[i] == i + 1 and direction in dirmap:
+            downstream[i + 1] = int(labels_flat[start + offsets[dirmap.index(direction)]])
+
+    # The whole catchment of an outlet also has all of the outlets that drain into it
+    members = {label: [label] for label in set(outlet_labels)}
+    for label in members:
+        below = downstream.get(label, 0)
+        while below != 0 and below != label and label not in members[below]:
+            members[below].append(label)
+            below = downstream.get(below, 0)
+
+    return labels[1:m + 1, 1:n + 1], [members[label] for label in outlet_labels]
+
+
+def trace_upstream(fdir: np.ndarray, row: int, col: int, dirmap: tuple, use_numba: bool = HAS_NUMBA) -> np.ndarray:
+    """
+    Finds the pixels upstream of (and including) the pixel at (row, col) in a D8 flow direction grid.
+
+    Returns:
+        a boolean array with the same shape as fdir, True for the pixels in the catchment
+    """
+    labels, members = label_outlets(fdir, [row], [col], dirmap, use_numba)
+    return labels == 1
+
+
+def catchments(grid, fdir: Raster, xs: list, ys: list, dirmap: tuple, use_numba: bool = HAS_NUMBA) -> list:
+    """
+    Delineates the catchments upstream of the points (xs[i], ys[i]), in the current view of the grid,
+    all at once (see label_outlets). The result for each point is the same as
+    grid.catchment(fdir=fdir, x=x, y=y, dirmap=dirmap, xytype='coordinate') in pysheds.
+
+    Returns:
+        a list of pysheds Rasters, one per point, True for the pixels in the catchment
+    """
+    view = grid.view(fdir, dtype=np.int64, nodata=fdir.nodata)
+    xmin, ymin, xmax, ymax = view.bbox
+    rows = []
+    cols = []
+    for x, y in zip(xs, ys):
+        if (x < xmin) or (x > xmax) or (y < ymin) or (y > ymax):
+            raise ValueError(f"Pour point ({x}, {y}) is out of bounds for dataset with bbox {view.bbox}.")
+        col, row = grid.nearest_cell(x, y, view.affine, 'corner')
+        rows.append(row)
+        cols.append(col)
+
+    labels, members = label_outlets(np.asarray(view), rows, cols, dirmap, use_numba)
+
+    viewfinder = ViewFinder(**view.viewfinder.properties)
+    viewfinder.nodata = False
+    results = []
+    for outlet_members in members:
+        catch = labels == outlet_members[0] if len(outlet_members) == 1 else np.isin(labels, outlet_members)
+        results.append(Raster(catch, viewfinder))
+    return results
+
+
+def catchment(grid, fdir: Raster, x: float, y: float, dirmap: tuple, use_numba: bool = HAS_NUMBA) -> Raster:
+    """
+    Delineates the catchment upstream of the point (x, y), in the current view of the grid.
+    Same as grid.catchment(fdir=fdir, x=x, y=y, dirmap=dirmap, xytype='coordinate') in pysheds.
+
+    Returns:
+        a pysheds Raster, True for the pixels in the catchment
+    """
+    return catchments(grid, fdir, [x], [y], dirmap, use_numba)[0]
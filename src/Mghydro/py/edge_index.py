@@ -0,0 +1,424 @@
+"""
+Index of the edges of the unit catchments, for the "edges" dissolve method (see py/fast_dissolve.py).
+
+union_edges() finds the outline of a watershed by taking every unit catchment apart into its edges,
+and dropping the edges that two of them share. That touches every vertex of every unit catchment,
+even though nearly all of them are inside of the watershed. But which edges are shared, and with whom,
+does not depend on the watershed. So in an offline step (see prepare_data.py), we work it out once for the
+whole basin: we give each distinct vertex a number (rounding to EDGE_PRECISION), and for every edge of every
+unit catchment, we find the unit catchment on the other side of it. Where neighbours don't quite line up,
+we split their edges where they touch or cross, and find what is on the other side by looking a hair to the
+right of the edge. The edges of each unit catchment are grouped by the neighbour, so a unit catchment with
+hundreds of edges only has a handful of groups.
+
+To dissolve some of the unit catchments, we keep the groups whose neighbour is not one of them (or is nothing:
+the edge of the basin, or a gap), and stitch their edges together into rings at the numbered vertices.
+Rings that go counter-clockwise are the outside, and the ones that go clockwise are holes. This takes time
+in proportion to the number of unit catchments and the length of the outline, not to the number of vertices
+inside of the watershed.
+
+The index is saved next to the pickle files, as PICKLE_DIR/edges_##_hires.npz (or _lores), with the arrays:
+    comid: the unit catchments, sorted
+    start: the groups of edges of comid[i] are start[i]:start[i + 1]
+    neighbor: for each group, the COMID of the unit catchment on the other side of its edges, or 0 for none
+    edge_start: the edges in group j are edge_start[j]:edge_start[j + 1] in u and v
+    u, v: the vertices at the start and the end of each edge, which goes around its unit catchment
+        with the unit catchment on the left
+    x, y: the coordinates of the vertices
+    source: the signature of the unit catchments it was built from (see py/signature.py)
+"""
+import os
+import time
+import numpy as np
+import geopandas as gpd
+import shapely
+from shapely.geometry import Polygon, MultiPolygon
+from config import *
+from py.fast_dissolve import EDGE_PRECISION, ring_edges, union_edges
+from py.signature import signature, matches
+
+# To find what is on the other side of an edge that doesn't line up with a neighbour,
+# we look this far to the right of its middle, in decimal degrees
+SIDE_OFFSET = 10 * EDGE_PRECISION
+
+# Edges that are closer to parallel than this (the sine of the angle between them) can only meet by overlapping
+PARALLEL = 1e-9
+
+
+def get_edge_index_filename(basin: int, high_resolution: bool) -> str:
+    """
+    Standard filename for the edge index, stored next to the pickle files:
+        PICKLE_DIR/edges_##_hires.npz or PICKLE_DIR/edges_##_lores.npz
+    """
+    resolution_str = 'hires' if high_resolution else 'lores'
+    return f'{PICKLE_DIR}/edges_{basin}_{resolution_str}.npz'
+
+
+def number_vertices(points: np.ndarray) -> (np.ndarray, np.ndarray):
+    """
+    Gives the same number to the points that round to the same multiple of EDGE_PRECISION.
+    Returns the number of each point, and the (x, y) of each numbered vertex.
+    """
+    _, first, vertex = np.unique(np.round(points / EDGE_PRECISION).astype(np.int64), axis=0,
+                                 return_index=True, return_inverse=True)
+    return vertex.ravel(), points[first]
+
+
+def find_twins(u: np.ndarray, v: np.ndarray, n_vertices: int) -> np.ndarray:
+    """For each edge u -> v, the position of an edge v -> u, or -1 if there isn't one."""
+    key = u.astype(np.int64) * n_vertices + v
+    order = np.argsort(key, kind='stable')
+    sorted_key = key[order]
+    reverse = v.astype(np.int64) * n_vertices + u
+    pos = np.minimum(np.searchsorted(sorted_key, reverse), len(key) - 1)
+    return np.where(sorted_key[pos] == reverse, order[pos], -1)
+
+
+def meeting_points(a: np.ndarray, b: np.ndarray, i: np.ndarray, j: np.ndarray) -> (np.ndarray, np.ndarray):
+    """
+    Where the segments a -> b touch or cross each other, other than at their ends, for pairs of segments
+    i, j that intersect (each pair once). Returns the segment that has to be split, and the point, for each one.
+    A crossing splits both segments at the same point.
+    """
+    d_i, d_j = b[i] - a[i], b[j] - a[j]
+    len_i, len_j = np.hypot(*d_i.T), np.hypot(*d_j.T)
+    denom = d_i[:, 0] * d_j[:, 1] - d_i[:, 1] * d_j[:, 0]
+    parallel = np.abs(denom) <= PARALLEL * len_i * len_j
+
+    def inside(t, length):
+        # Far enough from both ends of the segment that it would be a new vertex
+        return (t * length > EDGE_PRECISION) & ((1 - t) * length > EDGE_PRECISION)
+
+    segment, points = [], []
+
+    # Segments that cross, or where the end of one touches the other. If the point is at the end
+    # of one of them, we use that vertex exactly.
+    k = np.flatnonzero(~parallel)
+    w = a[j[k]] - a[i[k]]
+    t = (w[:, 0] * d_j[k, 1] - w[:, 1] * d_j[k, 0]) / denom[k]
+    s = (w[:, 0] * d_i[k, 1] - w[:, 1] * d_i[k, 0]) / denom[k]
+    p = a[i[k]] + t[:, None] * d_i[k]
+    for ends, param, length in (((a[i[k]], b[i[k]]), t, len_i[k]), ((a[j[k]], b[j[k]]), s, len_j[k])):
+        p = np.where((param * length <= EDGE_PRECISION)[:, None], ends[0], p)
+        p = np.where(((1 - param) * length <= EDGE_PRECISION)[:, None], ends[1], p)
+    for seg, param, length in ((i[k], t, len_i[k]), (j[k], s, len_j[k])):
+        hit = inside(param, length)
+        segment.append(seg[hit])
+        points.append(p[hit])
+
+    # Segments that overlap along a line: the ends of each one that are inside of the other
+    k = np.flatnonzero(parallel)
+    for seg, origin, d, length, ends in ((i[k], a[i[k]], d_i[k], len_i[k], (a[j[k]], b[j[k]])),
+                                         (j[k], a[j[k]], d_j[k], len_j[k], (a[i[k]], b[i[k]]))):
+        for end in ends:
+            w = end - origin
+            t = (w[:, 0] * d[:, 0] + w[:, 1] * d[:, 1]) / length ** 2
+            off = np.abs(w[:, 0] * d[:, 1] - w[:, 1] * d[:, 0]) / length
+            hit = inside(t, length) & (off <= EDGE_PRECISION)
+            segment.append(seg[hit])
+            points.append(end[hit])
+
+    return np.concatenate(segment), np.concatenate(points)
+
+
+def node_edges(u: np.ndarray, v: np.ndarray, owner: np.ndarray, xy: np.ndarray, loose: np.ndarray) -> tuple:
+    """
+    Splits the loose edges (the ones without a twin) where other loose edges touch or cross them.
+
+    Returns:
+        u, v, owner and xy, with the split edges replaced by their pieces, and the number of edges we split
+    """
+    a, b = xy[u[loose]], xy[v[loose]]
+    segments = shapely.linestrings(np.stack([a, b], axis=1))
+    i, j = shapely.STRtree(segments).query(segments, predicate='intersects')
+    keep = i < j
+    i, j = i[keep], j[keep]
+    segment, points = meeting_points(a, b, i, j)
+    if len(segment) == 0:
+        return u, v, owner, xy, 0
+
+    # Number the new vertices along with the old ones (a crossing gets the same number in both edges)
+    n_old = len(xy)
+    vertex, xy = number_vertices(np.concatenate([xy, points]))
+    u, v = vertex[u], vertex[v]
+    edge, new = loose[segment], vertex[n_old:]
+
+    # The new vertices along each edge, in order from its start, once each
+    d = xy[v[edge]] - xy[u[edge]]
+    t = ((xy[new] - xy[u[edge]]) * d).sum(axis=1)
+    order = np.lexsort((t, edge))
+    edge, new = edge[order], new[order]
+    keep = np.r_[True, (edge[1:] != edge[:-1]) | (new[1:] != new[:-1])] & (new != u[edge]) & (new != v[edge])
+    edge, new = edge[keep], new[keep]
+
+    # Each split edge becomes u -> new[0] -> new[1] ... -> v
+    first = np.r_[True, edge[1:] != edge[:-1]]
+    last = np.r_[edge[1:] != edge[:-1], True]
+    previous = np.empty_like(new)
+    previous[1:] = new[:-1]
+    previous[first] = u[edge[first]]
+    split = np.unique(edge)
+    kept = np.ones(len(u), dtype=bool)
+    kept[split] = False
+    u = np.concatenate([u[kept], previous, new[last]])
+    v = np.concatenate([v[kept], new, v[edge[last]]])
+    owner = np.concatenate([owner[kept], owner[edge], owner[edge[last]]])
+    return u, v, owner, xy, len(split)
+
+
+def side_neighbors(geoms: np.ndarray, u: np.ndarray, v: np.ndarray, owner: np.ndarray, xy: np.ndarray,
+                   edges: np.ndarray) -> np.ndarray:
+    """
+    For the edges that don't have a twin, the position in geoms of the unit catchment just to the right
+    of the middle of the edge (on the other side of it from its own unit catchment), or -1 if there isn't one.
+    """
+    a, b = xy[u[edges]], xy[v[edges]]
+    d = b - a
+    right = np.stack([d[:, 1], -d[:, 0]], axis=1) / np.hypot(*d.T)[:, None]
+    points = shapely.points((a + b) / 2 + right * SIDE_OFFSET)
+    point, geom = shapely.STRtree(geoms).query(points, predicate='intersects')
+    keep = geom != owner[edges[point]]
+    point, geom = point[keep], geom[keep]
+    result = np.full(len(edges), -1, dtype=np.int64)
+    _, first = np.unique(point, return_index=True)
+    result[point[first]] = geom[first]
+    return result
+
+
+def build_edge_index(catchments_gdf: gpd.GeoDataFrame, max_rounds: int = 5) -> dict:
+    """
+    Finds the edges of all of the unit catchments in a basin, and what is on the other side of each one.
+
+    Args:
+        catchments_gdf: the unit catchments, indexed by COMID
+        max_rounds: the number of times to split the edges that don't line up with a neighbour.
+            Each round can make new meeting points, though one or two rounds is usually enough.
+
+    Returns:
+        a dict of NumPy arrays, see the module docstring
+    """
+    t0 = time.perf_counter()
+    comids = np.sort(catchments_gdf.index.to_numpy())
+    geoms = catchments_gdf.geometry.loc[comids].to_numpy()
+    start, end, owner = ring_edges(geoms, return_index=True)
+    vertex, xy = number_vertices(np.concatenate([start, end]))
+    u, v = vertex[:len(start)], vertex[len(start):]
+    keep = u != v
+    u, v, owner = u[keep], v[keep], owner[keep]
+    if VERBOSE: print(f"  {len(u):,} edges and {len(xy):,} vertices, {time.perf_counter() - t0:.1f} s")
+
+    for k in range(max_rounds):
+        twin = find_twins(u, v, len(xy))
+        loose = np.flatnonzero(twin < 0)
+        if len(loose) == 0:
+            break
+        u, v, owner, xy, n_split = node_edges(u, v, owner, xy, loose)
+        if VERBOSE: print(f"  {len(loose):,} edges without a twin, split {n_split:,} of them, "
+                          f"{time.perf_counter() - t0:.1f} s")
+        if n_split == 0:
+            break
+    twin = find_twins(u, v, len(xy))
+
+    # The unit catchment on the other side of each edge
+    other = np.where(twin >= 0, owner[np.maximum(twin, 0)], -1)
+    loose = np.flatnonzero(twin < 0)
+    if len(loose) > 0:
+        other[loose] = side_neighbors(geoms, u, v, owner, xy, loose)
+    neighbor = np.where(other >= 0, comids[np.maximum(other, 0)], 0)
+    if VERBOSE: print(f"  {np.count_nonzero(other < 0):,} edges on the edge of the basin or a gap, "
+                      f"{time.perf_counter() - t0:.1f} s")
+
+    # Group the edges by unit catchment, and then by neighbour
+    order = np.lexsort((neighbor, owner))
+    u, v, owner, neighbor = u[order], v[order], owner[order], neighbor[order]
+    new_group = np.r_[True, (owner[1:] != owner[:-1]) | (neighbor[1:] != neighbor[:-1])]
+    group_start = np.flatnonzero(new_group)
+    group_owner = owner[group_start]
+
+    vertex_type = np.int32 if len(xy) < 2 ** 31 else np.int64
+    return {
+        'comid': comids,
+        'start': np.searchsorted(group_owner, np.arange(len(comids) + 1)).astype(np.int64),
+        'neighbor': neighbor[group_start],
+        'edge_start': np.r_[group_start, len(u)].astype(np.int64),
+        'u': u.astype(vertex_type),
+        'v': v.astype(vertex_type),
+        'x': xy[:, 0].copy(),
+        'y': xy[:, 1].copy(),
+        'source': np.array(signature(catchments_gdf)),
+    }
+
+
+def save_edge_index(index: dict, basin: int, high_resolution: bool):
+    fname = get_edge_index_filename(basin, high_resolution)
+    if VERBOSE: print(f"Saving edge index to: {fname}")
+    np.savez(fname, **index)
+
+
+def load_edge_index(basin: int, high_resolution: bool, source: str = None) -> dict or None:
+    """
+    Returns the edge index for a basin, or None if it has not been built.
+    Run `python prepare_data.py edges` to build it.
+    If `source` is given (from py.signature.signature()), also returns None if it was built from other data.
+    """
+    if PICKLE_DIR == '':
+        return None
+    fname = get_edge_index_filename(basin, high_resolution)
+    if not os.path.isfile(fname):
+        return None
+    if VERBOSE: print(f"Fetching BASIN # {basin} edge index from {fname}")
+    with np.load(fname) as npz:
+        index = {key: npz[key] for key in npz.files}
+    saved = str(index['source']) if 'source' in index else None
+    if source is not None and not matches(saved, source, fname):
+        return None
+    return index
+
+
+def ranges(starts: np.ndarray, stops: np.ndarray) -> np.ndarray:
+    """All of the numbers in the ranges starts[i]:stops[i], one after the other."""
+    lengths = stops - starts
+    return np.arange(lengths.sum()) + np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+
+
+def stitch_rings(u: np.ndarray, v: np.ndarray, x: np.ndarray, y: np.ndarray) -> list or None:
+    """
+    Joins up the edges u -> v into closed rings of vertices. Returns None if they don't make closed rings.
+
+    Where the outline touches itself at a vertex, there is more than one way to go on from it. We take the
+    edge that turns the farthest to the left, which keeps to the same corner of the polygon (it is on the left
+    of the edges), so that two pieces that touch at a corner come out as separate rings. If that comes back to
+    a vertex that it has already been to (a hole that touches the outside at a corner), we cut the loop there,
+    so that the hole is a ring of its own.
+    """
+    n = len(u)
+    into, out_of = np.argsort(v, kind='stable'), np.argsort(u, kind='stable')
+    if n == 0 or not np.array_equal(v[into], u[out_of]):
+        return None
+    following = np.empty(n, dtype=np.int64)
+    following[into] = out_of
+
+    sorted_u = u[out_of]
+    lo = np.searchsorted(sorted_u, v, side='left')
+    hi = np.searchsorted(sorted_u, v, side='right')
+    corners = np.flatnonzero(hi - lo > 1)
+    if len(corners) > 0:
+        # Each edge into a corner, with each of the edges out of it
+        edge = np.repeat(corners, hi[corners] - lo[corners])
+        candidate = out_of[ranges(lo[corners], hi[corners])]
+        back = np.arctan2(y[u[edge]] - y[v[edge]], x[u[edge]] - x[v[edge]])
+        out = np.arctan2(y[v[candidate]] - y[u[candidate]], x[v[candidate]] - x[u[candidate]])
+        # The angle from going back the way we came, clockwise, to the edge out
+        clockwise = np.mod(back - out, 2 * np.pi)
+        clockwise[clockwise <= 0] = 2 * np.pi
+        best = np.lexsort((clockwise, edge))
+        first = np.r_[True, edge[best][1:] != edge[best][:-1]]
+        turns = following.copy()
+        turns[edge[best][first]] = candidate[best][first]
+        if len(np.unique(turns)) == n:
+            following = turns
+
+    following = following.tolist()
+    start = u.tolist()
+    visited = [False] * n
+    rings = []
+    for e in range(n):
+        path, position = [], {}
+        while not visited[e]:
+            visited[e] = True
+            vertex = start[e]
+            if vertex in position:
+                k = position[vertex]
+                rings.append(path[k:])
+                for other in path[k + 1:]:
+                    del position[other]
+                del path[k + 1:]
+            else:
+                position[vertex] = len(path)
+                path.append(vertex)
+            e = following[e]
+        if len(path) > 0:
+            rings.append(path)
+    return rings
+
+
+def make_polygons(rings: list, x: np.ndarray, y: np.ndarray) -> Polygon or MultiPolygon or None:
+    """
+    Makes the (Multi)Polygon from rings of vertices: counter-clockwise rings are the outsides,
+    and clockwise rings are holes in the smallest outside that they are in. Returns None if that doesn't work.
+    """
+    ring_lengths = np.array([len(ring) for ring in rings])
+    vertices = np.concatenate(rings)
+    ring = np.repeat(np.arange(len(rings)), ring_lengths)
+    first = np.cumsum(ring_lengths) - ring_lengths
+    following = np.arange(len(vertices)) + 1
+    following[first + ring_lengths - 1] = first
+    xs, ys = x[vertices], y[vertices]
+    area2 = np.bincount(ring, weights=xs * ys[following] - xs[following] * ys, minlength=len(rings))
+
+    coords = np.stack([xs, ys], axis=1)
+    polygons = shapely.polygons(shapely.linearrings(coords, indices=ring))
+    shells, holes = np.flatnonzero(area2 > 0), np.flatnonzero(area2 < 0)
+    if len(shells) == 0:
+        return None
+
+    holes_of = {shell: [] for shell in shells}
+    if len(holes) > 0:
+        hole, shell = shapely.STRtree(polygons[shells]).query(polygons[holes], predicate='covered_by')
+        shell = shells[shell]
+        best = np.lexsort((area2[shell], hole))
+        hole, shell = hole[best], shell[best]
+        first_shell = np.r_[True, hole[1:] != hole[:-1]]
+        if np.count_nonzero(first_shell) != len(holes):
+            return None
+        for h, s in zip(holes[hole[first_shell]], shell[first_shell]):
+            holes_of[s].append(shapely.get_exterior_ring(polygons[h]))
+
+    parts = [Polygon(shapely.get_exterior_ring(polygons[s]), holes_of[s]) for s in shells]
+    result = parts[0] if len(parts) == 1 else MultiPolygon(parts)
+    return result if result.is_valid else None
+
+
+def outline(index: dict, comids: np.ndarray) -> Polygon or MultiPolygon or None:
+    """
+    The union of some of the unit catchments, from the index (see the module docstring).
+    Returns None if some of them are not in the index, or if the edges don't make a valid polygon.
+    """
+    comids = np.unique(comids)
+    rows = np.minimum(np.searchsorted(index['comid'], comids), len(index['comid']) - 1)
+    if len(comids) == 0 or not np.array_equal(index['comid'][rows], comids):
+        return None
+
+    groups = ranges(index['start'][rows], index['start'][rows + 1])
+    groups = groups[~np.isin(index['neighbor'][groups], comids)]
+    edges = ranges(index['edge_start'][groups], index['edge_start'][groups + 1])
+    rings = stitch_rings(index['u'][edges], index['v'][edges], index['x'], index['y'])
+    if rings is None:
+        return None
+    return make_polygons(rings, index['x'], index['y'])
+
+
+def dissolve_indexed(index: dict, df: gpd.GeoDataFrame, catchments_gdf: gpd.GeoDataFrame) -> \
+        Polygon or MultiPolygon or None:
+    """
+    Dissolves the polygons in df, using the index for the rows that are unit catchments.
+
+    The other rows (the split terminal unit catchment in high-res mode, pre-dissolved pieces,
+    and the watersheds of outlets upstream) are dissolved with the outline using union_edges().
+    A row is a unit catchment if its geometry is the very same object as in catchments_gdf, so a polygon
+    that was changed is never mistaken for the unit catchment.
+
+    Returns None if the index can't be used, so that the caller can fall back to union_edges().
+    """
+    geoms = df.geometry.to_numpy()
+    originals = catchments_gdf.geometry.reindex(df.index).to_numpy()
+    is_unit = np.array([g is o for g, o in zip(geoms, originals)], dtype=bool)
+    if not is_unit.any():
+        return None
+
+    poly = outline(index, df.index.to_numpy()[is_unit])
+    if poly is None:
+        return None
+    if is_unit.all():
+        return poly
+    return union_edges(np.concatenate([[poly], geoms[~is_unit]]))
@@ -15,12 +15,42 @@ output: a geopandas dataseries with a single polygon
 with no internal rings or "donut holes," which is what I was looking for
 with my watershed boundaries. 
 
+For big watersheds, the clip and the buffers are slow, so there are a few other ways to do it now,
+using shapely 2 (see dissolve()). Pick one with DISSOLVE_METHOD in config.py, and compare them
+with benchmarks/bench_dissolve.py.
+
 """
 
+import multiprocessing
+import numpy as np
 import geopandas as gpd
+import shapely
 from shapely.geometry import Polygon, MultiPolygon
+from config import *
 gpd.options.use_pygeos = True
 
+# The ways that we can dissolve the unit catchments into a watershed (see dissolve)
+DISSOLVE_METHODS = ("clip", "coverage", "snap", "edges")
+
+# For the "snap" method, the size of the grid that the coordinates are snapped to, in decimal degrees (about 1 cm).
+# The MERIT-Basins vertices are on the corners of the 3 arcsecond pixels, so this does not move them
+# by any amount that matters, but it makes neighbouring catchments meet exactly.
+SNAP_GRID_SIZE = 1e-7
+
+# For the "edges" method, vertices that round to the same multiple of this (in decimal degrees) are the same
+EDGE_PRECISION = 1e-9
+
+# For dissolve_parallel(): a rough guess of the memory that dissolving takes, per vertex of the input polygons
+# (the GEOS copies of the polygons, and the intermediate results)
+BYTES_PER_VERTEX = 200
+
+# and the smallest chunk that we make, however little memory there is
+MIN_CHUNK_SIZE = 100
+
+# The polygons and options for the worker processes in dissolve_parallel(). We set these just before starting
+# the workers, which are forked, so they share this memory with the main process instead of getting a copy.
+parallel_state = {}
+
 
 def buffer(poly: Polygon) -> Polygon:
     """
@@ -45,6 +75,7 @@ def close_holes(poly: Polygon or MultiPolygon, area_max: float) -> Polygon or Mu
                   so this needs to be in square decimal degrees...
     Example:
         df.geometry.apply(lambda p: close_holes(p))
+    For a whole array or GeoSeries of polygons, fill_holes() does the same thing much faster.
     """
 
     if isinstance(poly, Polygon):
@@ -88,9 +119,63 @@ def dissolve_shp(shp: str) -> gpd.GeoDataFrame:
     return dissolve_geopandas(df)
 
 
-def fill_geopandas(gdf: gpd.GeoDataFrame, area_max: float) -> gpd.GeoDataFrame:
-    filled = gdf.geometry.apply(lambda p: close_holes(p, area_max))
-    return filled
+def fill_holes(geoms: np.ndarray, area_max: float) -> np.ndarray:
+    """
+    Same as close_holes() for every polygon in an array, all at once with shapely 2, instead of one at a time:
+    fills the holes with an area less than or equal to area_max (in square decimal degrees),
+    or all of the holes if area_max is 0. MultiPolygons stay MultiPolygons.
+    The polygons that don't have any holes to fill are returned as they are.
+
+    Works on any number of polygons, e.g. a watershed, or all of the unit catchments in a basin:
+        catchments_gdf.geometry = fill_holes(catchments_gdf.geometry.to_numpy(), 0)
+    """
+    geoms = np.asarray(geoms, dtype=object)
+    type_id = shapely.get_type_id(geoms)
+    if not np.isin(type_id, [shapely.GeometryType.POLYGON, shapely.GeometryType.MULTIPOLYGON]).all():
+        raise ValueError("Unsupported geometry type")
+
+    # Every hole of every part
+    parts, part_of = shapely.get_parts(geoms, return_index=True)
+    n_holes = shapely.get_num_interior_rings(parts)
+    hole_part = np.repeat(np.arange(len(parts)), n_holes)
+    hole_number = np.arange(len(hole_part)) - np.repeat(np.cumsum(n_holes) - n_holes, n_holes)
+    holes = shapely.get_interior_ring(parts[hole_part], hole_number)
+    if area_max == 0:
+        keep = np.zeros(len(holes), dtype=bool)
+    else:
+        keep = shapely.area(shapely.polygons(holes)) > area_max
+
+    # Only remake the geometries that lose a hole
+    changed_part = np.zeros(len(parts), dtype=bool)
+    changed_part[hole_part[~keep]] = True
+    changed = np.zeros(len(geoms), dtype=bool)
+    changed[part_of[changed_part]] = True
+    if not changed.any():
+        return geoms.copy()
+
+    # The new parts: the exterior ring, then the holes that we keep
+    redo = np.flatnonzero(changed[part_of])
+    kept_holes = np.flatnonzero(keep & changed[part_of[hole_part]])
+    rings = np.concatenate([shapely.get_exterior_ring(parts[redo]), holes[kept_holes]])
+    ring_part = np.concatenate([redo, hole_part[kept_holes]])
+    order = np.argsort(ring_part, kind='stable')
+    new_parts = shapely.polygons(rings[order], indices=np.searchsorted(redo, ring_part[order]))
+
+    result = geoms.copy()
+    is_multi = type_id == shapely.GeometryType.MULTIPOLYGON
+    single = changed & ~is_multi
+    result[single] = new_parts[np.searchsorted(part_of[redo], np.flatnonzero(single))]
+    multi = np.flatnonzero(changed & is_multi)
+    if len(multi) > 0:
+        in_multi = np.isin(part_of[redo], multi)
+        result[multi] = shapely.multipolygons(new_parts[in_multi],
+                                              indices=np.searchsorted(multi, part_of[redo][in_multi]))
+    return result
+
+
+def fill_geopandas(gdf: gpd.GeoDataFrame or gpd.GeoSeries, area_max: float) -> gpd.GeoSeries:
+    """Fills the holes in the polygons, see fill_holes(). Returns a GeoSeries with the same index."""
+    return gpd.GeoSeries(fill_holes(gdf.geometry.to_numpy(), area_max), index=gdf.index, crs=gdf.crs)
 
 
 def dissolve_geopandas(df: gpd.GeoDataFrame) -> gpd.GeoDataFrame:
@@ -124,4 +209,261 @@ def dissolve_geopandas(df: gpd.GeoDataFrame) -> gpd.GeoDataFrame:
 
     clipped = clipped.geometry.apply(lambda p: buffer(p))
 
-    return clipped
\ No newline at end of file
+    return clipped
+
+
+def dissolve(df: gpd.GeoDataFrame, method: str = None, edge_index: dict = None,
+             catchments_gdf: gpd.GeoDataFrame = None) -> gpd.GeoSeries:
+    """
+    Dissolves the polygons in a GeoDataFrame into one. Returns a GeoSeries with a single (Multi)Polygon,
+    like dissolve_geopandas().
+
+    Args:
+        df: the polygons, e.g. the unit catchments in a watershed
+        method: one of DISSOLVE_METHODS. If None, uses DISSOLVE_METHOD in config.py.
+            "clip":     clip a big rectangle with the polygons, then buffer out and in to remove the little
+                        artifacts from MERIT-Basins topology errors (see dissolve_geopandas). The original method.
+            "coverage": shapely's coverage union (see union_coverage)
+            "snap":     shapely's union, with the coordinates snapped to a fine grid (see union_snapped)
+            "edges":    drop the edges that are shared by two polygons, and stitch together the rest
+                        (see union_edges)
+            The last 3 don't do the buffers, so tiny gaps between unit catchments can show up as holes
+            (which FILL takes care of).
+        edge_index: for the "edges" method, the edge index of the basin, if it has been built
+            (see py/edge_index.py). Then we only look at the edges on the outline of the unit catchments.
+        catchments_gdf: the unit catchments of the basin, which the edge index was made from
+    """
+    if method is None:
+        method = DISSOLVE_METHOD
+    if method == "clip":
+        return dissolve_geopandas(df)
+
+    geoms = df.geometry.to_numpy()
+    if method == "coverage":
+        poly = union_coverage(geoms)
+    elif method == "snap":
+        poly = union_snapped(geoms)
+    elif method == "edges":
+        poly = None
+        if edge_index is not None and catchments_gdf is not None:
+            from py.edge_index import dissolve_indexed
+            poly = dissolve_indexed(edge_index, df, catchments_gdf)
+        if poly is None:
+            poly = union_edges(geoms)
+    else:
+        raise Exception(f"Unknown dissolve method: '{method}'. Please use one of: {', '.join(DISSOLVE_METHODS)}")
+    return gpd.GeoSeries([poly], crs=df.crs)
+
+
+def union_snapped(geoms: np.ndarray) -> Polygon or MultiPolygon:
+    """
+    The union of the polygons, with the coordinates snapped to a grid of SNAP_GRID_SIZE.
+    Snapping makes the union more robust to the near-misses between neighbours in MERIT-Basins.
+    """
+    return shapely.union_all(geoms, grid_size=SNAP_GRID_SIZE)
+
+
+def union_coverage(geoms: np.ndarray) -> Polygon or MultiPolygon:
+    """
+    The union of polygons that form a "coverage": they don't overlap, and neighbours have exactly the same
+    vertices along the edges that they share. GEOS only has to drop the shared edges, which is much faster
+    than a general union. MERIT-Basins is nearly, but not always, a valid coverage. Where it isn't,
+    the result can be invalid, and then we fall back to union_snapped().
+    """
+    try:
+        result = shapely.coverage_union_all(geoms)
+    except shapely.errors.GEOSException:
+        result = None
+    if result is None or result.is_empty or not result.is_valid:
+        return union_snapped(geoms)
+    return result
+
+
+def ring_edges(geoms: np.ndarray, return_index: bool = False) -> (np.ndarray, np.ndarray):
+    """
+    Returns the edges of all of the rings of the polygons, as arrays of the (x, y) of their start and end,
+    each going around with its polygon on the left: counter-clockwise around the outside, clockwise around holes.
+    With return_index=True, also returns the position in geoms of the polygon that each edge came from.
+    """
+    polys, owner = shapely.get_parts(geoms, return_index=True)
+    is_polygon = shapely.get_type_id(polys) == shapely.GeometryType.POLYGON
+    polys, owner = polys[is_polygon], owner[is_polygon]
+
+    # The exterior rings, then the interior rings (holes) of every polygon
+    n_holes = shapely.get_num_interior_rings(polys)
+    hole_poly = np.repeat(np.arange(len(polys)), n_holes)
+    hole_number = np.arange(len(hole_poly)) - np.repeat(np.cumsum(n_holes) - n_holes, n_holes)
+    rings = np.concatenate([shapely.get_exterior_ring(polys), shapely.get_interior_ring(polys[hole_poly], hole_number)])
+    is_hole = np.arange(len(rings)) >= len(polys)
+
+    coords, ring = shapely.get_coordinates(rings, return_index=True)
+    same_ring = ring[1:] == ring[:-1]
+    start, end, ring = coords[:-1][same_ring], coords[1:][same_ring], ring[:-1][same_ring]
+
+    # Twice the signed area of each ring (the shoelace formula): positive if it goes counter-clockwise
+    cross = start[:, 0] * end[:, 1] - end[:, 0] * start[:, 1]
+    area2 = np.bincount(ring, weights=cross, minlength=len(rings))
+    flip = ((area2 < 0) != is_hole)[ring]
+    start, end = np.where(flip[:, None], end, start), np.where(flip[:, None], start, end)
+    if return_index:
+        return start, end, np.concatenate([owner, owner[hole_poly]])[ring]
+    return start, end
+
+
+def cancel_shared_edges(start: np.ndarray, end: np.ndarray) -> (np.ndarray, np.ndarray):
+    """
+    Drops the edges that are shared by two polygons. A shared edge goes one way around one polygon,
+    and the other way around its neighbour (see ring_edges), so we count each edge forwards and backwards,
+    and keep the ones that don't cancel out. These are the edges of the outer boundary and the holes.
+    """
+    n = len(start)
+    if n == 0:
+        return start, end
+    points = np.concatenate([start, end])
+    _, first, vertex = np.unique(np.round(points / EDGE_PRECISION).astype(np.int64), axis=0,
+                                 return_index=True, return_inverse=True)
+    vertex = vertex.ravel()
+    u, v = vertex[:n], vertex[n:]
+    keep = u != v
+    u, v = u[keep], v[keep]
+
+    lo, hi = np.minimum(u, v), np.maximum(u, v)
+    keys, edge = np.unique(lo * np.int64(len(first)) + hi, return_inverse=True)
+    net = np.bincount(edge.ravel(), weights=np.where(u < v, 1, -1), minlength=len(keys))
+
+    # One copy of each edge that is left, going the way that it went more often
+    remaining = np.flatnonzero(net != 0)
+    lo, hi = keys[remaining] // len(first), keys[remaining] % len(first)
+    forwards = (net[remaining] > 0)[:, None]
+    lo_xy, hi_xy = points[first[lo]], points[first[hi]]
+    return np.where(forwards, lo_xy, hi_xy), np.where(forwards, hi_xy, lo_xy)
+
+
+def union_edges(geoms: np.ndarray) -> Polygon or MultiPolygon:
+    """
+    The union of the polygons, made from the edges that are not shared by two of them (see cancel_shared_edges).
+    What's left is the outer boundary and the holes, plus any edges where neighbours don't quite match.
+    We node these lines, make polygons out of them, and keep the ones that are inside of the input polygons.
+    Falls back to union_snapped() if that doesn't give us anything.
+    """
+    start, end = cancel_shared_edges(*ring_edges(geoms))
+    if len(start) == 0:
+        return union_snapped(geoms)
+
+    lines = shapely.linestrings(np.stack([start, end], axis=1))
+    faces = shapely.get_parts(shapely.polygonize(shapely.get_parts(shapely.union_all(lines))))
+    if len(faces) == 0:
+        return union_snapped(geoms)
+
+    # The faces are either all inside of the union, or all outside (in a hole or a gap between catchments)
+    tree = shapely.STRtree(geoms)
+    face, _ = tree.query(shapely.point_on_surface(faces), predicate='intersects')
+    faces = faces[np.unique(face)]
+    if len(faces) == 0:
+        return union_snapped(geoms)
+    return shapely.coverage_union_all(faces) if len(faces) > 1 else faces[0]
+
+
+def hilbert_distance(x: np.ndarray, y: np.ndarray, order: int = 16) -> np.ndarray:
+    """
+    The position of each point along a Hilbert curve that fills the bounding box of the points,
+    on a grid of 2^order x 2^order cells. Points that are close together on the curve are close together
+    on the map, so consecutive runs of points sorted this way make compact chunks.
+    """
+    n = 2 ** order
+    span_x, span_y = max(x.max() - x.min(), 1e-12), max(y.max() - y.min(), 1e-12)
+    xi = np.minimum(((x - x.min()) / span_x * n).astype(np.int64), n - 1)
+    yi = np.minimum(((y - y.min()) / span_y * n).astype(np.int64), n - 1)
+
+    d = np.zeros(len(x), dtype=np.int64)
+    s = n // 2
+    while s > 0:
+        rx = (xi & s) > 0
+        ry = (yi & s) > 0
+        d += s * s * ((3 * rx) ^ ry)
+        # Rotate the quadrant, so that the curve inside of it is in the standard orientation
+        flip = ~ry & rx
+        xi = np.where(flip, n - 1 - xi, xi)
+        yi = np.where(flip, n - 1 - yi, yi)
+        swap = ~ry
+        xi, yi = np.where(swap, yi, xi), np.where(swap, xi, yi)
+        s //= 2
+    return d
+
+
+def make_chunks(geoms: np.ndarray, chunk_size: int) -> list:
+    """Splits the polygons into chunks of about chunk_size neighbouring polygons. Returns the positions in each."""
+    bounds = shapely.bounds(geoms)
+    order = np.argsort(hilbert_distance((bounds[:, 0] + bounds[:, 2]) / 2, (bounds[:, 1] + bounds[:, 3]) / 2),
+                       kind='stable')
+    n_chunks = int(np.ceil(len(geoms) / chunk_size))
+    return np.array_split(order, n_chunks)
+
+
+def dissolve_chunk(chunk: np.ndarray) -> bytes:
+    """Runs in a worker: dissolves one chunk of the polygons, and returns the result as WKB."""
+    state = parallel_state
+    poly = dissolve(state['df'].iloc[np.sort(chunk)], state['method'], state['edge_index'],
+                    state['catchments_gdf']).values[0]
+    return shapely.to_wkb(poly)
+
+
+def merge_pair(pair: tuple) -> bytes:
+    """Runs in a worker: dissolves two of the polygons that we have made so far, given as WKB."""
+    polys = gpd.GeoDataFrame(geometry=shapely.from_wkb(list(pair)), crs=parallel_state['df'].crs)
+    return shapely.to_wkb(dissolve(polys, parallel_state['method']).values[0])
+
+
+def dissolve_parallel(df: gpd.GeoDataFrame, method: str = None, workers: int = None, chunk_size: int = None,
+                      memory_mb: float = None, edge_index: dict = None,
+                      catchments_gdf: gpd.GeoDataFrame = None) -> gpd.GeoSeries:
+    """
+    Like dissolve(), but for a lot of polygons, splits them into chunks of neighbouring polygons
+    (in the order of a Hilbert curve through their bounding boxes), dissolves the chunks in a pool of
+    worker processes, and then merges the results two at a time, neighbours with neighbours,
+    in a tree, until there is one polygon left.
+
+    Falls back to dissolve() if there are no more than chunk_size polygons, if workers is 1, in a process
+    that is already a worker (e.g. with WORKERS > 1), or where we can't fork processes (Windows).
+
+    Args:
+        df, method, edge_index, catchments_gdf: see dissolve()
+        workers: number of worker processes. If None, uses DISSOLVE_WORKERS in config.py
+        chunk_size: number of polygons per chunk. If None, uses DISSOLVE_CHUNK_SIZE in config.py
+        memory_mb: roughly how much memory the workers can use together, in megabytes, or 0 for no limit.
+            If the chunks would need more than that, we make them smaller (see BYTES_PER_VERTEX).
+            If None, uses DISSOLVE_MEMORY_MB in config.py
+    """
+    if method is None:
+        method = DISSOLVE_METHOD
+    if workers is None:
+        workers = DISSOLVE_WORKERS
+    if chunk_size is None:
+        chunk_size = DISSOLVE_CHUNK_SIZE
+    if memory_mb is None:
+        memory_mb = DISSOLVE_MEMORY_MB
+
+    if workers <= 1 or len(df) <= chunk_size or multiprocessing.current_process().daemon or \
+            'fork' not in multiprocessing.get_all_start_methods():
+        return dissolve(df, method, edge_index, catchments_gdf)
+
+    geoms = df.geometry.to_numpy()
+    if memory_mb > 0:
+        per_polygon = shapely.get_num_coordinates(geoms).sum() * BYTES_PER_VERTEX / len(geoms)
+        chunk_size = max(MIN_CHUNK_SIZE, min(chunk_size, int(memory_mb * 1e6 / workers / per_polygon)))
+    chunks = make_chunks(geoms, chunk_size)
+    workers = min(workers, len(chunks))
+    if VERBOSE: print(f"  dissolving {len(df):,} polygons in {len(chunks)} chunks, with {workers} workers")
+
+    parallel_state.update(df=df, method=method, edge_index=edge_index, catchments_gdf=catchments_gdf)
+    try:
+        with multiprocessing.get_context('fork').Pool(workers) as pool:
+            polys = pool.map(dissolve_chunk, chunks, chunksize=1)
+            # Merge the neighbouring pairs, until there is one left. Chunks that are next to each other
+            # on the Hilbert curve are next to each other on the map, and so are the merged pairs.
+            while len(polys) > 1:
+                merged = pool.map(merge_pair, zip(polys[0::2], polys[1::2]), chunksize=1)
+                polys = merged + polys[len(merged) * 2:]
+    finally:
+        parallel_state.clear()
+    return gpd.GeoSeries([shapely.from_wkb(polys[0])], crs=df.crs)
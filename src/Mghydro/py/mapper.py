@@ -27,12 +27,13 @@ def create_folder_if_not_exists(folder_path: str) -> bool:
         print(f"Error creating folder: {e}")
         return False
 
-def make_map(df: pd.DataFrame) -> bool:
+def make_map(df: pd.DataFrame, map_folder: str = MAP_FOLDER) -> bool:
     """
 
     input:
         df: a Pandas dataframe with the cols [id, lat, lng, name, area_reported, area_calc_sqkm,
         result]
+        map_folder: where to write _viewer.html
 
     returns:
         True if it successfully wrote the file viewer.html.
@@ -78,7 +79,7 @@ def make_map(df: pd.DataFrame) -> bool:
     df = df[df.result != 'failed']
 
     # Use a jinja template to create the html file
-    template_file = "py/viewer_template.html"
+    template_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), "viewer_template.html")
     with open(template_file, 'r') as f:
         template_str = f.read()
 
@@ -109,9 +110,9 @@ def make_map(df: pd.DataFrame) -> bool:
     )
 
     # Make sure the folder is there. If not, try to create it.
-    create_folder_if_not_exists(MAP_FOLDER)
+    create_folder_if_not_exists(map_folder)
 
-    viewer_fname = f"{MAP_FOLDER}/_viewer.html"
+    viewer_fname = f"{map_folder}/_viewer.html"
     f = open(viewer_fname, 'w')
     f.write(html)
     f.close()
@@ -7,17 +7,31 @@ Raster-based delineation is slow and requires a lot of memory. So we only do the
 and use vector data for the rest of the upstream watershed.
 """
 import os
+import numpy as np
 from numpy import floor, ceil
 from pysheds.grid import Grid
 from shapely.geometry import Polygon, MultiPolygon
 from shapely import wkb, ops
 
 from py.raster_plots import *
-from config import *
+from py.settings import Settings
+import py.raster_cache as raster_cache
+import py.d8_trace as d8_trace
+import py.raster_boundary as raster_boundary
+import py.split_cache as split_cache
+import py.catchment_labels as catchment_labels
+
+# Distance of a half-pixel in the MERIT-Hydro rasters (3 arcseconds), in decimal degrees
+HALFPIX = 0.000416667
+
+# MERIT-Hydro flow direction uses the old ESRI standard for flow direction...
+DIRMAP = (64, 128, 1, 2, 4, 8, 16, 32)
 
 
 def split_catchment(wid: str, basin: int, lat: float, lng: float, catchment_poly: Polygon,
-                    bSingleCatchment: bool) -> (object or None, float, float):
+                    bSingleCatchment: bool, settings: Settings = None,
+                    snap_memo: dict = None, snapped: tuple = None,
+                    comid: int = None) -> (object or None, float, float):
     """
     Performs the detailed pixel-scale raster-based delineation for a watershed.
 
@@ -34,6 +48,14 @@ def split_catchment(wid: str, basin: int, lat: float, lng: float, catchment_poly
         catchment_poly: a Shapely polygon; we'll use it to clip the flow accumulation raster to get an accurate snap
         bSingleCatchment: is the watershed small, i.e. there is only one unit catchment in it?
             If so, we'll use a lower snap threshold for the outlet.
+        settings: see py/settings.py. If None, uses the values in config.py
+        snap_memo: optional dict for the results in this unit catchment, keyed by the snapped pour point.
+            If another outlet in the same unit catchment already snapped to the same pixel, we return
+            its polygon, and skip the (slow) raster delineation.
+        snapped: optional (lng_snap, lat_snap), if we already snapped the outlet with the stream pixel index
+            (see py/stream_index.py). Then we don't need to read the accumulation raster.
+        comid: optional COMID of the terminal unit catchment. If we have the pre-rasterized unit catchments
+            for the basin (see py/catchment_labels.py), we use them to mask the rasters.
 
     Returns:
         poly: a shapely polygon representing the part of the terminal unit catchment that is upstream of the
@@ -68,37 +90,221 @@ def split_catchment(wid: str, basin: int, lat: float, lng: float, catchment_poly
     the key to getting accurate results!
     """
 
-    # Get a bounding box for the unit catchment
-    bounds = catchment_poly.bounds
-    bounds_list = [float(i) for i in bounds]
+    if settings is None:
+        settings = Settings.from_config()
 
-    # The coordinates of the bounding box edges that we get from the above query
-    # do not correspond well with the edges of the grid pixels.
-    # We need to round them to the nearest whole pixel and then
-    # adjust them by a half-pixel width to get good results in pysheds.
+    # Snap the outlet to the nearest stream. This depends entirely on the threshold (see get_threshold)
+    numpixels = get_threshold(bSingleCatchment, settings)
 
-    # Distance of a half-pixel
-    halfpix = 0.000416667
+    # Look for the result of an earlier run (see py/split_cache.py). (Not with the plots, which we would skip.)
+    use_cache = settings.split_cache != '' and not settings.plots
+    if use_cache:
+        cache_snap_key = split_cache.snap_key(basin, catchment_poly, lat, lng, numpixels, settings)
+        if snapped is None:
+            snapped = split_cache.get_snap(cache_snap_key, settings)
+        if snapped is not None:
+            result = split_cache.get_split(split_cache.split_key(basin, catchment_poly, *snapped, settings), settings)
+            if result is not None:
+                if settings.verbose: print("Found the split catchment in the split cache")
+                return result
 
-    # Bounding box is xmin, ymin, xmax, ymax
-    # round the elements DOWN, DOWN, UP, UP
-    # The number 1200 is because the MERIT-Hydro rasters have 3 arsecond resolution, or 1/1200 of a decimal degree.
-    # So we just multiply it by 1200, round up or down to the nearest whole number, then divide by 1200
-    # to put it back in its regular units of decimal degrees. Then, since pysheds wants the *center*
-    # of the pixel, not its edge, add or subtract a half-pixel width as appropriate.
-    # This took me a while to figure out but was essential to getting results that look correct
-    bounds_list[0] = floor(bounds_list[0] * 1200) / 1200 - halfpix
-    bounds_list[1] = floor(bounds_list[1] * 1200) / 1200 - halfpix
-    bounds_list[2] = ceil( bounds_list[2] * 1200) / 1200 + halfpix
-    bounds_list[3] = ceil( bounds_list[3] * 1200) / 1200 + halfpix
+    # We only need the accumulation raster for snapping (and the plots)
+    grid, fdir, acc = read_windows(wid, basin, lat, lng, catchment_poly, settings,
+                                   accumulation=snapped is None or settings.plots, comid=comid)
 
-    # The bounding box needs to be a tuple for pysheds.
-    bounding_box = tuple(bounds_list)
+    if settings.verbose: print("Using threshold of {} for number of upstream pixels.".format(numpixels))
+
+    if snapped is not None:
+        lng_snap, lat_snap = snapped
+    else:
+        # Snap the pour point to a point on the accumulation grid where accum (# of upstream pixels)
+        # is greater than our threshold
+        streams = acc > numpixels
+        xy = (lng, lat)
+        try:
+            [lng_snap, lat_snap] = grid.snap_to_mask(streams, xy)  # New version does not give you the snap distance.
+        except Exception as e:
+            if settings.verbose: print(f"Could not snap the pour point. Error: {e}")
+            return None, None, None
+        if use_cache:
+            split_cache.put_snap(cache_snap_key, basin, lng_snap, lat_snap, settings)
+
+    # Outlets that snap to the same pixel have the same watershed
+    snap_key = (lng_snap, lat_snap)
+    if snap_memo is not None and snap_key in snap_memo:
+        if settings.verbose: print("Outlet snapped to the same pixel as a previous outlet; reusing its polygon")
+        return snap_memo[snap_key]
+
+    # Plot the accumulation grid, for debugging
+    if settings.plots:
+        plot_accum(acc, lat, lng, lat_snap, lng_snap, wid, catchment_poly)
+
+    # Plot the streams!
+    if settings.plots:
+        streams = acc > numpixels
+        plot_streams(streams, catchment_poly, lat, lng, lat_snap, lng_snap, wid, numpixels)
+
+    # Finally, here is the raster based watershed delineation with pysheds!
+    if settings.verbose: print("Delineating catchment")
+    try:
+        if settings.tracer == "pysheds":
+            catch = grid.catchment(fdir=fdir,
+                                   x=lng_snap,
+                                   y=lat_snap,
+                                   dirmap=DIRMAP,
+                                   xytype='coordinate',
+                                   recursionlimit=15000)
+        else:
+            # Our own tracer, which does not use recursion (see py/d8_trace.py)
+            catch = d8_trace.catchment(grid, fdir, lng_snap, lat_snap, DIRMAP)
+
+        # Clip the bounding box to the catchment
+        # Seems optional, but turns out this line is essential.
+        grid.clip_to(catch)
+        clipped_catch = grid.view(catch, dtype=np.uint8)
+    except Exception as e:
+        if settings.verbose: print(f"ERROR: something went wrong during the catchment delineation. Error: {e}")
+        return None, lng_snap, lat_snap
+
+    result_polygon = polygonize_catchment(grid, clipped_catch, wid, settings)
+    if use_cache:
+        split_cache.put_split(split_cache.split_key(basin, catchment_poly, lng_snap, lat_snap, settings), basin,
+                              (result_polygon, lat_snap - HALFPIX, lng_snap + HALFPIX), settings)
+
+    # The snapped vertices look better if we nudge them one half pixels
+    lng_snap += HALFPIX
+    lat_snap -= HALFPIX
+
+    if settings.plots:
+        plot_catchment(catch, catchment_poly, result_polygon, lat, lng, lat_snap, lng_snap, wid, DIRMAP)
+        plot_clipped(fdir, clipped_catch, catchment_poly, lat, lng, lat_snap, lng_snap, wid, result_polygon)
+
+    if snap_memo is not None:
+        snap_memo[snap_key] = (result_polygon, lat_snap, lng_snap)
+
+    return result_polygon, lat_snap, lng_snap
+
+
+def split_catchment_batch(outlets: list, basin: int, catchment_poly: Polygon, bSingleCatchment: bool,
+                          settings: Settings = None, snapped: np.ndarray = None, comid: int = None) -> list:
+    """
+    Same as split_catchment(), for several outlets in the same unit catchment at once.
+
+    We read and mask the rasters once, snap all of the outlets together, and then label every pixel
+    with the first outlet downstream of it, in one pass over the flow directions (see d8_trace.catchments).
+    An outlet's polygon is made from its own pixels plus those of any outlets upstream of it.
+    The results are the same as calling split_catchment() for each outlet.
+
+    Args:
+        outlets: list of (wid, lat, lng) for the outlets in the unit catchment
+        basin, catchment_poly, bSingleCatchment, settings: see split_catchment()
+        snapped: optional array of the snapped (lng, lat) of each outlet, from the stream pixel index
+        comid: optional COMID of the terminal unit catchment, see split_catchment()
+
+    Returns:
+        for each outlet, a tuple (poly, lat_snap, lng_snap), like split_catchment()
+    """
+    if settings is None:
+        settings = Settings.from_config()
+
+    numpixels = get_threshold(bSingleCatchment, settings)
+
+    # Look for the results of an earlier run (see py/split_cache.py). If we have all of them, we're done.
+    # (Not with the plots, like in split_catchment().)
+    cached = [None] * len(outlets)
+    use_cache = settings.split_cache != '' and not settings.plots
+    if use_cache:
+        snap_keys = [split_cache.snap_key(basin, catchment_poly, lat, lng, numpixels, settings)
+                     for wid, lat, lng in outlets]
+        if snapped is None:
+            snaps = [split_cache.get_snap(key, settings) for key in snap_keys]
+            snapped = None if None in snaps else np.array(snaps)
+        if snapped is not None:
+            cached = [split_cache.get_split(split_cache.split_key(basin, catchment_poly, lng_snap, lat_snap,
+                                                                  settings), settings)
+                      for lng_snap, lat_snap in snapped]
+            if None not in cached:
+                if settings.verbose: print(f"Found the split catchments for {len(outlets)} outlets in the split cache")
+                return cached
+
+    wid, lat, lng = outlets[0]
+    grid, fdir, acc = read_windows(wid, basin, lat, lng, catchment_poly, settings, accumulation=snapped is None,
+                                   comid=comid)
+
+    if snapped is None:
+        if settings.verbose: print(f"Snapping {len(outlets)} outlets, with a threshold of {numpixels} "
+                                   "upstream pixels")
+        streams = acc > numpixels
+        xy = np.array([(lng, lat) for wid, lat, lng in outlets])
+        try:
+            snapped = grid.snap_to_mask(streams, xy)
+        except Exception as e:
+            if settings.verbose: print(f"Could not snap the pour points. Error: {e}")
+            return [(None, None, None)] * len(outlets)
+        if use_cache:
+            for key, (lng_snap, lat_snap) in zip(snap_keys, snapped):
+                split_cache.put_snap(key, basin, lng_snap, lat_snap, settings)
+
+    if settings.verbose: print("Delineating catchments")
+    try:
+        if settings.tracer == "pysheds":
+            catches = [grid.catchment(fdir=fdir, x=lng_snap, y=lat_snap, dirmap=DIRMAP, xytype='coordinate',
+                                      recursionlimit=15000) for lng_snap, lat_snap in snapped]
+        else:
+            catches = d8_trace.catchments(grid, fdir, snapped[:, 0], snapped[:, 1], DIRMAP)
+    except Exception as e:
+        if settings.verbose: print(f"ERROR: something went wrong during the catchment delineation. Error: {e}")
+        return [(None, lng_snap, lat_snap) for lng_snap, lat_snap in snapped]
+
+    # polygonize_catchment() needs the grid clipped to each catchment in turn
+    mask_view = grid.viewfinder
+    results = []
+    by_pixel = {}
+    for (wid, lat, lng), (lng_snap, lat_snap), catch, result in zip(outlets, snapped, catches, cached):
+        # Outlets that snap to the same pixel have the same watershed
+        if (lng_snap, lat_snap) not in by_pixel and result is not None:
+            by_pixel[(lng_snap, lat_snap)] = result
+        elif (lng_snap, lat_snap) not in by_pixel:
+            try:
+                grid.viewfinder = mask_view
+                grid.clip_to(catch)
+                clipped_catch = grid.view(catch, dtype=np.uint8)
+            except Exception as e:
+                if settings.verbose: print(f"ERROR: something went wrong during the catchment delineation. "
+                                           f"Error: {e}")
+                by_pixel[(lng_snap, lat_snap)] = (None, lng_snap, lat_snap)
+            else:
+                result_polygon = polygonize_catchment(grid, clipped_catch, wid, settings)
+                # The snapped vertices look better if we nudge them one half pixels
+                by_pixel[(lng_snap, lat_snap)] = (result_polygon, lat_snap - HALFPIX, lng_snap + HALFPIX)
+                if use_cache:
+                    split_cache.put_split(split_cache.split_key(basin, catchment_poly, lng_snap, lat_snap, settings),
+                                          basin, by_pixel[(lng_snap, lat_snap)], settings)
+        results.append(by_pixel[(lng_snap, lat_snap)])
+
+    return results
+
+
+def read_windows(wid: str, basin: int, lat: float, lng: float, catchment_poly: Polygon,
+                 settings: Settings, accumulation: bool = True, comid: int = None) -> (Grid, object, object):
+    """
+    Reads the flow direction and accumulation rasters in the bounding box of the unit catchment,
+    and masks them to the unit catchment polygon (see split_catchment for the details).
+    If we know the unit catchment's COMID, and the pre-rasterized unit catchments have been built
+    for the basin, we read the mask from them instead of rasterizing the polygon (see py/catchment_labels.py).
+
+    Returns:
+        grid: the pysheds Grid, clipped to the unit catchment
+        fdir: the flow direction raster
+        acc: the flow accumulation raster, or None if accumulation is False
+    """
+    # Get a bounding box for the unit catchment, lined up with the raster pixels
+    bounding_box = get_bounding_box(catchment_poly)
 
     # Open the flow direction raster *using windowed reading mode*
-    fdir_fname = "{}/flowdir{}.tif".format(MERIT_FDIR_DIR, basin)
-    if VERBOSE: print("Loading flow direction raster from: {}".format(fdir_fname))
-    if VERBOSE: print(" using windowed reading mode with bounding_box = {}".format(repr(bounding_box)))
+    fdir_fname = "{}/flowdir{}.tif".format(settings.merit_fdir_dir, basin)
+    if settings.verbose: print("Loading flow direction raster from: {}".format(fdir_fname))
+    if settings.verbose: print(" using windowed reading mode with bounding_box = {}".format(repr(bounding_box)))
 
     if not os.path.isfile(fdir_fname):
         raise Exception("Could not find flow flow direction raster: {}".format(fdir_fname))
@@ -110,61 +316,52 @@ def split_catchment(wid: str, basin: int, lat: float, lng: float, catchment_poly
     # You can still use it without numba, but the code is older and has not evolved with the new stuff (?)
     # Anyhow, the old version worked better for me in my testing.
     # grid = Grid.from_raster(path=fdir_fname, data=fdir_fname, data_name="myflowdir", window=bounding_box,nodata=0)
-    grid = Grid.from_raster(fdir_fname, window=bounding_box, nodata=0)
-    fdir = grid.read_raster(fdir_fname, window=bounding_box, nodata=0)
+    # grid = Grid.from_raster(fdir_fname, window=bounding_box, nodata=0)
+    # fdir = grid.read_raster(fdir_fname, window=bounding_box, nodata=0)
+    # We now read the window through the raster block cache, which keeps the file open and
+    # the decoded tiles in memory for the next outlet (see py/raster_cache.py). Same result.
+    fdir = raster_cache.read_window(fdir_fname, bounding_box, nodata=0)
+    grid = Grid.from_raster(fdir)
     # Now "clip" the rectangular flow direction grid even further so that it ONLY contains data
     # inside the bounaries of the terminal unit catchment.
     # This prevents us from accidentally snapping the pour point to a neighboring watershed.
     # This was especially a problem around confluences, but this step seems to fix it.
-    # (Seems I had to first convert it to hex format to get this to work...)
-    hexpoly = catchment_poly.wkb_hex
-    poly = wkb.loads(hexpoly, hex=True)
-    # coerce this into a single-part polygon, in case the geometry is a MultiPolygon
-    poly = get_largest(poly)
+    mymask = None
+    if comid is not None and settings.catchment_labels:
+        mymask = catchment_labels.read_mask(basin, comid, catchment_poly, bounding_box, fdir)
+    if mymask is None:
+        mymask = rasterize_catchment(grid, catchment_poly)
 
-    # Fix any holes in the polygon by taking the exterior coordinates.
-    # One of the annoyances of working with GeoPandas and pysheds is that you have
-    # to constantly switch back and forth between Polygons and MultiPolygons...
-    filled_poly = Polygon(poly.exterior.coords)
-
-    # It needs to be of type MultiPolygon to work with rasterio apparently
-    multi_poly = MultiPolygon([filled_poly])
-    polygon_list = list(multi_poly.geoms)
-
-    # Convert the polygon into a pixelized raster "mask".
-    mymask = grid.rasterize(polygon_list)
-    # grid.add_gridded_data(mymask, data_name="mymask", affine=grid.affine, crs=grid.crs, shape=grid.shape)
+    # We apply the same mask to the flow direction and accumulation rasters, so we only work it out once.
+    # (Note: these arrays are our own copies, not the ones in the raster cache, so we can change them.)
+    outside = np.asarray(mymask) == 0
 
     # I believe this step was unnecessary, but it makes the plots look a little nicer
-    m, n = grid.shape
-    for i in range(0, m):
-        for j in range(0, n):
-            if int(mymask[i, j]) == 0:
-                fdir[i, j] = 0
+    fdir[outside] = 0
 
     # Plot the mask that I created from rasterized vector polygon
-    if PLOTS:
+    if settings.plots:
         plot_mask(mymask, catchment_poly, lat, lng, wid)
 
-    # MERIT-Hydro flow direction uses the old ESRI standard for flow direction...
-    dirmap = (64, 128, 1, 2, 4, 8, 16, 32)
-
     # Plot the flow-direction raster, for debugging
-    if PLOTS:
-        plot_flowdir(fdir, lat, lng, wid, dirmap, catchment_poly)
+    if settings.plots:
+        plot_flowdir(fdir, lat, lng, wid, DIRMAP, catchment_poly)
 
-    if VERBOSE: print("Snapping pour point")
+    # Clips the flow direction grid to a new rectangular bounding box.
+    # that corresponds to the mask of the unit catchment.
+    grid.clip_to(mymask)
+
+    if not accumulation:
+        return grid, fdir, None
+
+    if settings.verbose: print("Snapping pour point")
 
     # Open the accumulation raster, again using windowed reading mode.
-    accum_fname = '{}/accum{}.tif'.format(MERIT_ACCUM_DIR, basin)
+    accum_fname = '{}/accum{}.tif'.format(settings.merit_accum_dir, basin)
     if not os.path.isfile(accum_fname):
         raise Exception("Could not find accumulation raster: {}".format(accum_fname))
 
-    acc = grid.read_raster(accum_fname, data_name="acc", window=bounding_box, window_crs=grid.crs, nodata=0)
-
-    # Clips the flow direction grid to a new rectangular bounding box.
-    # that corresponds to the mask of the unit catchment.
-    grid.clip_to(mymask)
+    acc = raster_cache.read_window(accum_fname, bounding_box, nodata=0)
 
     # MASK the accumulation raster to the unit catchment POLYGON. Set any pixel that is not
     # in 'mymask' to zero. That way, the pour point will always snap to a grid cell that is
@@ -172,14 +369,14 @@ def split_catchment(wid: str, basin: int, lat: float, lng: float, catchment_poly
     # to a neighboring watershed. It took me a bunch of experimenting to realize
     # that this is the key to getting good results in small watersheds, especially
     # when there are other streams nearby.
-    # The approach I used (looping over every pixel in the grid) is simple but a little hackish.
-    # Would be better implemented as a method in pysheds.
-    m, n = grid.shape
-    for i in range(0, m):
-        for j in range(0, n):
-            if int(mymask[i, j]) == 0:
-                acc[i, j] = 0
+    # I used to do this by looping over every pixel in the grid, which was slow for big unit catchments.
+    acc[outside] = 0
+
+    return grid, fdir, acc
 
+
+def get_threshold(bSingleCatchment: bool, settings: Settings) -> int:
+    """The minimum number of upstream pixels for the pixels that we snap the outlet to."""
     # Snap the outlet to the nearest stream. This function depends entirely on the threshold
     # that you set for how minimum number of upstream pixels to define a waterway.
     # If the user is looking for a small headwater stream, we can use a small number.
@@ -188,55 +385,31 @@ def split_catchment(wid: str, basin: int, lat: float, lng: float, catchment_poly
     # The values here work OK, but I did not test very extensively...
     # Using a minimum value like 500 prevents the script from finding little tiny watersheds.
     if bSingleCatchment:
-        numpixels = THRESHOLD_SINGLE
+        return settings.threshold_single
     else:
         # Case where there are 2 or more unit catchments in the watershed
         # setting this value too low causes incorrect results and weird topology problems in the output
-        numpixels = THRESHOLD_MULTIPLE
-
-    if VERBOSE: print("Using threshold of {} for number of upstream pixels.".format(numpixels))
-
-    # Snap the pour point to a point on the accumulation grid where accum (# of upstream pixels)
-    # is greater than our threshold
-    streams = acc > numpixels
-    xy = (lng, lat)
-    try:
-        [lng_snap, lat_snap] = grid.snap_to_mask(streams, xy)  # New version does not give you the snap distance.
-    except Exception as e:
-        if VERBOSE: print(f"Could not snap the pour point. Error: {e}")
-        return None, None, None
-
-    # Plot the accumulation grid, for debugging
-    if PLOTS:
-        plot_accum(acc, lat, lng, lat_snap, lng_snap, wid, catchment_poly)
-
-    # Plot the streams!
-    if PLOTS:
-        plot_streams(streams, catchment_poly, lat, lng, lat_snap, lng_snap, wid, numpixels)
+        return settings.threshold_multiple
 
-    # Finally, here is the raster based watershed delineation with pysheds!
-    if VERBOSE: print("Delineating catchment")
-    try:
-        catch = grid.catchment(fdir=fdir,
-                               x=lng_snap,
-                               y=lat_snap,
-                               dirmap=dirmap,
-                               xytype='coordinate',
-                               recursionlimit=15000)
 
-        # Clip the bounding box to the catchment
-        # Seems optional, but turns out this line is essential.
-        grid.clip_to(catch)
-        clipped_catch = grid.view(catch, dtype=np.uint8)
-    except Exception as e:
-        if VERBOSE: print(f"ERROR: something went wrong during pysheds grid.catchment(). Error: {e}")
-        return None, lng_snap, lat_snap
+def polygonize_catchment(grid: Grid, clipped_catch, wid: str, settings: Settings) -> Polygon:
+    """
+    Converts the raster of the pixels in the catchment (clipped to the catchment) to a single shapely Polygon.
+    """
+    if settings.polygonize != "pysheds":
+        # Trace the boundary of the pixels, without polygonize() and unary_union (see py/raster_boundary.py)
+        if settings.verbose: print("Tracing the boundary of the catchment")
+        if settings.polygonize == "trace":
+            hole_threshold = None
+        else:
+            hole_threshold = settings.fill_threshold if settings.fill else 0
+        return raster_boundary.catchment_polygon(np.asarray(clipped_catch) != 0, clipped_catch.affine,
+                                                 hole_threshold)
 
     # Convert high-precision raster subcatchment to a polygon using pysheds method .polygonize()
-    if VERBOSE: print("Converting to polygon")
+    if settings.verbose: print("Converting to polygon")
     shapes = grid.polygonize(clipped_catch)
 
-
     # The output from pysheds is creating MANY shapes.
     # Dissolve them together with the unary union operation in shapely
     # (Could not install numba on my web server, but performance does
@@ -256,10 +429,6 @@ def split_catchment(wid: str, basin: int, lat: float, lng: float, catchment_poly
 
     shape_count = 0
 
-    # The snapped vertices look better if we nudge them one half pixels
-    lng_snap += halfpix
-    lat_snap -= halfpix
-
     # Convert the result from pysheds into a list of shapely polygons
     for shape, value in shapes:
         pysheds_polygon = shape
@@ -275,7 +444,7 @@ def split_catchment(wid: str, basin: int, lat: float, lng: float, catchment_poly
         result_polygon = ops.unary_union(shapely_polygons)
 
         if result_polygon.geom_type == "MultiPolygon":
-            if PLOTS:
+            if settings.plots:
                 polygons = list(result_polygon.geoms)
                 plot_polys(polygons, wid)
 
@@ -284,11 +453,59 @@ def split_catchment(wid: str, basin: int, lat: float, lng: float, catchment_poly
         # If pysheds generated a single polygon, that is our answer
         result_polygon = shapely_polygons[0]
 
-    if PLOTS:
-        plot_catchment(catch, catchment_poly, result_polygon, lat, lng, lat_snap, lng_snap, wid, dirmap)
-        plot_clipped(fdir, clipped_catch, catchment_poly, lat, lng, lat_snap, lng_snap, wid, result_polygon)
+    return result_polygon
 
-    return result_polygon, lat_snap, lng_snap
+
+def get_bounding_box(catchment_poly: Polygon) -> tuple:
+    """
+    Gets the bounding box of a unit catchment, for the windowed reading of the rasters.
+
+    The coordinates of the polygon's bounding box do not correspond well with the edges of the grid pixels.
+    We need to round them to the nearest whole pixel and then
+    adjust them by a half-pixel width to get good results in pysheds.
+
+    Returns:
+        a tuple with 4 floats: (Left, Bottom, Right, Top)
+    """
+    bounds_list = [float(i) for i in catchment_poly.bounds]
+
+    # Bounding box is xmin, ymin, xmax, ymax
+    # round the elements DOWN, DOWN, UP, UP
+    # The number 1200 is because the MERIT-Hydro rasters have 3 arsecond resolution, or 1/1200 of a decimal degree.
+    # So we just multiply it by 1200, round up or down to the nearest whole number, then divide by 1200
+    # to put it back in its regular units of decimal degrees. Then, since pysheds wants the *center*
+    # of the pixel, not its edge, add or subtract a half-pixel width as appropriate.
+    # This took me a while to figure out but was essential to getting results that look correct
+    bounds_list[0] = floor(bounds_list[0] * 1200) / 1200 - HALFPIX
+    bounds_list[1] = floor(bounds_list[1] * 1200) / 1200 - HALFPIX
+    bounds_list[2] = ceil( bounds_list[2] * 1200) / 1200 + HALFPIX
+    bounds_list[3] = ceil( bounds_list[3] * 1200) / 1200 + HALFPIX
+
+    # The bounding box needs to be a tuple for pysheds.
+    return tuple(bounds_list)
+
+
+def rasterize_catchment(grid: Grid, catchment_poly: Polygon):
+    """
+    Converts the unit catchment polygon into a pixelized raster "mask" on the grid.
+    Returns a pysheds Raster, 1 for the pixels inside of the unit catchment and 0 outside.
+    """
+    # (Seems I had to first convert it to hex format to get this to work...)
+    hexpoly = catchment_poly.wkb_hex
+    poly = wkb.loads(hexpoly, hex=True)
+    # coerce this into a single-part polygon, in case the geometry is a MultiPolygon
+    poly = get_largest(poly)
+
+    # Fix any holes in the polygon by taking the exterior coordinates.
+    # One of the annoyances of working with GeoPandas and pysheds is that you have
+    # to constantly switch back and forth between Polygons and MultiPolygons...
+    filled_poly = Polygon(poly.exterior.coords)
+
+    # It needs to be of type MultiPolygon to work with rasterio apparently
+    multi_poly = MultiPolygon([filled_poly])
+    polygon_list = list(multi_poly.geoms)
+
+    return grid.rasterize(polygon_list)
 
 
 def get_largest(input_poly: MultiPolygon or Polygon) -> Polygon:
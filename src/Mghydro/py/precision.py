@@ -0,0 +1,93 @@
+"""
+Rounding the coordinates of the output geometries, so that the GeoJSON and KML files and the map files are smaller.
+
+We used to do this by writing each geometry out as WKT text, rounding every number in the text with a regular
+expression, and reading the text back in. For a large watershed, or the thousands of river reaches on the map,
+that is slow, and the text takes a lot of memory. Here we round the arrays of coordinates directly, for all of
+the geometries at once. Rounding can make consecutive vertices the same, so we drop the repeats, which also
+makes the files smaller. (If that would leave too few vertices to make a ring or a line, we keep them.)
+
+With 5 decimals, the coordinates are rounded to about 1 m, which is much finer than the 3 arcsecond
+(about 90 m) MERIT-Hydro pixels.
+"""
+import numpy as np
+import shapely
+
+# Smallest number of coordinates in a ring (the first one is repeated at the end) and in a line
+MIN_RING_COORDS = 4
+MIN_LINE_COORDS = 2
+
+
+def round_coords(coords: np.ndarray, index: np.ndarray, decimals: int, min_coords: int) -> (np.ndarray, np.ndarray):
+    """
+    Rounds the coordinates of a set of rings or lines, and drops the vertices that are the same as the one
+    before them, except in rings or lines that would have fewer than min_coords left.
+
+    Args:
+        coords: the coordinates of all of the rings or lines, one after the other
+        index: which ring or line each coordinate belongs to, in increasing order
+        decimals: number of decimals to keep
+        min_coords: smallest number of coordinates that a ring or line can have
+
+    Returns:
+        the coordinates that we keep, and their index
+    """
+    coords = np.round(coords, decimals)
+    repeat = np.r_[False, (index[1:] == index[:-1]) & (coords[1:] == coords[:-1]).all(axis=1)]
+    n_left = np.bincount(index[~repeat], minlength=index.max() + 1 if len(index) > 0 else 0)
+    keep = ~repeat | (n_left[index] < min_coords)
+    return coords[keep], index[keep]
+
+
+def round_coordinates(geoms: np.ndarray, decimals: int) -> np.ndarray:
+    """
+    Rounds the coordinates of the geometries to the number of decimals, and drops repeated vertices
+    (see the module docstring). Works on (Multi)Polygons and (Multi)LineStrings, e.g. the watershed and the
+    river reaches. Other geometries (points) are only rounded. Empty geometries are left as they are.
+    """
+    geoms = np.asarray(geoms, dtype=object)
+    result = geoms.copy()
+    type_id = shapely.get_type_id(geoms)
+    empty = shapely.is_empty(geoms)
+    polygonal = np.isin(type_id, [shapely.GeometryType.POLYGON, shapely.GeometryType.MULTIPOLYGON]) & ~empty
+    linear = np.isin(type_id, [shapely.GeometryType.LINESTRING, shapely.GeometryType.MULTILINESTRING]) & ~empty
+    is_multi = np.isin(type_id, [shapely.GeometryType.MULTIPOLYGON, shapely.GeometryType.MULTILINESTRING])
+
+    for which, make_part, make_multi in ((polygonal, make_polygons, shapely.multipolygons),
+                                         (linear, make_lines, shapely.multilinestrings)):
+        rows = np.flatnonzero(which)
+        if len(rows) == 0:
+            continue
+        parts, part_of = shapely.get_parts(geoms[rows], return_index=True)
+        new_parts = make_part(parts, decimals)
+
+        # Put the parts back together. A MultiPolygon (or MultiLineString) with one part stays a MultiPolygon.
+        single = ~is_multi[rows]
+        result[rows[single]] = new_parts[np.isin(part_of, np.flatnonzero(single))]
+        multi = np.flatnonzero(~single)
+        if len(multi) > 0:
+            in_multi = np.isin(part_of, multi)
+            result[rows[multi]] = make_multi(new_parts[in_multi], indices=np.searchsorted(multi, part_of[in_multi]))
+
+    # Anything else (e.g. points) is only rounded
+    other = np.flatnonzero(~polygonal & ~linear & ~empty)
+    if len(other) > 0:
+        coords = shapely.get_coordinates(geoms[other])
+        result[other] = shapely.set_coordinates(geoms[other].copy(), np.round(coords, decimals))
+    return result
+
+
+def make_polygons(parts: np.ndarray, decimals: int) -> np.ndarray:
+    """The polygons, with their rings rounded."""
+    rings, ring_part = shapely.get_rings(parts, return_index=True)
+    coords, ring = shapely.get_coordinates(rings, return_index=True)
+    coords, ring = round_coords(coords, ring, decimals, MIN_RING_COORDS)
+    # The exterior ring of each polygon comes first, then its holes
+    return shapely.polygons(shapely.linearrings(coords, indices=ring), indices=ring_part)
+
+
+def make_lines(parts: np.ndarray, decimals: int) -> np.ndarray:
+    """The lines, rounded."""
+    coords, line = shapely.get_coordinates(parts, return_index=True)
+    coords, line = round_coords(coords, line, decimals, MIN_LINE_COORDS)
+    return shapely.linestrings(coords, indices=line)
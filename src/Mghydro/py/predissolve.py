@@ -0,0 +1,230 @@
+"""
+Hierarchical "pre-dissolved" catchment tree, to speed up the dissolve for large watersheds.
+
+For a large watershed, the dissolve step has to merge thousands (or even hundreds of thousands)
+of unit catchment polygons, every time. But the watersheds of big rivers share most of their
+area: the Grand River at Brantford and at Cayuga both contain everything upstream of Brantford.
+
+In an offline step (see prepare_data.py), we walk the river network from upstream to downstream,
+and for every reach whose upstream area is above a threshold (PREDISSOLVE_AREA, in km²), we save the
+dissolved polygon of its entire watershed. Each of these is built from the polygons that we already
+made for the reaches just upstream of it, so the build is fast.
+
+At delineation time, the watershed is made of a handful of these pre-dissolved pieces, plus the
+"leftover" unit catchments that are in small tributaries (upstream area below the threshold)
+or are the terminal unit catchment itself. Since upstream area only grows as we go downstream,
+the number of pieces and leftover unit catchments depends on the shape of the river network
+near the outlet, and not on the total number of unit catchments in the watershed.
+
+The pre-dissolved polygons are saved as a pickle file next to the other pickle files:
+    PICKLE_DIR/predissolved_##_hires.pkl
+    PICKLE_DIR/predissolved_##_lores.pkl
+with the signature of the unit catchments and rivers they were built from (see py/signature.py).
+"""
+import os
+import pickle
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+from config import *
+from py.fast_dissolve import dissolve
+from py.topology import comid_to_row
+from py.signature import signature, matches
+
+
+def get_predissolved_filename(basin: int, high_resolution: bool) -> str:
+    """
+    Standard filename for the pre-dissolved polygons, stored next to the pickle files.
+    """
+    resolution_str = 'hires' if high_resolution else 'lores'
+    return f'{PICKLE_DIR}/predissolved_{basin}_{resolution_str}.pkl'
+
+
+def cached_rows(topo: dict, rivers_df: pd.DataFrame, area_threshold: float) -> np.ndarray:
+    """
+    Gets the rows (in the topology arrays) of the reaches that get a pre-dissolved polygon,
+    i.e. all reaches whose upstream area is at least `area_threshold` km².
+    """
+    uparea = rivers_df['uparea'].reindex(topo['comid']).to_numpy()
+    return np.flatnonzero(uparea >= area_threshold)
+
+
+def cover(topo: dict, is_cached: np.ndarray, row: int, include_root: bool) -> (np.ndarray, np.ndarray):
+    """
+    Splits the watershed of `row` into pre-dissolved pieces and leftover unit catchments.
+
+    Works on the nested set labeling: the watershed is a slice of the pre-order array,
+    each pre-dissolved piece covers a sub-slice, and we only keep the pieces that are not
+    already inside another one.
+
+    Args:
+        topo: topology index, from py.topology.load_topology()
+        is_cached: boolean array, True for each row that has a pre-dissolved polygon
+        row: the row of the terminal unit catchment
+        include_root: if False, the terminal unit catchment is always a leftover. We do this in
+            high-resolution mode, because we are going to replace its polygon with the split catchment.
+
+    Returns:
+        pieces: rows whose pre-dissolved polygons we should use
+        leftovers: rows of the unit catchments that are not in any piece. If include_root is False,
+            the first one is always `row`.
+    """
+    if include_root and is_cached[row]:
+        return np.array([row], dtype=np.int32), np.empty(0, dtype=np.int32)
+
+    start = topo['entry'][row]
+    end = start + topo['size'][row]
+    watershed = topo['preorder'][start:end]
+
+    # Candidates, in pre-order, leaving out the terminal unit catchment itself
+    positions = np.flatnonzero(is_cached[watershed[1:]]) + start + 1
+    pieces = []
+    covered_until = start + 1
+    for pos in positions:
+        if pos >= covered_until:
+            piece = topo['preorder'][pos]
+            pieces.append(piece)
+            covered_until = pos + topo['size'][piece]
+
+    # Mark the parts of the slice that are covered by the pieces
+    covered = np.zeros(end - start + 1, dtype=np.int32)
+    for piece in pieces:
+        piece_start = topo['entry'][piece] - start
+        covered[piece_start] += 1
+        covered[piece_start + topo['size'][piece]] -= 1
+    leftovers = watershed[np.cumsum(covered[:-1]) == 0]
+
+    return np.array(pieces, dtype=np.int32), leftovers
+
+
+def build_predissolved(catchments_gdf: gpd.GeoDataFrame, rivers_df: pd.DataFrame, topo: dict,
+                       area_threshold: float) -> gpd.GeoDataFrame:
+    """
+    Builds the pre-dissolved polygons for one basin.
+
+    We go through the reaches from upstream to downstream (reverse pre-order), so that the
+    pieces for the reaches just upstream of each one have already been built.
+
+    Args:
+        catchments_gdf: the unit catchments, indexed by COMID
+        rivers_df: the rivers table, indexed by COMID (we only need the field uparea)
+        topo: topology index, from py.topology.load_topology()
+        area_threshold: minimum upstream area, in km², for a reach to get a pre-dissolved polygon
+
+    Returns:
+        GeoDataFrame indexed by COMID, with the dissolved watershed of each of these reaches,
+        and the signature of the data in gdf.attrs['source']
+    """
+    rows = cached_rows(topo, rivers_df, area_threshold)
+    rows = rows[np.argsort(topo['entry'][rows])[::-1]]
+    is_cached = np.zeros(len(topo['comid']), dtype=bool)
+
+    geoms = {}
+    n = len(rows)
+    for i, row in enumerate(rows):
+        pieces, leftovers = cover(topo, is_cached, row, include_root=False)
+        parts = catchments_gdf.geometry.loc[topo['comid'][leftovers]].tolist()
+        parts += [geoms[piece] for piece in pieces]
+        parts_gdf = gpd.GeoDataFrame(geometry=parts, crs=catchments_gdf.crs)
+        geoms[row] = dissolve(parts_gdf).iloc[0]
+        is_cached[row] = True
+
+        if VERBOSE and (i + 1) % 1000 == 0:
+            print(f"  built {i + 1:,} of {n:,} pre-dissolved polygons")
+
+    comids = topo['comid'][rows]
+    predissolved_gdf = gpd.GeoDataFrame({'uparea_threshold': area_threshold},
+                                        index=pd.Index(comids, name='COMID'),
+                                        geometry=[geoms[row] for row in rows],
+                                        crs=catchments_gdf.crs)
+    predissolved_gdf.attrs['source'] = signature(catchments_gdf, topo)
+    return predissolved_gdf
+
+
+def save_predissolved(gdf: gpd.GeoDataFrame, basin: int, high_resolution: bool):
+    fname = get_predissolved_filename(basin, high_resolution)
+    if VERBOSE: print(f"Saving pre-dissolved polygons to: {fname}")
+    with open(fname, "wb") as f:
+        pickle.dump(gdf, f)
+
+
+def load_predissolved(basin: int, high_resolution: bool, source: str = None) -> gpd.GeoDataFrame or None:
+    """
+    Returns the pre-dissolved polygons for a basin, or None if they have not been built.
+    Run `python prepare_data.py predissolve` to build them.
+    If `source` is given (from py.signature.signature()), also returns None if they were built from other data.
+    """
+    if PICKLE_DIR == '':
+        return None
+    fname = get_predissolved_filename(basin, high_resolution)
+    if not os.path.isfile(fname):
+        return None
+    if VERBOSE: print(f"Fetching BASIN # {basin} pre-dissolved polygons from pickle file.")
+    with open(fname, "rb") as f:
+        predissolved_gdf = pickle.load(f)
+    if source is not None and not matches(predissolved_gdf.attrs.get('source'), source, fname):
+        return None
+    return predissolved_gdf
+
+
+def cached_mask(topo: dict, predissolved_gdf: gpd.GeoDataFrame or None) -> np.ndarray or None:
+    """
+    Boolean array, True for each row in the topology arrays that has a pre-dissolved polygon.
+    Returns None if there are no pre-dissolved polygons.
+    """
+    if predissolved_gdf is None or len(predissolved_gdf) == 0:
+        return None
+    is_cached = np.zeros(len(topo['comid']), dtype=bool)
+    rows = comid_to_row(topo, predissolved_gdf.index.to_numpy())
+    is_cached[rows[rows >= 0]] = True
+    return is_cached
+
+
+def assemble_subbasins(catchments_gdf: gpd.GeoDataFrame, predissolved_gdf: gpd.GeoDataFrame or None,
+                       is_cached: np.ndarray or None, topo: dict, terminal_comid: int, B: np.ndarray,
+                       include_root: bool, gauge_polygons: dict = None) -> gpd.GeoDataFrame:
+    """
+    Makes the GeoDataFrame of polygons that we need to dissolve to get the watershed.
+
+    Without pre-dissolved polygons, this is just all of the unit catchments in B.
+    Otherwise, it is the leftover unit catchments plus the pre-dissolved pieces.
+    Either way, the terminal unit catchment is the first row, indexed by `terminal_comid`
+    (unless include_root is True and the whole watershed is a single pre-dissolved piece).
+
+    Args:
+        is_cached: from cached_mask(), so that we only have to compute it once per basin
+        gauge_polygons: optional dict of the watersheds we already made for outlets upstream,
+            {row of the terminal unit catchment: polygon}. These are used like the pre-dissolved pieces,
+            except that, in high-res mode, the polygon only covers part of its terminal unit catchment,
+            so we also add the whole terminal unit catchment.
+    """
+    if is_cached is None and not gauge_polygons:
+        return catchments_gdf.loc[B]
+
+    is_piece = np.zeros(len(topo['comid']), dtype=bool) if is_cached is None else is_cached
+    if gauge_polygons:
+        is_piece = is_piece.copy()
+        is_piece[list(gauge_polygons)] = True
+
+    row = comid_to_row(topo, terminal_comid)[0]
+    pieces, leftovers = cover(topo, is_piece, row, include_root)
+    if len(pieces) == 0:
+        return catchments_gdf.loc[B]
+
+    # Pre-dissolved polygons are complete, so we prefer them over the outlet polygons
+    if is_cached is None:
+        from_gauges = pieces
+    else:
+        from_gauges = pieces[~is_cached[pieces]]
+    cached_pieces = np.setdiff1d(pieces, from_gauges)
+
+    if VERBOSE: print(f"  using {len(cached_pieces)} pre-dissolved piece(s), {len(from_gauges)} upstream "
+                      f"outlet watershed(s) and {len(leftovers)} unit catchment(s)")
+    leftovers_gdf = catchments_gdf.loc[topo['comid'][np.concatenate([leftovers, from_gauges])]]
+    pieces_gdf = []
+    if len(cached_pieces) > 0:
+        pieces_gdf.append(predissolved_gdf.loc[topo['comid'][cached_pieces], ['geometry']])
+    if len(from_gauges) > 0:
+        pieces_gdf.append(gpd.GeoDataFrame(index=topo['comid'][from_gauges], crs=catchments_gdf.crs,
+                                           geometry=[gauge_polygons[piece] for piece in from_gauges]))
+    return pd.concat([leftovers_gdf] + pieces_gdf)
@@ -0,0 +1,148 @@
+"""
+Converts the raster of the pixels in a catchment to a single polygon, by tracing its boundary.
+
+split_catchment() used to call pysheds' grid.polygonize(), which makes one polygon for every
+group of (4-connected) pixels. These were converted to shapely polygons one at a time, without their holes,
+merged with unary_union(), and if the result was a MultiPolygon, we kept the largest piece.
+
+Here we go straight to the answer: we pick the connected group of pixels that covers the largest area
+(with its holes filled), and walk along the pixel edges around it to get its outer boundary.
+This gives the same polygon, without the union.
+Optionally, we also trace the holes that are bigger than a given number of pixels, and cut them out.
+(The holes are cut out of the outer boundary, rather than given to Polygon() as its interior rings. Two holes
+can touch at a corner, and rings that touch like that would make an invalid polygon.)
+
+Set POLYGONIZE = "pysheds" in config.py to use the old method instead.
+"""
+import numpy as np
+import shapely
+from scipy import ndimage
+from shapely.geometry import Polygon
+
+
+def largest_region(mask: np.ndarray) -> np.ndarray:
+    """
+    Returns a boolean array that is True for the 4-connected group of pixels in the mask that covers the
+    largest area once its holes are filled, with its holes filled. (A hole is a group of pixels that can't
+    reach the edge of the array without crossing the group, moving up, down, left or right.)
+    This is the piece that we used to keep after merging the polygons from pysheds.
+    """
+    labels, n = ndimage.label(mask)
+    if n == 0:
+        raise Exception("There are no pixels in the catchment")
+    counts = np.bincount(labels.ravel())
+    objects = ndimage.find_objects(labels)
+
+    best_label, best_area, best_filled = 0, 0, None
+    for label in np.argsort(-counts[1:], kind='stable') + 1:
+        rows, cols = objects[label - 1]
+        # The filled area can't be larger than the bounding box
+        if (rows.stop - rows.start) * (cols.stop - cols.start) <= best_area:
+            continue
+        filled = ndimage.binary_fill_holes(labels[rows, cols] == label)
+        area = np.count_nonzero(filled)
+        if area > best_area:
+            best_label, best_area, best_filled = label, area, filled
+
+    region = np.zeros(mask.shape, dtype=bool)
+    region[objects[best_label - 1]] = best_filled
+    return region
+
+
+def trace_ring(region: np.ndarray) -> (np.ndarray, np.ndarray):
+    """
+    Traces the boundary of a group of pixels that is 4-connected and has no holes (see largest_region).
+
+    We make a list of the pixel edges that have the region on one side and not on the other,
+    all pointing the same way around the region. Since the region has no holes, and pixels that
+    only touch at a corner are filled in, every corner on the boundary has exactly one edge going out
+    of it, and the edges make a single loop. We follow the loop, and keep the corners where it turns.
+
+    Returns:
+        rows, cols: the corners of the pixels on the boundary, in order. The corner (i, j) is the upper-left
+            corner of pixel (i, j). The first corner is not repeated at the end.
+    """
+    m, n = region.shape
+    padded = np.zeros((m + 2, n + 2), dtype=bool)
+    padded[1:m + 1, 1:n + 1] = region
+
+    # Edges along the rows of corners: pixel above vs. pixel below.
+    # Going around with the region on the right (on screen): east under the top edges, west over the bottom ones.
+    above, below = padded[:-1, 1:-1], padded[1:, 1:-1]
+    r, c = np.nonzero(below & ~above)
+    top = (r, c, r, c + 1)
+    r, c = np.nonzero(above & ~below)
+    bottom = (r, c + 1, r, c)
+
+    # Edges along the columns of corners: pixel on the left vs. pixel on the right.
+    # South along the right edges, north along the left edges.
+    left, right = padded[1:-1, :-1], padded[1:-1, 1:]
+    r, c = np.nonzero(left & ~right)
+    east = (r, c, r + 1, c)
+    r, c = np.nonzero(right & ~left)
+    west = (r + 1, c, r, c)
+
+    r0, c0, r1, c1 = [np.concatenate(parts) for parts in zip(top, bottom, east, west)]
+
+    # The corners, as a single number each, and the edge that starts from the end of each edge
+    start_id = r0.astype(np.int64) * (n + 1) + c0
+    end_id = r1.astype(np.int64) * (n + 1) + c1
+    order = np.argsort(start_id)
+    following = order[np.searchsorted(start_id[order], end_id)].tolist()
+
+    ring = np.empty(len(following), dtype=np.int64)
+    edge = 0
+    for k in range(len(following)):
+        ring[k] = edge
+        edge = following[edge]
+    if edge != 0:
+        raise Exception("The boundary of the catchment did not close")
+
+    # Keep the corners where the direction changes
+    rows, cols = r0[ring], c0[ring]
+    d_row, d_col = r1[ring] - rows, c1[ring] - cols
+    turns = (d_row != np.roll(d_row, 1)) | (d_col != np.roll(d_col, 1))
+    return rows[turns], cols[turns]
+
+
+def ring_coords(rows: np.ndarray, cols: np.ndarray, affine) -> list:
+    """Converts the pixel corners to map coordinates, the same way as GDAL (x = c + col * a, y = f + row * e)."""
+    x = affine.c + cols * affine.a
+    y = affine.f + rows * affine.e
+    return list(zip(x.tolist(), y.tolist()))
+
+
+def catchment_polygon(mask: np.ndarray, affine, hole_threshold: int = None) -> Polygon:
+    """
+    Makes a polygon of the pixels in a catchment. If they are not all connected, we keep the largest group.
+
+    Args:
+        mask: boolean array, True for the pixels in the catchment
+        affine: the affine transform of the array (the grid cells must not be rotated)
+        hole_threshold: keep the holes with more than this many pixels. If None (the default),
+            the polygon has no holes, like the polygon from pysheds in split_catchment().
+
+    Returns:
+        a shapely Polygon
+    """
+    region = largest_region(mask)
+    shell = ring_coords(*trace_ring(region), affine)
+
+    polygon = Polygon(shell)
+    if hole_threshold is not None:
+        labels, n = ndimage.label(region & ~mask)
+        counts = np.bincount(labels.ravel())
+        holes = []
+        for label in np.flatnonzero(counts > hole_threshold):
+            if label != 0:
+                # Any pixels of the catchment inside of the hole are filled in
+                hole = ndimage.binary_fill_holes(labels == label)
+                holes.append(Polygon(ring_coords(*trace_ring(hole), affine)))
+        if len(holes) > 0:
+            polygon = polygon.difference(shapely.union_all(holes))
+            if polygon.geom_type == 'MultiPolygon':
+                polygon = max(polygon.geoms, key=lambda part: part.area)
+
+    if not polygon.is_valid:
+        raise Exception(f"The polygon of the catchment is not valid: {shapely.is_valid_reason(polygon)}")
+    return polygon
@@ -0,0 +1,221 @@
+"""
+In-process cache of the flow direction and accumulation rasters, for split_catchment() in high-res mode.
+
+split_catchment() used to call Grid.from_raster() and read_raster() for every outlet, which opened
+flowdir{basin}.tif twice and accum{basin}.tif once, and decompressed all of the GeoTIFF tiles
+in the window each time -- even though neighbouring gauges often need the very same tiles.
+
+Here, we keep one open rasterio dataset per file in each process, and read the rasters one
+internal block (tile) at a time. The decoded blocks are kept in memory and evicted in
+least-recently-used order when the total size is over RASTER_CACHE_MB megabytes.
+Set RASTER_CACHE_MB = 0 in config.py to turn the cache off (blocks are still read the same way).
+
+read_window() gives *exactly* the same pixels and affine transform as pysheds' read_raster()
+with the same window, so the delineation results do not change.
+
+If there is an uncompressed, memory-mapped copy of the raster in MEMMAP_DIR (see py/raster_memmap.py),
+we read the windows from it instead, with no decoding and no block cache.
+"""
+from collections import OrderedDict
+import os
+import numpy as np
+import rasterio
+import rasterio.windows
+from pysheds.sview import Raster, ViewFinder
+from pysheds import projection
+from config import *
+import py.raster_memmap as raster_memmap
+
+# For strip-organized (untiled) GeoTIFFs, the cache blocks are this many pixels wide, and at least this tall
+STRIP_BLOCK_SIZE = 512
+
+# path -> dict with the dataset, the process id that opened it, and a few of its properties
+_datasets = {}
+
+# (path, block row, block column) -> decoded block, most recently used last
+_blocks = OrderedDict()
+_stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'bytes': 0, 'bytes_decoded': 0, 'opens': 0, 'mapped': 0}
+
+
+def budget_bytes() -> int:
+    return int(RASTER_CACHE_MB * 1024 * 1024)
+
+
+def get_dataset(path: str) -> dict:
+    """
+    Returns the open dataset for a raster file, opening it the first time.
+    Forked worker processes open their own handle, since GDAL file handles can't be shared between processes.
+    If the raster has a memory-mapped copy, we open that instead, and 'dataset' is None.
+    """
+    entry = _datasets.get(path)
+    if entry is not None and entry['pid'] == os.getpid():
+        return entry
+
+    mapped = raster_memmap.open_memmap(path)
+    if mapped is not None:
+        _stats['opens'] += 1
+        entry = {
+            'dataset': None,
+            'memmap': mapped['data'],
+            'pid': os.getpid(),
+            'crs': projection.to_proj(mapped['crs']),
+            'transform': mapped['transform'],
+            'height': mapped['data'].shape[0],
+            'width': mapped['data'].shape[1],
+            'nodata': mapped['nodata'],
+        }
+        _datasets[path] = entry
+        return entry
+
+    if not os.path.isfile(path):
+        raise Exception(f"Could not find raster: {path}")
+
+    f = rasterio.open(path)
+    _stats['opens'] += 1
+
+    # The size of the cache blocks. For a tiled GeoTIFF, the internal tiles. For one that is organized
+    # in strips (rows), several strips at a time, cut into pieces STRIP_BLOCK_SIZE pixels wide.
+    block_height, block_width = f.block_shapes[0]
+    if block_width >= f.width:
+        block_width = STRIP_BLOCK_SIZE
+        block_height = block_height * int(np.ceil(STRIP_BLOCK_SIZE / block_height))
+
+    entry = {
+        'dataset': f,
+        'memmap': None,
+        'pid': os.getpid(),
+        'crs': projection.to_proj(f.crs),
+        'transform': f.transform,
+        'height': f.height,
+        'width': f.width,
+        'nodata': f.nodatavals[0],
+        'block_height': block_height,
+        'block_width': block_width,
+    }
+    _datasets[path] = entry
+    return entry
+
+
+def get_block(path: str, entry: dict, block_row: int, block_col: int) -> np.ndarray:
+    """Returns one decoded block of a raster, from the cache if it is there."""
+    key = (path, block_row, block_col)
+    if key in _blocks:
+        _blocks.move_to_end(key)
+        _stats['hits'] += 1
+        return _blocks[key]
+
+    _stats['misses'] += 1
+    bh, bw = entry['block_height'], entry['block_width']
+    f = entry['dataset']
+    row_off, col_off = block_row * bh, block_col * bw
+    window = rasterio.windows.Window(col_off, row_off, min(bw, f.width - col_off), min(bh, f.height - row_off))
+    block = f.read(1, window=window)
+    _stats['bytes_decoded'] += block.nbytes
+
+    if block.nbytes <= budget_bytes():
+        _blocks[key] = block
+        _stats['bytes'] += block.nbytes
+        while _stats['bytes'] > budget_bytes():
+            _, old_block = _blocks.popitem(last=False)
+            _stats['bytes'] -= old_block.nbytes
+            _stats['evictions'] += 1
+
+    return block
+
+
+def read_pixels(path: str, entry: dict, row_start: int, row_stop: int, col_start: int, col_stop: int) -> np.ndarray:
+    """Returns the rectangle [row_start:row_stop, col_start:col_stop] of the raster, put together from the blocks."""
+    bh, bw = entry['block_height'], entry['block_width']
+    data = None
+    for block_row in range(row_start // bh, (row_stop - 1) // bh + 1):
+        for block_col in range(col_start // bw, (col_stop - 1) // bw + 1):
+            block = get_block(path, entry, block_row, block_col)
+            if data is None:
+                data = np.zeros((row_stop - row_start, col_stop - col_start), dtype=block.dtype)
+
+            # The part of this block that is inside the rectangle, in raster coordinates
+            r0, r1 = max(row_start, block_row * bh), min(row_stop, (block_row + 1) * bh)
+            c0, c1 = max(col_start, block_col * bw), min(col_stop, (block_col + 1) * bw)
+            data[r0 - row_start:r1 - row_start, c0 - col_start:c1 - col_start] = \
+                block[r0 - block_row * bh:r1 - block_row * bh, c0 - block_col * bw:c1 - block_col * bw]
+    return data
+
+
+def read_window(path: str, bounding_box: tuple, nodata=None) -> Raster:
+    """
+    Reads part of a raster. This is a replacement for pysheds' grid.read_raster(path, window=bounding_box),
+    and returns the same thing: a pysheds Raster with the pixels in the bounding box.
+
+    Args:
+        path: the GeoTIFF file
+        bounding_box: (xmin, ymin, xmax, ymax), in the raster's coordinate system
+        nodata: the value for "no data". If None, uses the one in the file.
+
+    pysheds (rasterio) reads the window with its fractional pixel offsets, so GDAL picks the nearest source
+    pixel for each output pixel, and the affine transform keeps the fractional offset. We do the same here,
+    including the way that rasterio cuts off the part of the window that is outside of the raster.
+    """
+    entry = get_dataset(path)
+    window = rasterio.windows.from_bounds(*bounding_box, transform=entry['transform'])
+
+    # rasterio only reads the part of the window that is inside of the raster
+    row_start, row_stop = max(window.row_off, 0), min(window.row_off + window.height, entry['height'])
+    col_start, col_stop = max(window.col_off, 0), min(window.col_off + window.width, entry['width'])
+    n_rows = int(round(row_stop - row_start))
+    n_cols = int(round(col_stop - col_start))
+    if n_rows <= 0 or n_cols <= 0:
+        raise Exception(f"The window {bounding_box} is outside of the raster {path}")
+
+    # The source pixel for each output pixel, the way GDAL does it for nearest-neighbour sampling
+    rows = np.floor(row_start + (np.arange(n_rows) + 0.5) * (row_stop - row_start) / n_rows + 1e-10).astype(int)
+    cols = np.floor(col_start + (np.arange(n_cols) + 0.5) * (col_stop - col_start) / n_cols + 1e-10).astype(int)
+
+    if entry['memmap'] is not None:
+        # Just a copy of the pixels in the window, without decoding anything
+        data = entry['memmap'][np.ix_(rows, cols)]
+        _stats['mapped'] += 1
+    else:
+        data = read_pixels(path, entry, rows[0], rows[-1] + 1, cols[0], cols[-1] + 1)
+        data = data[np.ix_(rows - rows[0], cols - cols[0])]
+
+    if nodata is None:
+        nodata = entry['nodata']
+        nodata = 0 if nodata is None else data.dtype.type(nodata)
+
+    viewfinder = ViewFinder(affine=rasterio.windows.transform(window, entry['transform']), shape=data.shape,
+                            nodata=nodata, crs=entry['crs'])
+    return Raster(data, viewfinder)
+
+
+def stats() -> dict:
+    """Returns the cache counters: hits, misses, evictions, bytes decoded, files opened, and the blocks and bytes held."""
+    return dict(_stats, blocks=len(_blocks))
+
+
+def add_stats(counts: dict):
+    """Adds the counters from a worker process (see delineate.run_jobs) to the ones in this process."""
+    for k in ('hits', 'misses', 'bytes_decoded', 'opens', 'mapped'):
+        _stats[k] += counts.get(k, 0)
+
+
+def report():
+    """Prints a one-line summary of the cache counters."""
+    s = stats()
+    lookups = s['hits'] + s['misses']
+    hit_rate = s['hits'] / lookups if lookups > 0 else 0
+    print(f"Raster block cache: {s['hits']} hits, {s['misses']} misses ({hit_rate:.0%} hit rate), "
+          f"{s['bytes_decoded'] / 1e6:,.0f} MB decoded, {s['opens']} files opened, "
+          f"{s['blocks']} blocks using {s['bytes'] / 1e6:,.0f} of {RASTER_CACHE_MB:,} MB")
+    if s['mapped'] > 0:
+        print(f"Read {s['mapped']} windows from the memory-mapped rasters in {MEMMAP_DIR}")
+
+
+def clear():
+    """Empties the cache, closes the files, and resets the counters."""
+    _blocks.clear()
+    for entry in _datasets.values():
+        if entry['pid'] == os.getpid() and entry['dataset'] is not None:
+            entry['dataset'].close()
+    _datasets.clear()
+    for k in _stats:
+        _stats[k] = 0
@@ -0,0 +1,129 @@
+"""
+Uncompressed, memory-mapped copies of the flow direction and accumulation rasters, for high-res mode.
+
+Even with small tiles (see py/retile.py) and the block cache (see py/raster_cache.py), every window
+that split_catchment() reads has to be decompressed by GDAL, and each worker process keeps its own
+decoded tiles. If you can spare the disk space, we can skip all of that: we save each raster as a plain
+NumPy .npy file, and open it with numpy.memmap. Reading a window is then just a slice of the array.
+The operating system loads the pages of the file that we touch, and keeps them in its file cache,
+where all of the worker processes on the machine (and other jobs) share them.
+
+The files take about 1 byte per pixel for flow direction (uint8) and 4 for accumulation (float32),
+e.g. roughly 6 GB for a large basin's accumulation raster. They go in MEMMAP_DIR, with a small
+JSON "sidecar" file that has the affine transform, the coordinate system and the "no data" value:
+    MEMMAP_DIR/flowdir##.npy, MEMMAP_DIR/flowdir##.json
+    MEMMAP_DIR/accum##.npy, MEMMAP_DIR/accum##.json
+
+The sidecar also has the size and modification time of the GeoTIFF that we made the copy from.
+If the GeoTIFF changes, we don't use the old copy (and print a warning). Make them again with:
+    python prepare_data.py memmap 72
+"""
+import os
+import json
+import time
+import numpy as np
+import rasterio
+from rasterio.crs import CRS
+from rasterio.windows import Window
+from affine import Affine
+from config import *
+
+# Number of rows that we copy at a time
+CHUNK_ROWS = 1024
+
+
+def get_memmap_filenames(path: str, folder: str = None) -> (str, str):
+    """
+    The .npy file and the sidecar for a GeoTIFF, in MEMMAP_DIR (or another folder), e.g.
+        /data/merit/flowdir72.tif -> MEMMAP_DIR/flowdir72.npy, MEMMAP_DIR/flowdir72.json
+    """
+    if folder is None:
+        folder = MEMMAP_DIR
+    stem = os.path.splitext(os.path.basename(path))[0]
+    return f"{folder}/{stem}.npy", f"{folder}/{stem}.json"
+
+
+def source_version(path: str) -> dict:
+    stat = os.stat(path)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def convert(path: str, folder: str = None) -> (str, str):
+    """
+    Saves a copy of the first band of a GeoTIFF as an .npy file, with its sidecar (see the module docstring).
+
+    Args:
+        path: the GeoTIFF
+        folder: where to save the copy. Default: MEMMAP_DIR
+
+    Returns:
+        the names of the .npy file and the sidecar
+    """
+    npy_fname, json_fname = get_memmap_filenames(path, folder)
+    if VERBOSE: print(f"Copying {path} to {npy_fname}")
+
+    # Write to temporary files, so that a copy that was cut short is never used
+    tmp_npy, tmp_json = npy_fname + ".tmp", json_fname + ".tmp"
+    with rasterio.open(path) as f:
+        data = np.lib.format.open_memmap(tmp_npy, mode='w+', dtype=f.dtypes[0], shape=(f.height, f.width))
+        t0 = time.perf_counter()
+        for row in range(0, f.height, CHUNK_ROWS):
+            window = Window(0, row, f.width, min(CHUNK_ROWS, f.height - row))
+            data[row:row + window.height] = f.read(1, window=window)
+            if VERBOSE and (row // CHUNK_ROWS) % 10 == 9:
+                print(f"  {row + window.height:,} of {f.height:,} rows, {time.perf_counter() - t0:.0f} s")
+        data.flush()
+        del data
+
+        sidecar = {
+            'transform': list(f.transform)[:6],
+            'crs': f.crs.to_wkt() if f.crs is not None else None,
+            'nodata': f.nodatavals[0],
+            'dtype': f.dtypes[0],
+            'width': f.width,
+            'height': f.height,
+            'source': os.path.abspath(path),
+            'source_version': source_version(path),
+        }
+    with open(tmp_json, 'w') as out:
+        json.dump(sidecar, out, indent=2)
+
+    os.replace(tmp_npy, npy_fname)
+    os.replace(tmp_json, json_fname)
+    return npy_fname, json_fname
+
+
+def open_memmap(path: str) -> dict or None:
+    """
+    Opens the memory-mapped copy of a GeoTIFF, if there is one in MEMMAP_DIR and it is up to date.
+
+    Returns:
+        None, or a dict with:
+            data: the read-only memory-mapped array
+            transform: the affine transform of the raster
+            crs: its coordinate system (a rasterio CRS, or None)
+            nodata: its "no data" value, or None
+    """
+    if MEMMAP_DIR == '':
+        return None
+    npy_fname, json_fname = get_memmap_filenames(path)
+    if not os.path.isfile(npy_fname) or not os.path.isfile(json_fname):
+        return None
+
+    with open(json_fname) as f:
+        sidecar = json.load(f)
+    if os.path.isfile(path) and source_version(path) != sidecar['source_version']:
+        print(f"Warning: {path} has changed since {npy_fname} was made. Reading the GeoTIFF instead. "
+              f"Please run prepare_data.py memmap again.")
+        return None
+
+    data = np.load(npy_fname, mmap_mode='r')
+    if data.shape != (sidecar['height'], sidecar['width']) or data.dtype != np.dtype(sidecar['dtype']):
+        raise Exception(f"{npy_fname} does not match its sidecar file {json_fname}")
+
+    return {
+        'data': data,
+        'transform': Affine(*sidecar['transform']),
+        'crs': CRS.from_wkt(sidecar['crs']) if sidecar['crs'] is not None else None,
+        'nodata': sidecar['nodata'],
+    }
@@ -0,0 +1,152 @@
+"""
+Rewrites the flow direction and accumulation rasters as cloud-optimized GeoTIFFs, with small internal tiles.
+
+split_catchment() reads a small window of flowdir{basin}.tif and accum{basin}.tif for every outlet
+(see py/raster_cache.py). GDAL has to decode every internal block that the window touches, so the read
+is only as fast as the layout of the file allows. If the raster is organized in strips (rows), or in large
+blocks with a slow codec, a window of a couple of hundred pixels decodes a lot of pixels that we don't need.
+
+Here we copy a raster with GDAL's COG driver: a GeoTIFF with BLOCK_SIZE x BLOCK_SIZE tiles, lined up with
+the pixel grid, and the index of the tiles at the start of the file. The tiles are compressed with ZSTD,
+which is much faster to decode than DEFLATE (or with LZW if GDAL was built without ZSTD). We leave out the
+overviews, which we don't use. Then we check that the new file is exactly the same as the original, pixel by
+pixel, and time reading typical windows from both of them.
+
+Run it with prepare_data.py, and then point MERIT_FDIR_DIR and MERIT_ACCUM_DIR in config.py to the new folder:
+
+    python prepare_data.py retile 72 --out /data/merit_tiled
+    python prepare_data.py retile --files ../PySheds/data/Rasters/hyd_na_dir_15s.tif --out ../PySheds/data/tiled
+"""
+import os
+import time
+import numpy as np
+import geopandas as gpd
+import rasterio
+import rasterio.shutil
+import rasterio.transform
+from rasterio.io import MemoryFile
+from rasterio.windows import Window
+import py.raster_cache as raster_cache
+
+# Size of the internal tiles, in pixels. A typical unit catchment window is 100 to 300 pixels across.
+BLOCK_SIZE = 256
+
+# Number of rows that we compare at a time, when checking the new file
+VERIFY_ROWS = 1024
+
+
+def fast_codec() -> str:
+    """Returns ZSTD if this build of GDAL can write it, otherwise LZW."""
+    try:
+        with MemoryFile() as memfile:
+            with memfile.open(driver='GTiff', width=16, height=16, count=1, dtype='uint8', tiled=True,
+                              blockxsize=16, blockysize=16, compress='ZSTD',
+                              transform=rasterio.transform.from_origin(0, 16, 1, 1)) as f:
+                f.write(np.zeros((1, 16, 16), dtype=np.uint8))
+        return 'ZSTD'
+    except Exception:
+        return 'LZW'
+
+
+def describe(path: str) -> str:
+    """One line about the layout of a raster: size, data type, blocks, and compression."""
+    with rasterio.open(path) as f:
+        block_height, block_width = f.block_shapes[0]
+        compress = f.compression.value if f.compression is not None else 'none'
+        return (f"{f.width:,} x {f.height:,} {f.dtypes[0]}, {block_width} x {block_height} blocks, {compress}, "
+                f"{os.path.getsize(path) / 1e6:,.1f} MB")
+
+
+def retile_raster(src_path: str, dst_path: str, block_size: int = BLOCK_SIZE, compress: str = None):
+    """
+    Copies a raster to a cloud-optimized GeoTIFF with small tiles (see the module docstring).
+
+    Args:
+        src_path: the original raster
+        dst_path: the new raster. It can't be the same file.
+        block_size: the width and height of the tiles, in pixels (a multiple of 16)
+        compress: the codec. If None, uses ZSTD if we have it, otherwise LZW.
+    """
+    if os.path.abspath(src_path) == os.path.abspath(dst_path):
+        raise Exception(f"Please write the tiled raster to another file, not over the original: {src_path}")
+    if block_size % 16 != 0:
+        raise Exception(f"The block size must be a multiple of 16. We got {block_size}")
+    if compress is None:
+        compress = fast_codec()
+
+    with rasterio.Env() as env:
+        has_cog = 'COG' in env.drivers()
+
+    if has_cog:
+        rasterio.shutil.copy(src_path, dst_path, driver='COG', BLOCKSIZE=block_size, COMPRESS=compress,
+                             OVERVIEWS='NONE', BIGTIFF='IF_SAFER', NUM_THREADS='ALL_CPUS')
+    else:
+        # Older versions of GDAL (before 3.1) don't have the COG driver. A tiled GeoTIFF reads just as fast.
+        rasterio.shutil.copy(src_path, dst_path, driver='GTiff', TILED='YES', BLOCKXSIZE=block_size,
+                             BLOCKYSIZE=block_size, COMPRESS=compress, BIGTIFF='IF_SAFER', NUM_THREADS='ALL_CPUS')
+
+
+def verify_raster(src_path: str, dst_path: str):
+    """
+    Checks that two rasters have the same pixels, size, affine transform, coordinate system,
+    data type and "no data" value. Raises an exception if they don't.
+    """
+    with rasterio.open(src_path) as src, rasterio.open(dst_path) as dst:
+        for name in ('width', 'height', 'count', 'dtypes', 'nodatavals', 'transform', 'crs'):
+            if getattr(src, name) != getattr(dst, name):
+                raise Exception(f"The {name} of {dst_path} is not the same as in {src_path}: "
+                                f"{getattr(dst, name)} vs. {getattr(src, name)}")
+
+        for band in range(1, src.count + 1):
+            for row in range(0, src.height, VERIFY_ROWS):
+                window = Window(0, row, src.width, min(VERIFY_ROWS, src.height - row))
+                a, b = src.read(band, window=window), dst.read(band, window=window)
+                same = (a == b) | (np.isnan(a) & np.isnan(b)) if np.issubdtype(a.dtype, np.floating) else a == b
+                if not same.all():
+                    i, j = np.argwhere(~same)[0]
+                    raise Exception(f"{dst_path} is not the same as {src_path}: {np.count_nonzero(~same):,} pixels "
+                                    f"differ in rows {row:,} to {row + window.height:,}, the first at row "
+                                    f"{row + i:,}, column {j:,} (band {band})")
+
+
+def catchment_windows(catchments_gdf: gpd.GeoDataFrame, n: int) -> list:
+    """The windows that split_catchment() reads, for a random sample of unit catchments."""
+    from py.merit_detailed import get_bounding_box
+    sample = catchments_gdf.sample(min(n, len(catchments_gdf)), random_state=0)
+    return [get_bounding_box(poly) for poly in sample.geometry]
+
+
+def random_windows(path: str, n: int, size: int = 200) -> list:
+    """Square windows of size x size pixels, at random places in a raster."""
+    rng = np.random.default_rng(0)
+    with rasterio.open(path) as f:
+        windows = []
+        for k in range(n):
+            row = rng.integers(0, max(f.height - size, 0) + 1)
+            col = rng.integers(0, max(f.width - size, 0) + 1)
+            windows.append(tuple(rasterio.windows.bounds(Window(col, row, size, size), f.transform)))
+    return windows
+
+
+def time_windows(path: str, bounding_boxes: list) -> dict:
+    """
+    Times reading windows of a raster, the way split_catchment() does (see py/raster_cache.py).
+    Each window is read "cold", with the file just opened and nothing in the block cache,
+    like the first outlet in a unit catchment.
+
+    Returns:
+        a dict with the median and mean time per window, in milliseconds,
+        and the mean number of megabytes that were decoded for each window
+    """
+    times = []
+    decoded = 0
+    for bounding_box in bounding_boxes:
+        raster_cache.clear()
+        t0 = time.perf_counter()
+        raster_cache.read_window(path, bounding_box)
+        times.append(time.perf_counter() - t0)
+        decoded += raster_cache.stats()['bytes_decoded']
+    raster_cache.clear()
+    times = np.array(times) * 1000
+    return {'median_ms': float(np.median(times)), 'mean_ms': float(times.mean()),
+            'decoded_mb': decoded / len(bounding_boxes) / 1e6}
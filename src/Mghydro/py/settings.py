@@ -0,0 +1,117 @@
+"""
+Settings for a delineation run, as an object that we can pass around, instead of global variables.
+
+delineate() (the command-line workflow) takes all of its options from config.py. To call the
+delineation from another Python program, e.g. a batch driver that streams thousands of outlets
+through one process, use delineate_batch() in delineate.py with a Settings object:
+
+    from py.settings import Settings
+    from delineate import delineate_batch
+
+    settings = Settings.from_config(high_res=False, output_dir='', make_map=False)
+    watersheds_gdf, status_df = delineate_batch(points_df, settings)
+
+Each field has the same name as the option in config.py, in lower case. See config.py for what they do.
+Settings.from_config() starts from the values in config.py, and you can override any of them.
+
+The locations of the input vector data (catchments, rivers, the Level 2 basins and PICKLE_DIR)
+are not in here; these are still read from config.py, because the loaded data is shared between
+runs (see py/basin_cache.py).
+"""
+from dataclasses import dataclass, fields, replace
+import config
+
+
+@dataclass(frozen=True)
+class Settings:
+    # Delineation
+    high_res: bool
+    low_res_threshold: float
+    search_dist: float
+    predissolve: bool
+    dissolve_method: str
+    dissolve_workers: int
+    dissolve_chunk_size: int
+    dissolve_memory_mb: float
+    deduplicate: bool
+    nested: bool
+    match_areas: bool
+    area_matching_threshold: float
+    max_dist: float
+
+    # Raster-based delineation in high-res mode
+    merit_fdir_dir: str
+    merit_accum_dir: str
+    threshold_single: int
+    threshold_multiple: int
+    tracer: str
+    polygonize: str
+    batch_split: bool
+    stream_index: bool
+    split_cache: str
+    catchment_labels: bool
+
+    # Post-processing of the watershed polygon
+    fill: bool
+    fill_threshold: int
+    simplify: bool
+    simplify_tolerance: float
+
+    # Output. Set output_dir = '' to not write any files (the results are still returned).
+    output_dir: str
+    output_prefix: str
+    output_ext: str
+    output_csv: bool
+    make_map: bool
+    map_folder: str
+    map_rivers: bool
+    num_stream_orders: int
+
+    # Number of worker processes for the outlets in each Level 2 basin
+    workers: int
+
+    # Messages and debugging plots
+    verbose: bool
+    plots: bool
+
+    def __post_init__(self):
+        if self.workers < 1:
+            raise Exception(f"WORKERS must be 1 or more. We got {self.workers}")
+        if self.tracer not in ("builtin", "pysheds"):
+            raise Exception(f"TRACER must be 'builtin' or 'pysheds'. We got '{self.tracer}'")
+        if self.polygonize not in ("trace", "trace_holes", "pysheds"):
+            raise Exception(f"POLYGONIZE must be 'trace', 'trace_holes' or 'pysheds'. We got '{self.polygonize}'")
+        if self.dissolve_method not in ("clip", "coverage", "snap", "edges"):
+            raise Exception(f"DISSOLVE_METHOD must be 'clip', 'coverage', 'snap' or 'edges'. "
+                            f"We got '{self.dissolve_method}'")
+        if self.dissolve_workers < 1:
+            raise Exception(f"DISSOLVE_WORKERS must be 1 or more. We got {self.dissolve_workers}")
+        if self.dissolve_chunk_size < 2:
+            raise Exception(f"DISSOLVE_CHUNK_SIZE must be 2 or more. We got {self.dissolve_chunk_size}")
+
+    @classmethod
+    def from_config(cls, **overrides) -> 'Settings':
+        """
+        Makes a Settings object with the current values in config.py, plus any overrides,
+        e.g. Settings.from_config(high_res=False)
+        """
+        names = [f.name for f in fields(cls)]
+        for name in overrides:
+            if name not in names:
+                raise Exception(f"Unknown setting: {name}")
+        values = dict(overrides)
+        for name in names:
+            if name not in values:
+                if not hasattr(config, name.upper()):
+                    raise Exception(f"{name.upper()} is not set in config.py. Please add it, or pass {name}=...")
+                values[name] = getattr(config, name.upper())
+        return cls(**values)
+
+    def replace(self, **changes) -> 'Settings':
+        """Returns a copy of these settings with some values changed."""
+        return replace(self, **changes)
+
+    @property
+    def write_files(self) -> bool:
+        """True if we should write output files (watersheds, OUTPUT.csv, FAILED.csv) to output_dir."""
+        return self.output_dir != ''
@@ -0,0 +1,61 @@
+"""
+Signatures of the unit catchments and the river network, to check the files that we build from them ahead of time.
+
+prepare_data.py builds the pre-dissolved polygons, the stream pixel index, the unit catchment labels and the
+edge index from the unit catchments (and the pre-dissolved polygons also from the river network). If the unit
+catchments or the rivers change after that, e.g. when we download the _bugfix1 files, these files are out of
+date, and using them would quietly give the wrong watersheds. So each one is saved with the signature of the
+data it was built from. When we load it, we compare that with the signature of the data we have now, and if
+they are different, we print a warning and carry on as if the file had not been built.
+
+The signature of the unit catchments is a hash of their COMIDs, and the bounds and number of vertices of their
+polygons. (Hashing every coordinate would take too long in the big basins.) The signature of the river network
+is a hash of the COMIDs and upstream links in the topology index (see py/topology.py).
+"""
+import hashlib
+import numpy as np
+import geopandas as gpd
+import shapely
+
+
+def signature(catchments_gdf: gpd.GeoDataFrame, topo: dict = None) -> str:
+    """
+    Returns the signature of the unit catchments, and of the river network if `topo` is given.
+
+    Args:
+        catchments_gdf: the unit catchments, indexed by COMID
+        topo: the topology index, from py.topology.load_topology()
+    """
+    comids = catchments_gdf.index.to_numpy(dtype=np.int64)
+    order = np.argsort(comids, kind='stable')
+    geoms = catchments_gdf.geometry.to_numpy()[order]
+
+    h = hashlib.sha1()
+    h.update(comids[order].tobytes())
+    h.update(np.ascontiguousarray(shapely.bounds(geoms)).tobytes())
+    h.update(shapely.get_num_coordinates(geoms).astype(np.int64).tobytes())
+    if topo is not None:
+        h.update(b'rivers')
+        h.update(np.ascontiguousarray(topo['comid'], dtype=np.int64).tobytes())
+        h.update(np.ascontiguousarray(topo['up'], dtype=np.int32).tobytes())
+    return h.hexdigest()
+
+
+def matches(saved: str or None, current: str, fname: str) -> bool:
+    """
+    True if a file was built from the data that we have now. If not, prints a warning.
+
+    Args:
+        saved: the signature saved in the file, or None if it doesn't have one (it is from an older version)
+        current: the signature of the data we have now
+        fname: the file, for the warning
+    """
+    if saved == current:
+        return True
+    if saved is None:
+        print(f"Warning: {fname} does not say which unit catchments it was built from, so we don't use it. "
+              "Build it again with prepare_data.py")
+    else:
+        print(f"Warning: {fname} was built from other unit catchments or rivers than the ones we have now, "
+              "so we don't use it. Build it again with prepare_data.py")
+    return False
@@ -0,0 +1,160 @@
+"""
+On-disk cache of the split terminal unit catchments, for high-res mode.
+
+The raster-based split of the terminal unit catchment (see split_catchment) is the slowest step for each outlet,
+but its result only depends on the data and a few settings. So we save the results in an SQLite database
+(SPLIT_CACHE in config.py), which is shared by later runs, other processes, and other jobs on the same machine
+or file system. Running the same outlets again, e.g. after changing a setting that does not affect the split,
+does not read the rasters at all.
+
+There are two tables, both keyed by a hash of everything that goes into the result:
+    snaps: the snapped outlet, by the unit catchment polygon, the outlet coordinates, the snap threshold,
+           and the version of the rasters
+    splits: the split polygon (as WKB), by the unit catchment polygon, the snapped outlet, the method
+            used to make the polygon (POLYGONIZE), and the version of the rasters
+
+"The version of the rasters" is the size and modification time of the flow direction and accumulation files,
+so if these change, we don't use the old results. The unit catchment is identified by its polygon rather
+than its COMID, so the results are not used if the unit catchments change, either.
+Delete the file to empty the cache.
+
+The cache is best-effort: if the database is locked for too long, or its folder or file can't be made or written,
+we carry on without it.
+(SQLite locking does not always work on network file systems. If you see errors, use a local disk.)
+"""
+import os
+import sqlite3
+import hashlib
+import numpy as np
+from shapely import wkb
+from shapely.geometry import Polygon
+from py.settings import Settings
+
+# Seconds to wait for another process that is writing to the database
+TIMEOUT = 60
+
+# path -> (connection, process id that opened it)
+_connections = {}
+
+# (fdir path, accum path) -> version string
+_versions = {}
+
+_stats = {'hits': 0, 'misses': 0, 'writes': 0, 'errors': 0}
+
+
+def get_connection(path: str) -> sqlite3.Connection:
+    """
+    Returns the connection to the cache database, opening it (and making the tables) the first time.
+    Forked worker processes open their own connection.
+    """
+    entry = _connections.get(path)
+    if entry is not None and entry[1] == os.getpid():
+        return entry[0]
+
+    folder = os.path.dirname(path)
+    if folder != '':
+        os.makedirs(folder, exist_ok=True)
+    connection = sqlite3.connect(path, timeout=TIMEOUT, isolation_level=None)
+    connection.execute("CREATE TABLE IF NOT EXISTS snaps (key TEXT PRIMARY KEY, basin INTEGER, "
+                       "lng_snap REAL, lat_snap REAL)")
+    connection.execute("CREATE TABLE IF NOT EXISTS splits (key TEXT PRIMARY KEY, basin INTEGER, "
+                       "lat_snap REAL, lng_snap REAL, poly BLOB)")
+    _connections[path] = (connection, os.getpid())
+    return connection
+
+
+def data_version(basin: int, settings: Settings) -> str:
+    """The size and modification time of the flow direction and accumulation rasters for the basin."""
+    paths = (f"{settings.merit_fdir_dir}/flowdir{basin}.tif", f"{settings.merit_accum_dir}/accum{basin}.tif")
+    if paths not in _versions:
+        parts = []
+        for path in paths:
+            stat = os.stat(path) if os.path.isfile(path) else None
+            parts.append(f"{os.path.basename(path)}:{stat.st_size}:{stat.st_mtime_ns}" if stat else "missing")
+        _versions[paths] = ";".join(parts)
+    return _versions[paths]
+
+
+def make_key(*parts) -> str:
+    """Hash of the parts. Floats are written with repr(), so that the key is exact."""
+    return hashlib.sha1("|".join(repr(part) for part in parts).encode()).hexdigest()
+
+
+def catchment_key(catchment_poly: Polygon) -> str:
+    return hashlib.sha1(catchment_poly.wkb).hexdigest()
+
+
+def snap_key(basin: int, catchment_poly: Polygon, lat: float, lng: float, threshold: int,
+             settings: Settings) -> str:
+    return make_key("snap", basin, catchment_key(catchment_poly), float(lat), float(lng), int(threshold),
+                    data_version(basin, settings))
+
+
+def split_key(basin: int, catchment_poly: Polygon, lng_snap: float, lat_snap: float, settings: Settings) -> str:
+    # The snap threshold does not matter here, once we know where the outlet snapped to
+    hole_threshold = settings.fill_threshold if settings.fill else 0
+    method = (settings.polygonize, hole_threshold) if settings.polygonize == "trace_holes" else settings.polygonize
+    return make_key("split", basin, catchment_key(catchment_poly), float(lng_snap), float(lat_snap), method,
+                    data_version(basin, settings))
+
+
+def query(settings: Settings, sql: str, args: tuple) -> tuple or None:
+    """Runs a query and returns the first row, or None if there isn't one or something went wrong."""
+    try:
+        row = get_connection(settings.split_cache).execute(sql, args).fetchone()
+    except (sqlite3.Error, OSError) as e:
+        _stats['errors'] += 1
+        if settings.verbose: print(f"Could not read the split cache: {e}")
+        return None
+    _stats['hits' if row is not None else 'misses'] += 1
+    return row
+
+
+def write(settings: Settings, sql: str, args: tuple):
+    try:
+        get_connection(settings.split_cache).execute(sql, args)
+        _stats['writes'] += 1
+    except (sqlite3.Error, OSError) as e:
+        _stats['errors'] += 1
+        if settings.verbose: print(f"Could not write to the split cache: {e}")
+
+
+def get_snap(key: str, settings: Settings) -> tuple or None:
+    """Returns the snapped outlet (lng_snap, lat_snap), or None if it is not in the cache."""
+    row = query(settings, "SELECT lng_snap, lat_snap FROM snaps WHERE key = ?", (key,))
+    if row is None:
+        return None
+    # NumPy floats, like the ones from pysheds (these round differently than Python floats)
+    return np.float64(row[0]), np.float64(row[1])
+
+
+def put_snap(key: str, basin: int, lng_snap: float, lat_snap: float, settings: Settings):
+    write(settings, "INSERT OR REPLACE INTO snaps VALUES (?, ?, ?, ?)",
+          (key, basin, float(lng_snap), float(lat_snap)))
+
+
+def get_split(key: str, settings: Settings) -> tuple or None:
+    """Returns the result of split_catchment(), (poly, lat_snap, lng_snap), or None if it is not in the cache."""
+    row = query(settings, "SELECT poly, lat_snap, lng_snap FROM splits WHERE key = ?", (key,))
+    if row is None:
+        return None
+    return wkb.loads(row[0]), np.float64(row[1]), np.float64(row[2])
+
+
+def put_split(key: str, basin: int, result: tuple, settings: Settings):
+    poly, lat_snap, lng_snap = result
+    write(settings, "INSERT OR REPLACE INTO splits VALUES (?, ?, ?, ?, ?)",
+          (key, basin, float(lat_snap), float(lng_snap), poly.wkb))
+
+
+def stats() -> dict:
+    """Returns the counters: hits, misses, writes and errors."""
+    return dict(_stats)
+
+
+def close():
+    """Closes the database, e.g. before deleting the file."""
+    for connection, pid in _connections.values():
+        if pid == os.getpid():
+            connection.close()
+    _connections.clear()
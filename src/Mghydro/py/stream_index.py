@@ -0,0 +1,168 @@
+"""
+Index of the stream pixels in each unit catchment, for snapping the outlets without reading the rasters.
+
+In high-res mode, split_catchment() snaps the outlet to the nearest pixel in the terminal unit catchment
+with more than THRESHOLD_SINGLE or THRESHOLD_MULTIPLE upstream pixels. To do that, it reads the
+accumulation raster in the window, masks it to the unit catchment, and searches the whole window.
+
+In an offline step (see prepare_data.py), we do this once for every high-res unit catchment in the basin,
+and keep the pixels with more upstream pixels than the smallest threshold, along with their accumulation.
+At delineation time, snapping is a nearest-neighbour search in a KD-tree of the stream pixels in the
+terminal unit catchment that are over the threshold, for all of its outlets at once.
+The pixels are kept in the same order and coordinates as in the masked window, so we get the same
+snapped point as pysheds' snap_to_mask() in split_catchment().
+
+The index is saved next to the pickle files, as PICKLE_DIR/streams_##.npz, with the arrays:
+    comid: the unit catchments, sorted
+    start: the stream pixels of comid[i] are start[i]:start[i + 1] in the arrays below
+    affine: for each unit catchment, the affine transform (a, b, c, d, e, f) of its masked window
+    row, col: the stream pixels, in the masked window
+    acc: the number of upstream pixels of each stream pixel
+    threshold: we kept the pixels with more than this many upstream pixels
+    source: the signature of the unit catchments it was built from (see py/signature.py)
+"""
+import os
+import time
+import numpy as np
+import geopandas as gpd
+from scipy.spatial import cKDTree
+from affine import Affine
+from pysheds.sview import View
+from config import *
+from py.settings import Settings
+from py.signature import signature, matches
+
+
+def get_stream_index_filename(basin: int) -> str:
+    """
+    Standard filename for the stream pixel index, stored next to the pickle files:
+        PICKLE_DIR/streams_##.npz
+    """
+    return f'{PICKLE_DIR}/streams_{basin}.npz'
+
+
+def build_stream_index(catchments_gdf: gpd.GeoDataFrame, basin: int, threshold: int,
+                       settings: Settings = None) -> dict:
+    """
+    Finds the stream pixels in each of the high-res unit catchments in a basin.
+
+    Args:
+        catchments_gdf: the high-res unit catchments, indexed by COMID
+        basin: the Level 2 basin, which tells us which rasters to read
+        threshold: keep the pixels with more than this many upstream pixels.
+            Snapping with a lower threshold than this falls back to the rasters.
+        settings: see py/settings.py. If None, uses the values in config.py
+
+    Returns:
+        a dict of NumPy arrays, see the module docstring
+    """
+    from py.merit_detailed import read_windows
+    if settings is None:
+        settings = Settings.from_config()
+    settings = settings.replace(verbose=False, plots=False)
+
+    comids = np.sort(catchments_gdf.index.to_numpy())
+    geoms = catchments_gdf.geometry
+    start = np.zeros(len(comids) + 1, dtype=np.int64)
+    affines = np.full((len(comids), 6), np.nan)
+    rows, cols, accs = [], [], []
+    n_failed = 0
+    t0 = time.perf_counter()
+
+    for i, comid in enumerate(comids):
+        try:
+            grid, fdir, acc = read_windows('', basin, 0, 0, geoms.loc[comid], settings, comid=comid)
+        except Exception as e:
+            # We leave out this unit catchment. Its outlets are snapped with the rasters, like before.
+            n_failed += 1
+            if VERBOSE: print(f"  could not read the rasters for unit catchment {comid}: {e}")
+            start[i + 1] = start[i]
+            continue
+
+        # This is the masked accumulation as snap_to_mask() sees it, in the view of the clipped grid
+        acc_view = np.asarray(grid.view(acc))
+        row, col = np.nonzero(acc_view > threshold)
+        rows.append(row.astype(np.int32))
+        cols.append(col.astype(np.int32))
+        accs.append(acc_view[row, col])
+        affines[i] = tuple(grid.affine)[:6]
+        start[i + 1] = start[i] + len(row)
+
+        if VERBOSE and (i + 1) % 10000 == 0:
+            print(f"  {i + 1:,} of {len(comids):,} unit catchments, {time.perf_counter() - t0:.0f} s")
+
+    if n_failed > 0:
+        print(f"Warning: could not read the rasters for {n_failed} unit catchments in basin {basin}")
+
+    return {
+        'comid': comids,
+        'start': start,
+        'affine': affines,
+        'row': np.concatenate(rows) if rows else np.zeros(0, dtype=np.int32),
+        'col': np.concatenate(cols) if cols else np.zeros(0, dtype=np.int32),
+        'acc': np.concatenate(accs) if accs else np.zeros(0),
+        'threshold': np.array(threshold),
+        'source': np.array(signature(catchments_gdf)),
+    }
+
+
+def save_stream_index(index: dict, basin: int):
+    fname = get_stream_index_filename(basin)
+    if VERBOSE: print(f"Saving stream pixel index to: {fname}")
+    np.savez(fname, **index)
+
+
+def load_stream_index(basin: int, source: str = None) -> dict or None:
+    """
+    Returns the stream pixel index for a basin, or None if it has not been built.
+    Run `python prepare_data.py streams` to build it.
+    If `source` is given (from py.signature.signature()), also returns None if it was built from other data.
+    """
+    if PICKLE_DIR == '':
+        return None
+    fname = get_stream_index_filename(basin)
+    if not os.path.isfile(fname):
+        return None
+    if VERBOSE: print(f"Fetching BASIN # {basin} stream pixel index from {fname}")
+    with np.load(fname) as npz:
+        index = {key: npz[key] for key in npz.files}
+    saved = str(index['source']) if 'source' in index else None
+    if source is not None and not matches(saved, source, fname):
+        return None
+    return index
+
+
+def snap(index: dict, comid: int, xy: np.ndarray, threshold: int) -> np.ndarray or None:
+    """
+    Snaps points in a unit catchment to the nearest pixel with more than `threshold` upstream pixels.
+    Same as grid.snap_to_mask(acc > threshold, xy) in split_catchment().
+
+    Args:
+        index: from load_stream_index()
+        comid: the unit catchment that the points are in
+        xy: array with shape (N, 2) of the (lng, lat) of the points
+        threshold: the minimum number of upstream pixels (see merit_detailed.get_threshold)
+
+    Returns:
+        array with shape (N, 2) of the snapped (lng, lat), or None if we can't snap these points
+        with the index: the unit catchment is not in it, the threshold is lower than the one it was
+        built with, or there are no pixels over the threshold (snapping with the rasters fails too).
+    """
+    i = np.searchsorted(index['comid'], comid)
+    if i == len(index['comid']) or index['comid'][i] != comid or np.isnan(index['affine'][i, 0]):
+        return None
+    if threshold < index['threshold']:
+        return None
+
+    s = slice(index['start'][i], index['start'][i + 1])
+    keep = index['acc'][s] > threshold
+    if not keep.any():
+        return None
+
+    # Pixel (upper-left corner) coordinates, with the same function that pysheds uses
+    affine = Affine(*index['affine'][i])
+    x, y = View.affine_transform(affine, index['col'][s][keep], index['row'][s][keep])
+    tree_xy = np.column_stack([x, y])
+    tree = cKDTree(tree_xy)
+    dist, ix = tree.query(np.asarray(xy, dtype=np.float64))
+    return tree_xy[ix]
@@ -0,0 +1,272 @@
+"""
+Array-backed river network topology for a Level 2 megabasin.
+
+The MERIT-Basins rivers table stores the network as the fields up1, up2, up3 and up4,
+which hold the COMIDs of the (up to four) river reaches that flow into each reach.
+Walking that table one reach at a time with pandas lookups is slow in big basins,
+and a recursive walk can exceed Python's recursion limit on long rivers.
+
+Here we convert the table ONCE per basin into a few compact NumPy arrays:
+
+    comid     int64, COMID of each row
+    lookup    int32, maps (COMID - comid_base) -> row, or -1 if there is no such reach
+    parent    int32, row of the downstream reach, or -1 for an outlet to the sea / sink
+    up        int32, shape (n, 4), rows of the upstream reaches, or -1
+
+plus a "nested set" labeling of the river forest. We number the reaches in pre-order,
+i.e. every reach comes immediately before all of the reaches upstream of it:
+
+    preorder        int32, the rows, in pre-order
+    preorder_comid  int64, the COMIDs, in pre-order
+    entry           int32, position of each row in the pre-order arrays
+    size            int32, number of unit catchments upstream of each row (including itself)
+
+With this labeling, the upstream unit catchments of any reach are a single contiguous slice,
+preorder_comid[entry[row] : entry[row] + size[row]], so that a query is O(1) and never
+re-walks the same subtrees, no matter how many outlets we delineate in a basin.
+
+The arrays are saved in a small .npz file next to the pickle files, so we only build them once.
+When we read them back, we check that the COMIDs and upstream links still match the rivers table.
+"""
+import os
+import numpy as np
+import pandas as pd
+from config import *
+
+# The fields in the MERIT-Basins rivers shapefiles that hold the upstream COMIDs
+UP_FIELDS = ['up1', 'up2', 'up3', 'up4']
+
+# The arrays that we expect to find in a saved topology file
+TOPOLOGY_KEYS = {'comid', 'comid_base', 'lookup', 'parent', 'up', 'preorder', 'preorder_comid', 'entry', 'size'}
+
+
+def build_topology(rivers_df: pd.DataFrame) -> dict:
+    """
+    Builds the array-backed topology index from the MERIT-Basins rivers table.
+
+    Args:
+        rivers_df: DataFrame (or GeoDataFrame) indexed by COMID, with the fields up1 to up4
+
+    Returns:
+        a dict of NumPy arrays, see the module docstring
+    """
+    comid = rivers_df.index.to_numpy(dtype=np.int64)
+    n = len(comid)
+    comid_base, lookup, up = link_rows(rivers_df)
+
+    # Each reach has at most one downstream neighbor
+    parent = np.full(n, -1, dtype=np.int32)
+    rows = np.repeat(np.arange(n, dtype=np.int32), len(UP_FIELDS)).reshape(up.shape)
+    has_up = up >= 0
+    parent[up[has_up]] = rows[has_up]
+
+    topo = {
+        'comid': comid,
+        'comid_base': np.int64(comid_base),
+        'lookup': lookup,
+        'parent': parent,
+        'up': up,
+    }
+    topo.update(build_nested_set(topo))
+    return topo
+
+
+def link_rows(rivers_df: pd.DataFrame) -> (np.int64, np.ndarray, np.ndarray):
+    """
+    Converts the COMIDs in the fields up1 to up4 of the rivers table to rows.
+
+    Returns:
+        comid_base, lookup, up: see the module docstring
+    """
+    comid = rivers_df.index.to_numpy(dtype=np.int64)
+    up_comids = rivers_df[UP_FIELDS].to_numpy(dtype=np.int64)
+
+    # MERIT COMIDs are the basin code times one million plus a sequence number,
+    # so a dense lookup table is small (at most 1 million entries per basin).
+    comid_base = comid.min()
+    lookup = np.full(comid.max() - comid_base + 1, -1, dtype=np.int32)
+    lookup[comid - comid_base] = np.arange(len(comid), dtype=np.int32)
+
+    up = np.full((len(comid), len(UP_FIELDS)), -1, dtype=np.int32)
+    valid = (up_comids != 0) & (up_comids >= comid_base) & (up_comids <= comid.max())
+    up[valid] = lookup[up_comids[valid] - comid_base]
+    return np.int64(comid_base), lookup, up
+
+
+def matches_rivers(topo: dict, rivers_df: pd.DataFrame) -> bool:
+    """
+    True if the topology index was built from this rivers table: the same COMIDs, in the same order,
+    with the same upstream reaches. (The new versions of the MERIT-Basins files, e.g. _bugfix1, have the
+    same number of reaches as the old ones, but some of the links are different.)
+    """
+    if not np.array_equal(topo['comid'], rivers_df.index.to_numpy(dtype=np.int64)):
+        return False
+    return np.array_equal(topo['up'], link_rows(rivers_df)[2])
+
+
+def build_nested_set(topo: dict) -> dict:
+    """
+    Computes the pre-order (nested set) labeling of the river forest.
+
+    Everything is done one "generation" of reaches at a time with array operations:
+    first we go downstream to upstream to find the generations, then upstream to downstream to
+    add up the subtree sizes, and finally downstream to upstream again to hand out the entry numbers.
+    Each reach's entry number is its parent's, plus one, plus the sizes of the siblings before it.
+
+    Args:
+        topo: dict with the arrays 'comid', 'parent' and 'up' from build_topology()
+
+    Returns:
+        dict with the arrays 'preorder', 'preorder_comid', 'entry' and 'size'
+    """
+    comid = topo['comid']
+    parent = topo['parent']
+    up = topo['up']
+    n = len(comid)
+
+    # Generations, starting from the outlets to the sea (or to internal sinks)
+    generations = []
+    frontier = np.flatnonzero(parent < 0).astype(np.int32)
+    while frontier.size > 0:
+        generations.append(frontier)
+        frontier = up[frontier].ravel()
+        frontier = frontier[frontier >= 0]
+
+    size = np.ones(n, dtype=np.int32)
+    for generation in reversed(generations[1:]):
+        np.add.at(size, parent[generation], size[generation])
+
+    entry = np.full(n, -1, dtype=np.int32)
+    roots = generations[0] if generations else np.empty(0, dtype=np.int32)
+    entry[roots] = np.cumsum(size[roots]) - size[roots]
+    for generation in generations:
+        next_entry = entry[generation] + 1
+        for k in range(up.shape[1]):
+            children = up[generation, k]
+            has_child = children >= 0
+            children = children[has_child]
+            entry[children] = next_entry[has_child]
+            next_entry[has_child] += size[children]
+
+    # Reaches that are never reached from an outlet can only come from a cycle in the data.
+    # Leave them out of the pre-order arrays.
+    labeled = np.flatnonzero(entry >= 0)
+    preorder = np.empty(len(labeled), dtype=np.int32)
+    preorder[entry[labeled]] = labeled
+
+    return {
+        'preorder': preorder,
+        'preorder_comid': comid[preorder],
+        'entry': entry,
+        'size': size,
+    }
+
+
+def comid_to_row(topo: dict, comids) -> np.ndarray:
+    """
+    Vectorized COMID -> row lookup. Returns -1 for any COMID that is not in the basin.
+    """
+    comids = np.atleast_1d(np.asarray(comids, dtype=np.int64))
+    offsets = comids - topo['comid_base']
+    rows = np.full(len(comids), -1, dtype=np.int32)
+    in_range = (offsets >= 0) & (offsets < len(topo['lookup']))
+    rows[in_range] = topo['lookup'][offsets[in_range]]
+    return rows
+
+
+def upstream_rows(topo: dict, row: int) -> np.ndarray:
+    """
+    Gets the rows of all of the reaches upstream of `row` (including `row` itself).
+
+    Instead of recursion, we keep a "frontier" of rows, and at each step replace it with
+    all of their upstream neighbors in a single array operation. The number of steps is the
+    length of the longest flow path, in unit catchments, and there is no risk of
+    hitting Python's recursion limit.
+
+    The first element of the result is always `row`.
+    """
+    up = topo['up']
+    frontier = np.array([row], dtype=np.int32)
+    found = []
+    while frontier.size > 0:
+        found.append(frontier)
+        frontier = up[frontier].ravel()
+        frontier = frontier[frontier >= 0]
+
+    return np.concatenate(found)
+
+
+def upstream_comids(topo: dict, comid: int) -> np.ndarray:
+    """
+    Returns an array with the COMIDs of all of the unit catchments upstream of `comid`.
+    The first element is always `comid` itself, i.e. the terminal unit catchment.
+
+    Uses the nested set labeling, so this is just a slice (a view, not a copy) of the
+    pre-ordered COMID array.
+    """
+    row = comid_to_row(topo, comid)[0]
+    if row < 0:
+        raise Exception(f"COMID {comid} is not in the river network topology")
+
+    start = topo['entry'][row]
+    if start < 0:
+        # Not reachable from any outlet (bad data); fall back to walking the network.
+        return topo['comid'][upstream_rows(topo, row)]
+
+    return topo['preorder_comid'][start:start + topo['size'][row]]
+
+
+def upstream_first(topo: dict, rows) -> np.ndarray:
+    """
+    Returns the positions of `rows`, in an order where every reach comes after all of the
+    reaches that are upstream of it. (In pre-order, upstream reaches have larger entries.)
+    """
+    rows = np.asarray(rows, dtype=np.int64)
+    return np.argsort(-topo['entry'][rows], kind='stable')
+
+
+def get_topology_filename(basin: int) -> str:
+    """
+    Standard filename for the topology index, stored next to the pickle files:
+        PICKLE_DIR/topology_##.npz
+    """
+    return f'{PICKLE_DIR}/topology_{basin}.npz'
+
+
+def load_topology(basin: int, rivers_df: pd.DataFrame) -> dict:
+    """
+    Returns the topology index for a basin. Reads it from disk if we built it before,
+    otherwise builds it from the rivers table and saves it for next time.
+
+    Args:
+        basin: the Pfafstetter level 2 megabasin, an integer from 11 to 91
+        rivers_df: the MERIT-Basins rivers table, indexed by COMID
+
+    Returns:
+        a dict of NumPy arrays, see the module docstring
+    """
+    fname = get_topology_filename(basin) if PICKLE_DIR != '' else ''
+
+    if fname != '' and os.path.isfile(fname):
+        with np.load(fname) as npz:
+            topo = {key: npz[key] for key in npz.files}
+        # If the rivers data has changed since we saved the file, or the file
+        # is from an older version without all of the arrays, build it again
+        if TOPOLOGY_KEYS.issubset(topo):
+            if matches_rivers(topo, rivers_df):
+                if VERBOSE: print(f"Fetching BASIN # {basin} river topology from {fname}")
+                return topo
+            print(f"Warning: the river topology index in {fname} does not match the rivers data. "
+                  "Building it again.")
+
+    if VERBOSE: print(f"Building river topology index for BASIN # {basin}")
+    topo = build_topology(rivers_df)
+
+    if fname != '':
+        if VERBOSE: print(f"Saving river topology index to: {fname}")
+        try:
+            np.savez(fname, **topo)
+        except OSError:
+            print(f"Warning: could not save the topology index to: {fname}")
+
+    return topo
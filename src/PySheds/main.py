@@ -33,7 +33,6 @@ os.environ['USE_PYGEOS'] = '0'
 import pandas as pd
 from shapely.geometry import Polygon
 from shapely.ops import unary_union
-from area import area
 import numpy as np
 
 #-------------------------------------------------------------------------------
@@ -46,11 +45,26 @@ FLACC = os.path.join(os.path.dirname(__file__), "data", "Rasters", "hyd_na_acc_1
 #-------------------------------------------------------------------------------
 # Calculate Watershed Area
 #-------------------------------------------------------------------------------
+WGS84_RADIUS = 6378137
+
+def ring_area(coords):
+    # Area of a ring on a sphere with the WGS84 equatorial radius, in m², as in the "area" package,
+    # but with numpy over all of the vertices at once instead of a Python loop over each one.
+    # sum of (lng[i+2] - lng[i]) * sin(lat[i+1]), going around the ring
+    coords = np.radians(np.asarray(coords, dtype=float))
+    if len(coords) <= 2:
+        return 0
+    lng, lat = coords[:, 0], coords[:, 1]
+    total = np.sum((np.roll(lng, -2) - lng) * np.sin(np.roll(lat, -1)))
+    return total * WGS84_RADIUS * WGS84_RADIUS / 2
+
+
 def calculate_area(shape=None):
-    # print("my shape")
-    # print(shape)
     # format of shape => {'type': 'Polygon', 'coordinates': [[[x, y], [x, y] ...]]}
-    area_km2 = area(shape) / 1e+6
+    # The first ring is the outside of the polygon, and any others are holes.
+    rings = shape['coordinates']
+    area_m2 = abs(ring_area(rings[0])) - sum(abs(ring_area(ring)) for ring in rings[1:])
+    area_km2 = area_m2 / 1e+6
     return round(area_km2, 2)
 
 #-------------------------------------------------------------------------------
@@ -68,6 +68,73 @@ OUTPUT_CSV = True
 # Please note that these files can be large! (Up to around 1 GB for large basins.)
 PICKLE_DIR = 'Mghydro/pkl'
 
+# Format of the cached data in PICKLE_DIR:
+#   "parquet" for a columnar cache (GeoParquet + memory-mapped Arrow files) that only reads the
+#             columns we need, and is rebuilt automatically when the source shapefiles change.
+#             Requires the pyarrow package.
+#   "pickle"  for the original Python pickle files.
+CACHE_FORMAT = "parquet"
+
+# Memory budget, in MB, for keeping basin data (unit catchments, rivers, topology) in memory
+# between calls to delineate() in the same Python process, e.g. in batch scripts.
+# The least recently used basins are dropped when we go over. Set to 0 to turn off.
+BASIN_CACHE_MB = 2000
+
+# Memory budget, in MB, for keeping the decoded tiles of the flow direction and accumulation rasters
+# in memory, in high-res mode. Outlets that are close together use many of the same tiles.
+# The least recently used tiles are dropped when we go over. Set to 0 to turn off.
+RASTER_CACHE_MB = 1000
+
+# Folder for uncompressed copies of the flow direction and accumulation rasters, as NumPy .npy files,
+# which are memory-mapped instead of decoded (see py/raster_memmap.py). They take more disk space,
+# but reading a window is just a slice, and the worker processes share the pages in the OS file cache.
+# Make them with: python prepare_data.py memmap 72. Set to '' to read the GeoTIFFs.
+MEMMAP_DIR = ''
+
+# Number of worker processes to use for the outlet points in each Level 2 basin.
+# The workers are forked after the basin's data is loaded, so they share it instead of each loading a copy.
+# Needs Linux or macOS; on Windows, the script runs with one worker. Can also be set with: --workers N
+WORKERS = 1
+
+# For large watersheds, the script can use pre-dissolved polygons of the entire upstream
+# area of big rivers, instead of merging thousands of unit catchments every time.
+# These are made ahead of time, with: python prepare_data.py predissolve
+# PREDISSOLVE_AREA is the minimum upstream area, in km², for a river reach to get a pre-dissolved
+# polygon. Smaller values mean faster delineation of large watersheds, but larger files.
+# Set PREDISSOLVE = False to ignore the pre-dissolved polygons.
+PREDISSOLVE = True
+PREDISSOLVE_AREA = 10000
+
+# How to dissolve the unit catchments into the watershed polygon (see py/fast_dissolve.py):
+#   "clip"      clip a big rectangle with the unit catchments, then buffer out and in (the original method)
+#   "coverage"  shapely's coverage union, which is fast when neighbours share the same vertices
+#   "snap"      shapely's union, with the coordinates snapped to a fine grid
+#   "edges"     drop the edges that two unit catchments share, and stitch together the rest
+#               (faster if you build the edge index first: python prepare_data.py edges 72)
+# The last 3 skip the buffers, so tiny gaps between unit catchments can show up as holes (FILL removes these).
+# Compare them with: python benchmarks/bench_dissolve.py
+DISSOLVE_METHOD = "clip"
+
+# Very large watersheds (hundreds of thousands of unit catchments) can be dissolved by a pool of worker
+# processes: the unit catchments are split into chunks of DISSOLVE_CHUNK_SIZE neighbouring polygons,
+# the workers dissolve the chunks, and then merge the results two at a time until one polygon is left.
+# DISSOLVE_WORKERS is the number of processes; 1 turns this off. DISSOLVE_MEMORY_MB is roughly how much
+# memory the workers can use together (the chunks are made smaller to fit), or 0 for no limit.
+# Needs Linux or macOS. With WORKERS > 1, the watersheds that the outlet workers make are dissolved in one process.
+DISSOLVE_WORKERS = 1
+DISSOLVE_CHUNK_SIZE = 20000
+DISSOLVE_MEMORY_MB = 0
+
+# Outlets that are in the same unit catchment and snap to the same place on the river have the same
+# watershed. Set to True to delineate these only once, and copy the result to each outlet id.
+DEDUPLICATE = True
+
+# Nested mode, for networks of gauges where the watersheds of downstream gauges contain those upstream.
+# The outlets in each basin are delineated from upstream to downstream, and each watershed is made
+# from the watersheds of the outlets upstream of it, plus the rest of its unit catchments.
+# This is faster when many outlets are on the same rivers, but runs with only one worker.
+NESTED = False
+
 # Threshold for watershed size in km² above which the script will revert to
 # low-resolution mode
 # LOW_RES_THRESHOLD = 50000
@@ -127,3 +194,34 @@ MAX_DIST = 0.075
 # outlet is not getting snapped to a river centerline properly
 THRESHOLD_SINGLE = 500
 THRESHOLD_MULTIPLE = 10000
+
+# How to find the pixels upstream of the outlet in the flow direction raster, in high-res mode:
+#   "builtin" for our own tracer, which works for flow paths of any length (faster with the numba package)
+#   "pysheds" for pysheds' grid.catchment(), which can fail in long, narrow unit catchments
+TRACER = "builtin"
+
+# How to make the polygon of the pixels upstream of the outlet, in high-res mode:
+#   "trace"       trace the outer boundary of the pixels directly (fast)
+#   "trace_holes" same, but keep the holes that are bigger than FILL_THRESHOLD pixels (all of them if FILL = False)
+#   "pysheds"     pysheds' grid.polygonize(), and merge the pieces with unary_union (the original method)
+POLYGONIZE = "trace"
+
+# In high-res mode, split the terminal unit catchment for all of the outlets in it at once,
+# reading the rasters and tracing the flow directions only once (True), or for each outlet separately (False).
+# With PLOTS = True, each outlet is split separately, so that the plots are drawn
+BATCH_SPLIT = True
+
+# In high-res mode, snap the outlets to the streams with an index of the stream pixels in each unit catchment,
+# instead of reading the accumulation raster. The index is made ahead of time, with: python prepare_data.py streams
+# Set to False to ignore the index.
+STREAM_INDEX = True
+
+# File for the on-disk cache of the split terminal unit catchments in high-res mode (an SQLite database),
+# shared by later runs and other jobs. Running the same outlets again skips the raster-based delineation.
+# Set to '' to turn it off. Delete the file to empty the cache.
+SPLIT_CACHE = f"{PICKLE_DIR}/split_cache.sqlite" if PICKLE_DIR != '' else ''
+
+# In high-res mode, use the pre-rasterized unit catchments to mask the rasters to the terminal unit catchment,
+# instead of rasterizing its polygon for every outlet. Build them with: python prepare_data.py labels
+# If they have not been built for a basin, we rasterize the polygons like before.
+CATCHMENT_LABELS = True
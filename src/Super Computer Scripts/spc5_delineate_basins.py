@@ -44,6 +44,7 @@ start         = None
 end           = None
 method        = None
 plot          = None
+workers       = None
 
 parser  = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter,
                                   description='''Delineate all basins specified in file.''')
@@ -59,6 +60,8 @@ parser.add_argument('-m', '--method', action='store', default=method, dest='meth
                     help="Delineation tool to use. One of mghydro, pysheds. Default: Mghydro.")
 parser.add_argument('-p', '--plot', action='store', default=method, dest='plot',
                     help="Plot a webmap of result. Default is 'no'")
+parser.add_argument('-w', '--workers', action='store', default=workers, dest='workers',
+                    help="Number of worker processes for the Mghydro method. If None, uses WORKERS in config.py. Default: None.")
 
 args          = parser.parse_args()
 input_file    = args.input_file
@@ -67,6 +70,7 @@ start         = int(args.start)
 end           = int(args.end)
 method        = args.method
 plot          = args.plot
+workers       = args.workers
 
 if (input_file is None):
     raise ValueError("Input file needs to be specified.")
@@ -135,81 +139,78 @@ for dd in data['value'][start:end]:
 # -------------------------------
 # perform delineation
 # -------------------------------
-for iistation,istation in enumerate(stations):
+import pandas as pd
 
-    print("")
-    print("----------------------------------------------")
-    print("Working on delineating watershed draining towards station {} of {}: id={} (lat={},lng={})".format(
-        iistation+1,
-        len(stations),
-        istation['id'],
-        istation['lat'],
-        istation['lng']))
-    print(istation)
-    print("----------------------------------------------")
+json_name = input_file[:-5]
+dir_path = os.path.dirname(os.path.realpath(__file__))
 
+if (method in [None, 'mghydro']):  # Mghydro as default method
 
-    # Kasope add code to delineate basin ...
-    # os.environ['USE_PYGEOS'] = '0'
-    import pandas as pd
+    # All of the stations go through one call of delineate_batch(), in memory, so the
+    # basin data is only loaded once for all of the stations in the same Level 2 basin.
+    sys.path.append(os.path.join(dir_path, "..", "Mghydro"))
 
-    json_name = input_file[:-5]
-    basin = pd.DataFrame.from_records([istation])
-    print("basin")
-    print(basin, json_name)
+    from delineate import delineate_batch
+    from py.settings import Settings
 
-    dir_path = os.path.dirname(os.path.realpath(__file__))
-    
-    point_filename = json_name+'_point_{}_{}.csv'.format(start,end)
+    print("")
+    print("----------------------------------------------")
+    print("Working on delineating watersheds draining towards {} stations".format(len(stations)))
+    print("----------------------------------------------")
 
-    if (method in [None, 'mghydro']):  # Mghydro as default method
+    points = pd.DataFrame.from_records(stations)
+    settings = Settings.from_config(output_dir=os.path.abspath(output_folder),
+                                    output_prefix=json_name + '_')
+    if workers is not None:
+        settings = settings.replace(workers=int(workers))
+
+    # the relative paths in config.py are relative to the Mghydro folder
+    prev_path = os.getcwd()
+    os.chdir(sys.path[-1])
+    try:
+        watersheds_gdf, status_df = delineate_batch(points, settings)
+    finally:
+        os.chdir(prev_path)
 
+    print(status_df[['result', 'area_calc_sqkm', 'explanation']])
 
-        # change the next two lines to use a different method for the
-        # watershed delineation by changing the module and delineation
-        # function being imported
-        sys.path.append(os.path.join(dir_path, "..", "Mghydro"))
-        # print(sys.path)
+elif method == "pysheds":
+    sys.path.append(os.path.join(dir_path, "..", "Pysheds"))
 
-        
-        basin_csv = basin.to_csv(point_filename)
+    import main
 
-        import config
-        config.OUTLETS_CSV = os.path.abspath(point_filename)
-        config.OUTPUT_DIR = os.path.abspath(output_folder)
-        config.OUTPUT_PREFIX = json_name + '_'
+    for iistation,istation in enumerate(stations):
 
-        from delineate import delineate
+        print("")
+        print("----------------------------------------------")
+        print("Working on delineating watershed draining towards station {} of {}: id={} (lat={},lng={})".format(
+            iistation+1,
+            len(stations),
+            istation['id'],
+            istation['lat'],
+            istation['lng']))
+        print(istation)
+        print("----------------------------------------------")
 
-        prev_path = os.getcwd()
-        target_dir = sys.path[-1]
+        basin = pd.DataFrame.from_records([istation])
+        main.delineate(output_dir=output_folder, output_fname=json_name+'_', basins=basin)
 
-        os.chdir(target_dir)
-        
-        print(f"station: {istation['id']}")
-        delineate()
+if plot == 'yes':
+    sys.path.append(os.path.join(dir_path, "..", "Read Shapefiles"))
 
-        os.chdir(prev_path)
+    import read_plot_shp as plt
 
-        
+    point_filename = json_name+'_point_{}_{}.csv'.format(start,end)
 
-    elif method == "pysheds":
-        sys.path.append(os.path.join(dir_path, "..", "Pysheds"))
-        
-        import main
+    for istation in stations:
+        basin = pd.DataFrame.from_records([istation])
+        basin.to_csv(point_filename)
 
-        main.delineate(output_dir=output_folder, output_fname=json_name+'_', basins=basin)
-    
-    if plot == 'yes':
-        sys.path.append(os.path.join(dir_path, "..", "Read Shapefiles"))
-        
-        import read_plot_shp as plt
-        
         watershed_filename = json_name + '_' + str(istation['id'])
         watershed_gdf = plt.read_in_shapefile(data_dict={watershed_filename: os.path.join(output_folder, watershed_filename) + '.geojson'})
         plt.plot_shp(shapefiles=watershed_gdf, plot='webmap', point_file=point_filename, outfile_path=os.path.join(output_folder, watershed_filename))
-        
-    if(os.path.exists(point_filename) and os.path.isfile(point_filename)):
+
+        if(os.path.exists(point_filename) and os.path.isfile(point_filename)):
             os.remove(point_filename)
 
 print("")